@@ -0,0 +1,158 @@
+# admission.py
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from config import ADMISSION_MAX_CONCURRENT, ADMISSION_RATE, ADMISSION_BURST, ADMISSION_DEADLINES
+from metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+# 优先级从高到低
+CRISIS = "crisis"  # 危机模式用户的回复
+NORMAL = "normal"  # 普通聊天回复
+BACKGROUND = "background"  # 心理评估等后台任务
+LANES = (CRISIS, NORMAL, BACKGROUND)
+
+
+class AdmissionRejected(Exception):
+    """排队超过该优先级的期限，请求被放弃"""
+
+    def __init__(self, lane: str, waited: float):
+        super().__init__(f"{lane} 请求排队 {waited:.1f}s 后被放弃")
+        self.lane = lane
+        self.waited = waited
+
+
+class AdmissionController:
+    """模型调用的准入控制：全局并发上限 + 令牌桶限速 + 按优先级排队
+
+    有空位时总是先放行高优先级的排队请求。deadlines 给出各优先级最多排队多少秒，
+    超时抛出 AdmissionRejected 由调用方快速回复；None 表示一直等待。
+    rate <= 0 时不限速。
+    """
+
+    def __init__(self, max_concurrent: int, rate: float, burst: int, deadlines: Dict[str, Optional[float]]):
+        self.max_concurrent = max(1, max_concurrent)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.deadlines = deadlines
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._queues: Dict[str, deque] = {lane: deque() for lane in LANES}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.active = 0
+        self.admitted = {lane: 0 for lane in LANES}
+        self.rejected = {lane: 0 for lane in LANES}
+        self.wait = {lane: LatencyStats() for lane in LANES}
+
+    def _take_token(self) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _next_queue(self) -> Optional[deque]:
+        """返回队首有有效等待者的最高优先级队列"""
+        for lane in LANES:
+            queue = self._queues[lane]
+            while queue:
+                if not queue[0].done():
+                    return queue
+                queue.popleft()  # 已超时放弃的等待者
+        return None
+
+    def _kick(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """按优先级把空出的名额交给排队的请求"""
+        self._timer = None
+        while self.active < self.max_concurrent:
+            queue = self._next_queue()
+            if queue is None:
+                return
+            if not self._take_token():
+                # 令牌不足：等到下一个令牌生成时再分配
+                delay = (1 - self._tokens) / self.rate
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            queue.popleft().set_result(None)
+            self.active += 1
+
+    async def acquire(self, lane: str) -> None:
+        started = time.monotonic()
+        if self.active < self.max_concurrent and self._next_queue() is None and self._take_token():
+            self.active += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues[lane].append(waiter)
+            self._kick()
+            try:
+                await asyncio.wait_for(waiter, self.deadlines.get(lane))
+            except asyncio.TimeoutError:
+                waited = time.monotonic() - started
+                self.rejected[lane] += 1
+                self.wait[lane].record(waited)
+                logger.warning(f"模型调用排队超时，放弃 {lane} 请求 (等待 {waited:.1f}s, 当前 {self.metrics()['lanes']})")
+                raise AdmissionRejected(lane, waited) from None
+            except asyncio.CancelledError:
+                # 名额已经分配但调用方被取消：交还名额
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                raise
+        self.admitted[lane] += 1
+        self.wait[lane].record(time.monotonic() - started)
+
+    def try_acquire(self, lane: str) -> bool:
+        """不排队：有空闲名额和令牌、且没有更早的排队请求时立即占用，否则返回 False"""
+        if self.active < self.max_concurrent and self._next_queue() is None and self._take_token():
+            self.active += 1
+            self.admitted[lane] += 1
+            return True
+        return False
+
+    def share(self, workers: int) -> None:
+        """多进程运行时每个进程只分得 1/workers 的并发上限和速率，各进程合计不超过配置值"""
+        if workers <= 1:
+            return
+        self.max_concurrent = max(1, self.max_concurrent // workers)
+        self.rate = self.rate / workers
+        self.burst = max(1, self.burst // workers)
+        self._tokens = min(self._tokens, float(self.burst))
+
+    def release(self) -> None:
+        self.active -= 1
+        self._kick()
+
+    @asynccontextmanager
+    async def slot(self, lane: str):
+        """占用一个模型调用名额"""
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'active': self.active,
+            'max_concurrent': self.max_concurrent,
+            'lanes': {lane: sum(not w.done() for w in self._queues[lane]) for lane in LANES},
+            'admitted': dict(self.admitted),
+            'rejected': dict(self.rejected),
+            'wait': {lane: self.wait[lane].snapshot() for lane in LANES},
+        }
+
+
+admission = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_RATE, ADMISSION_BURST, ADMISSION_DEADLINES)
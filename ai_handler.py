@@ -1,12 +1,20 @@
 # ai_handler.py
+import asyncio
 import logging
 import os
-import requests
 import json
 import sys
+import time
+import httpx
 from urllib.parse import quote
-from config import OPENROUTER_API_KEY, AI_MODEL, AI_TEMPERATURE
+from config import (
+    OPENROUTER_API_KEY, OPENROUTER_API_URL, AI_TEMPERATURE,
+    AI_MAX_CONNECTIONS, AI_MAX_KEEPALIVE_CONNECTIONS, AI_KEEPALIVE_EXPIRY,
+    AI_CONNECT_TIMEOUT, AI_READ_TIMEOUT, AI_WRITE_TIMEOUT, AI_POOL_TIMEOUT,
+)
 from prompts import SYSTEM_PROMPT
+from admission import admission, NORMAL
+from model_router import model_router
 from typing import Optional, AsyncGenerator
 
 # 配置控制台编码为UTF-8以支持中文
@@ -18,127 +26,228 @@ if sys.platform == "win32":
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+# HTTP/2 需要可选依赖 h2（pip install "httpx[http2]"），缺失时退回 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 全局共享的异步客户端，绑定到创建它的事件循环
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """获取共享的 AsyncClient，当前事件循环变化时重新创建"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        # 旧循环上的连接无法在新循环复用，直接丢弃
+        _client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=AI_MAX_CONNECTIONS,
+                max_keepalive_connections=AI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=AI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=AI_CONNECT_TIMEOUT,
+                read=AI_READ_TIMEOUT,
+                write=AI_WRITE_TIMEOUT,
+                pool=AI_POOL_TIMEOUT,
+            ),
+        )
+        _client_loop = loop
+        logging.info(f"创建 OpenRouter 连接池 (HTTP/2: {HTTP2_AVAILABLE}, 最大连接数: {AI_MAX_CONNECTIONS})")
+    return _client
+
+
+async def close_ai_client() -> None:
+    """关闭共享客户端，释放连接池（在应用关闭时调用）"""
+    global _client, _client_loop
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
+
+def _build_headers() -> dict:
+    """构建 OpenRouter 请求头"""
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+    http_referer = os.getenv("HTTP_REFERER")
+    if http_referer:
+        headers["HTTP-Referer"] = http_referer
+
+    site_name = os.getenv("YOUR_SITE_NAME")
+    if site_name:
+        # URL 编码以支持中文字符
+        headers["X-Title"] = quote(site_name, safe='')
+    return headers
+
+
+def _build_payload(model: str, history: list, system_prompt: str, max_tokens: Optional[int], stream: bool = False) -> dict:
+    """构建请求体"""
+    data = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            *history
+        ],
+        "temperature": AI_TEMPERATURE,
+    }
+    if stream:
+        data["stream"] = True
+    if max_tokens:
+        data["max_tokens"] = max_tokens
+    return data
 
-async def get_ai_response(history: list, system_prompt: str = SYSTEM_PROMPT, max_tokens: Optional[int] = None) -> Optional[str]:
-    """
-    调用 OpenRouter API 获取非流式 AI 回复。
-    """
-    messages = [
-        {"role": "system", "content": system_prompt},
-        *history
-    ]
 
+async def _complete(model: str, history: list, system_prompt: str, max_tokens: Optional[int]) -> Optional[str]:
+    """向指定模型发送一次非流式请求，记录延迟或失败；出错时返回 None"""
+    started = time.monotonic()
     try:
-        logging.info(f"向 OpenRouter 发送非流式请求，模型: {AI_MODEL}, 历史长度: {len(history)}")
-        
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        
-        http_referer = os.getenv("HTTP_REFERER")
-        if http_referer:
-            headers["HTTP-Referer"] = http_referer
-
-        site_name = os.getenv("YOUR_SITE_NAME")
-        if site_name:
-            # URL 编码以支持中文字符
-            headers["X-Title"] = quote(site_name, safe='')
-
-        data = {
-            "model": AI_MODEL,
-            "messages": messages,
-            "temperature": AI_TEMPERATURE,
-        }
-        if max_tokens:
-            data["max_tokens"] = max_tokens
-        
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=data
+        logging.info(f"向 OpenRouter 发送非流式请求，模型: {model}, 历史长度: {len(history)}")
+
+        response = await _get_client().post(
+            OPENROUTER_API_URL,
+            headers=_build_headers(),
+            json=_build_payload(model, history, system_prompt, max_tokens)
         )
-        
+
         response.raise_for_status()
         completion = response.json()
-        
+
         if (completion.get("choices") and
             len(completion["choices"]) > 0 and
             (choice := completion["choices"][0]).get("message") is not None and
-            (msg := choice["message"]).get("content") is not None):
+            (msg := choice["message"]).get("content")):
             response_text = msg["content"]
-            logging.info(f"收到 OpenRouter 的回复: {response_text[:100]}...")
+            model_router.record_success(model, time.monotonic() - started)
+            logging.info(f"收到 OpenRouter 的回复 ({model}, {time.monotonic() - started:.2f}s): {response_text[:100]}...")
             return response_text
         else:
-            logging.warning("AI 响应为空或无效")
+            model_router.record_failure(model)
+            logging.warning(f"AI 响应为空或无效 ({model})")
             return None
+    except asyncio.CancelledError:
+        # 对冲落败或调用方超时被取消：不算失败，已等待的时间作为延迟下界记录
+        model_router.record_cancelled(model, time.monotonic() - started)
+        raise
     except Exception as e:
-        logging.error(f"调用 AI 时发生未知错误: {e}")
+        model_router.record_failure(model)
+        logging.error(f"调用 AI 时发生未知错误 ({model}): {e}")
         return None
 
 
-async def get_ai_stream(history: list, system_prompt: str = SYSTEM_PROMPT, max_tokens: Optional[int] = None) -> AsyncGenerator[str, None]:
+async def get_ai_response(history: list, system_prompt: str = SYSTEM_PROMPT, max_tokens: Optional[int] = None, lane: str = NORMAL) -> Optional[str]:
+    """
+    调用 OpenRouter API 获取非流式 AI 回复。
+    调用前按 lane 优先级排队获取准入名额，排队超时抛出 AdmissionRejected。
+
+    首选模型超过对冲延迟（其最近的 p95 延迟）仍未返回时，向最快的备选模型再发一次请求，
+    采用先返回的有效回复并取消另一方；首选模型失败时立即改用备选模型。
+    对冲请求需要另占一个准入名额，没有立即可用的名额时不对冲，继续等待首选模型。
+    """
+    async with admission.slot(lane):
+        loop = asyncio.get_running_loop()
+        primary = model_router.candidates()[0]
+        tried = [primary]
+        pending = {asyncio.create_task(_complete(primary, history, system_prompt, max_tokens)): primary}
+        hedge_at = loop.time() + model_router.hedge_delay(primary)
+        hedging = True
+        try:
+            while pending:
+                alternative = model_router.fastest_alternative(tried)
+                # 只对首选模型对冲一次，同时最多两个请求
+                timeout = max(0.0, hedge_at - loop.time()) if hedging and len(tried) == 1 and alternative else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedging = False
+                    if not admission.try_acquire(lane):
+                        model_router.hedges_skipped += 1
+                        logging.info(f"模型 {primary} 超过对冲延迟未返回，但没有空闲的准入名额，不发出对冲请求")
+                        continue
+                    model_router.hedges += 1
+                    logging.info(f"模型 {primary} 超过 {model_router.hedge_delay(primary):.1f}s 未返回，向 {alternative} 发出对冲请求")
+                    tried.append(alternative)
+                    hedge = asyncio.create_task(_complete(alternative, history, system_prompt, max_tokens))
+                    # 对冲请求结束（含被取消）时交还它占用的名额
+                    hedge.add_done_callback(lambda _: admission.release())
+                    pending[hedge] = alternative
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    if task.result():
+                        if model != primary:
+                            model_router.hedge_wins += 1
+                        return task.result()
+                if pending or not alternative:
+                    continue
+                # 已有请求都失败：在调用方的名额内改用备选模型
+                model_router.fallbacks += 1
+                logging.warning(f"模型 {tried[-1]} 请求失败，改用 {alternative}")
+                tried.append(alternative)
+                pending[asyncio.create_task(_complete(alternative, history, system_prompt, max_tokens))] = alternative
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def get_ai_stream(history: list, system_prompt: str = SYSTEM_PROMPT, max_tokens: Optional[int] = None, lane: str = NORMAL) -> AsyncGenerator[str, None]:
     """
     调用 OpenRouter API 获取流式 AI 回复。
+    整个流式过程占用一个准入名额，排队超时抛出 AdmissionRejected。
+    收到第一个 chunk 之前出错时依次改用备选模型；开始输出后出错则直接结束流。
     """
-    messages = [
-        {"role": "system", "content": system_prompt},
-        *history
-    ]
+    async with admission.slot(lane):
+        candidates = model_router.candidates()
+        for index, model in enumerate(candidates):
+            started = False
+            try:
+                logging.info(f"向 OpenRouter 发送流式请求，模型: {model}, 历史长度: {len(history)}")
 
-    try:
-        logging.info(f"向 OpenRouter 发送流式请求，模型: {AI_MODEL}, 历史长度: {len(history)}")
-        
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        
-        http_referer = os.getenv("HTTP_REFERER")
-        if http_referer:
-            headers["HTTP-Referer"] = http_referer
-
-        site_name = os.getenv("YOUR_SITE_NAME")
-        if site_name:
-            # URL 编码以支持中文字符
-            headers["X-Title"] = quote(site_name, safe='')
-
-        data = {
-            "model": AI_MODEL,
-            "messages": messages,
-            "temperature": AI_TEMPERATURE,
-            "stream": True,
-        }
-        if max_tokens:
-            data["max_tokens"] = max_tokens
-        
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=data,
-            stream=True
-        )
-        
-        response.raise_for_status()
-        
-        # 设置响应编码为 UTF-8
-        response.encoding = 'utf-8'
-        
-        for chunk in response.iter_lines(decode_unicode=True):
-            if chunk:
-                if chunk.startswith("data: "):
-                    data_str = chunk[6:]
-                    if data_str != "[DONE]":
-                        try:
-                            chunk_data = json.loads(data_str)
-                            if chunk_data.get("choices") and len(chunk_data["choices"]) > 0:
-                                delta = chunk_data["choices"][0].get("delta", {})
-                                if delta.get("content"):
-                                    yield delta["content"]
-                                    logging.debug(f"流式 chunk: {delta['content']}")
-                        except json.JSONDecodeError:
-                            continue
-        logging.info("流式响应完成")
-    except Exception as e:
-        logging.error(f"调用 AI 时发生未知错误: {e}")
-        yield f"错误: {str(e)}"
+                async with _get_client().stream(
+                    "POST",
+                    OPENROUTER_API_URL,
+                    headers=_build_headers(),
+                    json=_build_payload(model, history, system_prompt, max_tokens, stream=True)
+                ) as response:
+                    response.raise_for_status()
+
+                    # SSE 按 UTF-8 解码
+                    async for chunk in response.aiter_lines():
+                        if chunk:
+                            if chunk.startswith("data: "):
+                                data_str = chunk[6:]
+                                if data_str != "[DONE]":
+                                    try:
+                                        chunk_data = json.loads(data_str)
+                                        if chunk_data.get("choices") and len(chunk_data["choices"]) > 0:
+                                            delta = chunk_data["choices"][0].get("delta", {})
+                                            if delta.get("content"):
+                                                started = True
+                                                yield delta["content"]
+                                                logging.debug(f"流式 chunk: {delta['content']}")
+                                    except json.JSONDecodeError:
+                                        continue
+                if started:
+                    model_router.record_success(model)
+                    logging.info("流式响应完成")
+                    return
+                model_router.record_failure(model)
+                logging.warning(f"流式响应为空 ({model})")
+            except Exception as e:
+                # 出错时直接结束流，由调用方按空回复处理（与 get_ai_response 返回 None 一致）
+                model_router.record_failure(model)
+                logging.error(f"调用 AI 时发生未知错误 ({model}): {e}")
+                if started:
+                    return
+            if index + 1 < len(candidates):
+                model_router.fallbacks += 1
+                logging.warning(f"模型 {model} 流式请求失败，改用 {candidates[index + 1]}")
@@ -0,0 +1,210 @@
+# assessment_worker.py
+import asyncio
+import json
+import logging
+import re
+import time
+from typing import Dict, Optional
+
+from admission import AdmissionRejected, BACKGROUND
+from ai_handler import get_ai_response
+from background_worker import BackgroundWorker
+from config import (
+    ASSESSMENT_QUEUE_MAX, ASSESSMENT_BATCH_SIZE, ASSESSMENT_TIMEOUT, ASSESSMENT_EWMA_ALPHA, ASSESSMENT_MIN_CHARS,
+    ASSESSMENT_MAX_MESSAGES,
+)
+from database import get_assessment_state, get_messages_after, record_assessment
+from metrics import LatencyStats
+from prompts import MENTAL_ASSESSMENT_PROMPT, MENTAL_ASSESSMENT_BATCH_PROMPT, PREVIOUS_SCORES_TEMPLATE, NO_PREVIOUS_SCORES
+
+logger = logging.getLogger(__name__)
+
+_ROLE_NAMES = {"user": "用户", "assistant": "助手"}
+
+
+def format_history(history: list) -> str:
+    """把消息列表转换为紧凑的对话文本"""
+    return "\n".join(f"{_ROLE_NAMES.get(m['role'], m['role'])}: {m['content']}" for m in history)
+
+
+def parse_json_object(text: Optional[str]) -> Optional[dict]:
+    """从模型输出中提取 JSON 对象，兼容代码块包裹和前后多余文字"""
+    if not text:
+        return None
+    text = re.sub(r"^```(?:json)?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end <= start:
+            return None
+        try:
+            data = json.loads(text[start:end + 1])
+        except json.JSONDecodeError:
+            return None
+    return data if isinstance(data, dict) else None
+
+
+def parse_scores(data) -> Optional[tuple]:
+    """读取并校验 (抑郁, 焦虑) 分数，限制在 0-10 之间"""
+    if not isinstance(data, dict):
+        return None
+    try:
+        depression = float(data["depression"])
+        anxiety = float(data["anxiety"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return min(max(depression, 0.0), 10.0), min(max(anxiety, 0.0), 10.0)
+
+
+class AssessmentWorker(BackgroundWorker):
+    """后台心理评估队列
+
+    每次只把上次评估之后的新消息和上次的分数发给模型，新分数按 alpha 与上次的分数做 EWMA 合并，
+    并追加到分数序列。新消息中用户说的话少于 min_chars 个字时跳过，留到下次一起评估。
+    同一用户在处理前的多次请求只处理一次；队列有上限，满时丢弃新请求。
+    batch_size > 1 时把多位用户合并到一次模型调用中。
+    """
+
+    def __init__(self, max_queue: int, batch_size: int, timeout: float, alpha: float, min_chars: int,
+                 max_messages: int):
+        super().__init__()
+        self.max_queue = max_queue
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.alpha = alpha
+        self.min_chars = min_chars
+        self.max_messages = max_messages
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.assessed = 0
+        self.skipped = 0
+        self.shed = 0
+        self.batches = 0
+        self.messages_sent = 0
+        self.queue_wait = LatencyStats()
+        self.call_time = LatencyStats()
+
+    def submit(self, chat_id: int) -> bool:
+        """提交评估请求，返回是否被接受；评估时从数据库读取上次评估之后的新消息"""
+        self.submitted += 1
+        if chat_id in self._pending:
+            # 合并：保留原来的排队位置
+            self.coalesced += 1
+            return True
+        if len(self._pending) >= self.max_queue:
+            self.dropped += 1
+            logger.warning(f"评估队列已满 ({self.max_queue})，丢弃用户 {chat_id} 的评估请求")
+            return False
+        self._enqueue(chat_id, time.monotonic())  # chat_id -> 入队时间
+        return True
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'queue_depth': len(self._pending),
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'assessed': self.assessed,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'shed': self.shed,
+            'batches': self.batches,
+            'messages_sent': self.messages_sent,
+            'queue_wait': self.queue_wait.snapshot(),
+            'call_time': self.call_time.snapshot(),
+        }
+
+    async def _process_next(self) -> None:
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            chat_id, enqueued_at = self._pending.popitem(last=False)
+            self.queue_wait.record(time.monotonic() - enqueued_at)
+            try:
+                job = self._prepare(chat_id)
+            except Exception as e:
+                # 单个用户读取失败（例如数据库被锁）不影响同一批的其他用户
+                self.failed += 1
+                logger.warning(f"读取心理评估数据失败 (用户 {chat_id}): {e}")
+                continue
+            if job is not None:
+                batch.append(job)
+        if batch:
+            await self.run_batch(batch)
+
+    def _prepare(self, chat_id: int) -> Optional[tuple]:
+        """读取上次的分数和之后的新消息，返回 (chat_id, 上次分数或 None, 新消息)；新内容太少时返回 None"""
+        state = get_assessment_state(chat_id)
+        if state is None:
+            return None
+        depression, anxiety, last_id = state
+        rows = get_messages_after(chat_id, last_id, self.max_messages)
+        if sum(len(content.strip()) for _, role, content in rows if role == "user") < self.min_chars:
+            self.skipped += 1
+            return None
+        previous = None if last_id is None else (depression or 0.0, anxiety or 0.0)
+        return chat_id, previous, rows
+
+    @staticmethod
+    def _format_previous(previous: Optional[tuple]) -> str:
+        if previous is None:
+            return NO_PREVIOUS_SCORES
+        return PREVIOUS_SCORES_TEMPLATE.format(depression=previous[0], anxiety=previous[1])
+
+    @staticmethod
+    def _format_rows(rows: list) -> str:
+        return format_history([{'role': role, 'content': content} for _, role, content in rows])
+
+    def combine(self, previous: Optional[tuple], scores: tuple) -> tuple:
+        """新分数与上次的分数做 EWMA；首次评估直接使用新分数"""
+        if previous is None:
+            return scores
+        return tuple(round(self.alpha * new + (1 - self.alpha) * old, 2) for new, old in zip(scores, previous))
+
+    async def run_batch(self, batch: list) -> None:
+        """评估一批 (chat_id, 上次分数, 新消息) 并写入分数"""
+        self.batches += 1
+        started = time.monotonic()
+        try:
+            if len(batch) == 1:
+                chat_id, previous, rows = batch[0]
+                prompt = MENTAL_ASSESSMENT_PROMPT.format(previous=self._format_previous(previous),
+                                                         history=self._format_rows(rows))
+                response = await asyncio.wait_for(get_ai_response([{"role": "system", "content": prompt}], lane=BACKGROUND), timeout=self.timeout)
+                results = {chat_id: parse_scores(parse_json_object(response))}
+            else:
+                conversations = "\n\n".join(
+                    f"### 用户 {i}（上次评分：{self._format_previous(previous)}）\n{self._format_rows(rows)}"
+                    for i, (_, previous, rows) in enumerate(batch, start=1))
+                prompt = MENTAL_ASSESSMENT_BATCH_PROMPT.format(conversations=conversations)
+                response = await asyncio.wait_for(get_ai_response([{"role": "system", "content": prompt}], lane=BACKGROUND), timeout=self.timeout)
+                data = parse_json_object(response) or {}
+                results = {chat_id: parse_scores(data.get(str(i))) for i, (chat_id, _, _) in enumerate(batch, start=1)}
+        except AdmissionRejected:
+            # 模型调用繁忙时放弃本批评估，新消息保留到下次评估
+            self.shed += len(batch)
+            return
+        except Exception as e:
+            self.failed += len(batch)
+            logger.warning(f"心理评估失败 ({len(batch)} 位用户): {e}")
+            return
+        finally:
+            self.call_time.record(time.monotonic() - started)
+            self.messages_sent += sum(len(rows) for _, _, rows in batch)
+
+        for chat_id, previous, rows in batch:
+            scores = results.get(chat_id)
+            if scores is None:
+                self.failed += 1
+                logger.warning(f"心理评估结果无法解析 (用户 {chat_id})")
+                continue
+            combined = self.combine(previous, scores)
+            record_assessment(chat_id, *combined, *scores, rows[-1][0], len(rows))
+            self.assessed += 1
+            logger.info(f"心理评估更新 (用户 {chat_id}, {len(rows)} 条新消息): 抑郁={combined[0]}, 焦虑={combined[1]}"
+                        f"（本次 {scores[0]}/{scores[1]}）")
+
+
+assessment_worker = AssessmentWorker(ASSESSMENT_QUEUE_MAX, ASSESSMENT_BATCH_SIZE, ASSESSMENT_TIMEOUT,
+                                     ASSESSMENT_EWMA_ALPHA, ASSESSMENT_MIN_CHARS, ASSESSMENT_MAX_MESSAGES)
@@ -0,0 +1,58 @@
+# background_worker.py
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWorker:
+    """后台队列的公共部分：待处理的键按提交顺序排队，处理前重复提交的键只保留一次，
+    由当前事件循环中的一个后台任务依次处理
+
+    子类实现 _process_next，每次从 _pending 取出一项（或一批）并处理。处理中的异常（例如数据库被锁）
+    只计入 failed，后台任务继续处理后面的请求。
+    """
+
+    def __init__(self):
+        self._pending: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.failed = 0
+
+    def _enqueue(self, key: Hashable, value: Any = None) -> None:
+        self._pending[key] = value
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        """在当前事件循环中启动后台任务"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            if self._pending:
+                self._wakeup.set()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                try:
+                    await self._process_next()
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"{type(self).__name__} 处理失败: {e}")
+
+    async def _process_next(self) -> None:
+        raise NotImplementedError
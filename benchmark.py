@@ -0,0 +1,255 @@
+# benchmark.py
+"""
+性能基准测试。用法：python benchmark.py [名称 ...]，不带参数时运行全部。
+所有基准都使用临时数据库，不会修改 database.db。
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import database
+
+
+def _timeit(fn, repeat: int) -> float:
+    """运行 fn repeat 次，返回单次平均耗时（毫秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def _use_temp_db(name: str) -> str:
+    """把 database 模块切换到临时数据库文件"""
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_"), name)
+    database.DB_PATH = path
+    database.init_db()
+    return path
+
+
+def bench_connections(repeat: int = 500) -> None:
+    """对比每次操作新建连接与长连接下，一条用户消息的数据库开销"""
+    path = _use_temp_db("connections.db")
+    user_id = 1
+    database.create_or_update_user(user_id)
+    for i in range(40):
+        database.save_message(user_id, "user" if i % 2 == 0 else "assistant", f"历史消息 {i}")
+
+    def legacy(sql: str, params: tuple = ()) -> list:
+        # 旧实现：每个函数调用都 connect / execute / commit / close
+        conn = sqlite3.connect(path)
+        rows = conn.execute(sql, params).fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    select_user = 'SELECT * FROM users WHERE user_id = ?'
+    update_user = 'UPDATE users SET daily_chat_count = daily_chat_count, updated_at = ? WHERE user_id = ?'
+    insert_message = 'INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)'
+    select_history = 'SELECT role, content, timestamp FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?'
+
+    def legacy_message() -> None:
+        # 与原 handle_message 的调用顺序一致
+        now = datetime.now().isoformat()
+        legacy(select_user, (user_id,))                      # get_user
+        legacy(select_user, (user_id,))                      # increment_daily_chat -> get_user
+        legacy(select_user, (user_id,))                      # -> create_or_update_user -> get_user
+        legacy(update_user, (now, user_id))
+        legacy(select_user, (user_id,))                      # 更新 last_message_time
+        legacy(update_user, (now, user_id))
+        legacy(select_history, (user_id, 20))                # get_user_history
+        legacy(insert_message, (user_id, "user", "你好", now))
+        legacy(select_user, (user_id,))                      # 读取 warning_count
+        legacy(insert_message, (user_id, "assistant", "你好。", now))
+        legacy(select_user, (user_id,))                      # update_mental_scores
+        legacy(update_user, (now, user_id))
+
+    def pooled_message() -> None:
+        database.get_user(user_id)
+        database.increment_daily_chat(user_id)
+        database.create_or_update_user(user_id, last_message_time=datetime.now().isoformat())
+        database.get_user_history(user_id, 20)
+        database.save_message(user_id, "user", "你好")
+        database.get_user(user_id)
+        database.save_message(user_id, "assistant", "你好。")
+        database.update_mental_scores(user_id, 1.0, 1.0)
+
+    before = _timeit(legacy_message, repeat)
+    after = _timeit(pooled_message, repeat)
+    print("== 每条消息的数据库开销 ==")
+    print(f"每次新建连接: {before:.3f} ms/消息")
+    print(f"长连接 + WAL: {after:.3f} ms/消息  (提升 {before / after:.1f}x)")
+    database.close_connection()
+
+
+def bench_history(n_messages: int = int(os.getenv("BENCH_MESSAGES", "3000000")), n_users: int = 20000) -> None:
+    """在数百万条消息的表上对比 get_user_history 的旧查询与索引查询"""
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_"), "history.db")
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, role TEXT, content TEXT, timestamp TEXT)')
+    print(f"生成 {n_messages} 条消息（{n_users} 个用户）...")
+    base = datetime.now().timestamp()
+    rows = (
+        (i % n_users, "user" if i % 2 == 0 else "assistant", "今天有点累，不太想说话。" * 3,
+         datetime.fromtimestamp(base + i).isoformat())
+        for i in range(n_messages)
+    )
+    with conn:
+        conn.executemany('INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)', rows)
+    conn.close()
+
+    old_query = 'SELECT role, content, timestamp FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?'
+    new_query = 'SELECT role, content FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?'
+    user_ids = iter(range(10 ** 9))
+
+    conn = sqlite3.connect(path)
+    before = _timeit(lambda: conn.execute(old_query, (next(user_ids) % n_users, 20)).fetchall(), 5)
+    conn.close()
+
+    # 在已有数据上运行迁移，与升级线上 database.db 的过程一致
+    database.DB_PATH = path
+    start = time.perf_counter()
+    database.init_db()
+    migrate_ms = (time.perf_counter() - start) * 1000
+    conn = database.get_connection()
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + new_query, (1, 20)).fetchall()
+    after = _timeit(lambda: conn.execute(new_query, (next(user_ids) % n_users, 20)).fetchall(), 2000)
+
+    print("== get_user_history 查询耗时 ==")
+    print(f"无索引 ORDER BY timestamp: {before:.3f} ms/次")
+    print(f"(user_id, id) 索引 ORDER BY id: {after:.3f} ms/次  (提升 {before / after:.0f}x)")
+    print(f"迁移（建索引）耗时: {migrate_ms:.0f} ms")
+    print(f"查询计划: {plan[0][-1]}")
+    database.close_connection()
+
+
+def bench_keywords(repeat: int = 2000) -> None:
+    """对比逐个关键词子串查找与 Aho-Corasick 匹配器在不同词表大小和消息长度下的耗时"""
+    import random
+    from config import CRISIS_KEYWORDS, VIOLATION_KEYWORDS
+    from keyword_matcher import KeywordMatcher
+
+    rng = random.Random(42)
+    alphabet = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]  # 常用汉字区间
+    base = list(CRISIS_KEYWORDS) + list(VIOLATION_KEYWORDS)
+    print("== 关键词匹配耗时 (µs/条消息) ==")
+    print(f"{'词表大小':>8} {'消息长度':>8} {'逐词查找':>10} {'自动机':>10} {'提升':>6}")
+    for size in (len(base), 200, 2000):
+        extra = [''.join(rng.choices(alphabet, k=rng.randint(2, 4))) for _ in range(size - len(base))]
+        keywords = base + extra
+        matcher = KeywordMatcher({"crisis": keywords[:size // 2], "violation": keywords[size // 2:]})
+        for length in (20, 200, 2000):
+            text = ''.join(rng.choices(alphabet, k=length))
+            naive = _timeit(lambda: any(k in text for k in keywords), repeat) * 1000
+            automaton = _timeit(lambda: matcher.find_all(text), repeat) * 1000
+            print(f"{size:>12} {length:>12} {naive:>14.1f} {automaton:>13.1f} {naive / automaton:>7.1f}x")
+
+
+def bench_inactivity_sweep(n_users: int = int(os.getenv("BENCH_USERS", "100000")), repeat: int = 5) -> None:
+    """对比逐用户标记与批量 UPDATE 的每分钟不活跃检查开销"""
+    from datetime import timedelta
+
+    path = _use_temp_db("sweep.db")
+    now = datetime.now()
+    active = now.isoformat()
+    stale = (now - timedelta(hours=2)).isoformat()
+    # 80% 的会话早已结束，19% 正在聊天，1% 刚超过 10 分钟未发消息（本轮需要标记）
+    n_stale = max(1, n_users // 100)
+    print(f"生成 {n_users} 个用户（本轮需标记 {n_stale} 个）...")
+
+    def rows():
+        for user_id in range(n_users):
+            if user_id < n_stale:
+                yield user_id, stale, None
+            elif user_id % 5 == 0:
+                yield user_id, active, None
+            else:
+                yield user_id, stale, stale
+
+    conn = database.get_connection()
+    with conn:
+        conn.executemany('INSERT INTO users (user_id, last_message_time, last_chat_end_time) VALUES (?, ?, ?)', rows())
+
+    def reopen() -> None:
+        with conn:
+            conn.execute('UPDATE users SET last_chat_end_time = NULL WHERE user_id < ?', (n_stale,))
+
+    def legacy_sweep() -> None:
+        # 旧实现：datetime() 包裹列无法使用索引，每个用户单独连接、读取再更新
+        c = sqlite3.connect(path)
+        inactive = [row[0] for row in c.execute('''
+            SELECT user_id FROM users
+            WHERE last_message_time IS NOT NULL
+            AND last_chat_end_time IS NULL
+            AND datetime(last_message_time) < datetime('now', '-10 minutes')
+        ''').fetchall()]
+        for user_id in inactive:
+            per_user = sqlite3.connect(path)
+            per_user.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchall()
+            with per_user:
+                per_user.execute('UPDATE users SET last_chat_end_time = ?, updated_at = ? WHERE user_id = ?',
+                                 (datetime.now().isoformat(), datetime.now().isoformat(), user_id))
+            per_user.close()
+        c.close()
+
+    def timed(sweep) -> float:
+        total = 0.0
+        for _ in range(repeat):
+            reopen()
+            total += _timeit(sweep, 1)
+        return total / repeat
+
+    before = timed(legacy_sweep)
+    before_idle = _timeit(legacy_sweep, repeat)
+    after = timed(lambda: database.close_inactive_chats(10))
+    after_idle = _timeit(lambda: database.close_inactive_chats(10), repeat)
+    plan = conn.execute('''EXPLAIN QUERY PLAN SELECT user_id FROM users
+        WHERE last_chat_end_time IS NULL AND last_message_time < ? LIMIT ?''', (active, 1000)).fetchall()
+
+    print("== 每分钟不活跃检查耗时 ==")
+    print(f"逐用户标记: {before:.1f} ms/轮（无需标记时 {before_idle:.1f} ms）")
+    print(f"批量 UPDATE + 部分索引: {after:.1f} ms/轮（无需标记时 {after_idle:.2f} ms）  (提升 {before / after:.0f}x)")
+    print(f"查询计划: {plan[0][-1]}")
+    database.close_connection()
+
+
+def bench_risk(n_users: int = int(os.getenv("BENCH_USERS", "100000")), repeat: int = 200) -> None:
+    """对比全表计算排序与风险分索引下的 top-N 查询"""
+    import random
+
+    _use_temp_db("risk.db")
+    rng = random.Random(7)
+    conn = database.get_connection()
+    with conn:
+        conn.executemany('INSERT INTO users (user_id, depression_score, anxiety_score) VALUES (?, ?, ?)',
+                         ((i, rng.uniform(0, 10), rng.uniform(0, 10)) for i in range(n_users)))
+    old_query = '''SELECT user_id, (depression_score + anxiety_score) as total_score FROM users
+        WHERE is_banned = 0 ORDER BY total_score DESC LIMIT ?'''
+    before = _timeit(lambda: conn.execute(old_query, (3,)).fetchall(), repeat // 10)
+    after = _timeit(lambda: database.get_worst_users(3), repeat)
+    page = _timeit(lambda: database.get_risk_review(50, min_score=12.0, cursor=(15.0, 0)), repeat)
+    plan = conn.execute('EXPLAIN QUERY PLAN SELECT user_id FROM users WHERE is_banned = 0 ORDER BY risk_score DESC, user_id LIMIT 3').fetchall()
+
+    print(f"== get_worst_users top-3 查询耗时（{n_users} 个用户）==")
+    print(f"全表计算并排序: {before:.3f} ms/次")
+    print(f"风险分索引: {after:.3f} ms/次  (提升 {before / after:.0f}x)")
+    print(f"风险复查翻页（50 条）: {page:.3f} ms/页")
+    print(f"查询计划: {plan[0][-1]}")
+    database.close_connection()
+
+
+BENCHMARKS = {
+    "connections": bench_connections,
+    "history": bench_history,
+    "keywords": bench_keywords,
+    "sweep": bench_inactivity_sweep,
+    "risk": bench_risk,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
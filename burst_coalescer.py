@@ -0,0 +1,122 @@
+# burst_coalescer.py
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from config import BURST_DEBOUNCE_SECONDS, BURST_MAX_DELAY
+
+logger = logging.getLogger(__name__)
+
+
+def merge_user_turns(history: list) -> list:
+    """把末尾连续的多条用户消息合并为一条，作为一轮对话交给模型"""
+    start = len(history)
+    while start > 0 and history[start - 1]["role"] == "user":
+        start -= 1
+    if len(history) - start < 2:
+        return history
+    merged = "\n".join(m["content"] for m in history[start:])
+    return history[:start] + [{"role": "user", "content": merged}]
+
+
+class Burst:
+    """一个聊天中尚未回复的连续消息"""
+
+    __slots__ = ('messages', 'flagged', 'first_at', 'task', 'generating')
+
+    def __init__(self):
+        self.messages = 0
+        # 任意一条消息需要模型做违规检查时为 True
+        self.flagged = False
+        self.first_at = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.generating = False
+
+
+class BurstCoalescer:
+    """合并同一聊天短时间内连续到达的消息，只生成一次回复
+
+    每条新消息都会重新计时；在 window 秒内没有新消息时才开始生成回复，
+    最迟在第一条消息后 max_delay 秒开始。生成过程中到达的新消息会取消正在进行的生成，
+    合并后重新回复。回复函数调用 release() 后，该次回复不再被取消。
+    """
+
+    def __init__(self, window: float, max_delay: float):
+        self.window = window
+        self.max_delay = max(window, max_delay)
+        self._bursts: Dict[int, Burst] = {}
+        self.messages = 0
+        self.replies = 0
+        self.coalesced = 0
+        self.cancelled_generations = 0
+
+    def add(self, chat_id: int, reply: Callable[[int, Burst], Awaitable[None]], flagged: bool = False) -> Burst:
+        """登记一条消息，并（重新）安排该聊天的回复"""
+        self.messages += 1
+        burst = self._bursts.get(chat_id)
+        if burst is None:
+            burst = self._bursts[chat_id] = Burst()
+        else:
+            self.coalesced += 1
+        if burst.task is not None:
+            if burst.generating:
+                self.cancelled_generations += 1
+                logger.info(f"用户 {chat_id} 发来新消息，取消正在生成的回复")
+            burst.task.cancel()
+        burst.messages += 1
+        burst.flagged = burst.flagged or flagged
+        burst.generating = False
+        delay = min(self.window, max(0.0, burst.first_at + self.max_delay - time.monotonic()))
+        burst.task = asyncio.create_task(self._run(chat_id, burst, delay, reply))
+        return burst
+
+    def release(self, chat_id: int, burst: Burst) -> None:
+        """回复已生成：之后的新消息开始新的一轮，不再取消本次回复"""
+        if self._bursts.get(chat_id) is burst:
+            del self._bursts[chat_id]
+
+    def cancel(self, chat_id: int) -> bool:
+        """放弃该聊天尚未完成的回复（如危机消息需要立即处理），返回是否有被取消的回复"""
+        burst = self._bursts.pop(chat_id, None)
+        if burst is None or burst.task is None:
+            return False
+        burst.task.cancel()
+        return True
+
+    async def _run(self, chat_id: int, burst: Burst, delay: float, reply: Callable[[int, Burst], Awaitable[None]]) -> None:
+        await asyncio.sleep(delay)
+        burst.generating = True
+        if burst.messages > 1:
+            logger.info(f"合并用户 {chat_id} 的 {burst.messages} 条连续消息生成一次回复")
+        try:
+            await reply(chat_id, burst)
+            self.replies += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"合并回复失败 (用户 {chat_id}): {e}")
+        finally:
+            # 被新消息取消时 burst 已交给新的任务，不能在这里移除
+            if burst.task is asyncio.current_task():
+                self.release(chat_id, burst)
+
+    async def stop(self) -> None:
+        """取消所有等待中的回复"""
+        tasks = [burst.task for burst in self._bursts.values() if burst.task is not None]
+        self._bursts.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'pending_chats': len(self._bursts),
+            'messages': self.messages,
+            'replies': self.replies,
+            'coalesced': self.coalesced,
+            'cancelled_generations': self.cancelled_generations,
+        }
+
+
+burst_coalescer = BurstCoalescer(BURST_DEBOUNCE_SECONDS, BURST_MAX_DELAY)
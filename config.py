@@ -8,15 +8,135 @@ load_dotenv()
 # --- Telegram 配置 ---
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+# --- Webhook 模式 ---
+# 设置 WEBHOOK_URL（Telegram 可访问的 https 地址，不含路径）时改用 webhook 接收更新，否则使用长轮询
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # 校验请求头 X-Telegram-Bot-Api-Secret-Token，webhook 模式下必须设置
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")  # 本地监听地址，通常由反向代理终止 TLS 后转发
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_MAX_PENDING = 256  # 已确认但尚未处理完的更新数上限，超出时返回 503 让 Telegram 稍后重发
+WEBHOOK_MAX_BODY = 1024 * 1024  # 单个请求体的最大字节数
+WEBHOOK_MAX_CONNECTIONS = 40  # 告知 Telegram 同时建立的最大连接数
+
 # --- OpenRouter AI 配置 ---
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 AI_MODEL = "z-ai/glm-4.5-air:free" 
 AI_TEMPERATURE = 0.6  
+# 按优先级排列的模型列表：AI_MODEL 为首选，AI_FALLBACK_MODELS（逗号分隔）为备选
+AI_MODELS = [AI_MODEL] + [m.strip() for m in os.getenv("AI_FALLBACK_MODELS", "").split(",") if m.strip()]
+
+# --- 对冲请求与熔断 ---
+AI_LATENCY_EWMA_ALPHA = 0.2  # 模型延迟 EWMA 的平滑系数
+AI_HEDGE_DEFAULT_DELAY = 8.0  # 延迟样本不足时，首选模型多少秒无响应后向备选模型发出对冲请求
+AI_HEDGE_MIN_DELAY = 2.0  # 对冲延迟取首选模型 p95 延迟，并限制在此范围内
+AI_HEDGE_MAX_DELAY = 15.0
+AI_CIRCUIT_FAILURES = 3  # 连续失败多少次后熔断该模型
+AI_CIRCUIT_COOLDOWN = 60.0  # 熔断持续时间（秒）
+
+# --- OpenRouter 连接池配置 ---
+OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+AI_MAX_CONNECTIONS = int(os.getenv("AI_MAX_CONNECTIONS", "50"))  # 连接池上限
+AI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("AI_MAX_KEEPALIVE_CONNECTIONS", "20"))  # 保持长连接的数量
+AI_KEEPALIVE_EXPIRY = 30.0  # 空闲长连接保留时间（秒）
+AI_CONNECT_TIMEOUT = 10.0  # 建立连接超时（秒）
+AI_READ_TIMEOUT = 60.0  # 两次读取之间的超时（秒），流式响应按 chunk 计算
+AI_WRITE_TIMEOUT = 10.0
+AI_POOL_TIMEOUT = 30.0  # 等待连接池空闲连接的超时（秒）
+
+# --- 模型调用准入控制 ---
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "20"))  # 同时进行的模型调用上限
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "0"))  # 每秒最多发起的模型调用数，0 表示不限速
+ADMISSION_BURST = 10  # 令牌桶容量，允许的瞬时突发调用数
+# 各优先级最多排队多少秒，超时后放弃并快速回复；None 表示一直等待
+ADMISSION_DEADLINES = {"crisis": None, "normal": 8.0, "background": 5.0}
+
+# --- 并发处理 ---
+# 同时处理的更新数；大于 1 时不同聊天并行，同一聊天仍按顺序处理。默认 1，即逐条处理
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+
+# --- 多进程分片 ---
+# 大于 1 时主进程只接收更新，按 chat_id 一致性哈希转发给这么多个工作进程；1 表示单进程运行
+# 模型调用准入的并发上限和速率由各分片均分，合计不超过 ADMISSION_* 的配置；CONCURRENT_UPDATES 仍按进程生效
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8100"))  # 分片 i 在本机 SHARD_BASE_PORT + i 端口接收转发
+SHARD_QUEUE_MAX = 1000  # 每个分片等待转发的更新数上限，满时向入口施加背压
+SHARD_VNODES = 64  # 一致性哈希环上每个分片的虚拟节点数
+SHARD_HEALTH_INTERVAL = 10.0  # 健康检查（心跳）间隔（秒）
+SHARD_HEALTH_FAILURES = 3  # 进程存活但连续多少次健康检查失败后重启
+SHARD_STOP_TIMEOUT = 30.0  # 等待分片处理完已接收的更新并退出的时间（秒）
+SHARD_PARENT_CHECK_INTERVAL = 1.0  # 分片进程检查 supervisor 是否仍在运行的间隔（秒），supervisor 退出后分片随之退出
+# 分片进程等待 SQLite 写锁的超时（秒）。数据库调用在事件循环中同步执行，多进程争用写锁时
+# 每次调用最多让事件循环停顿这么久（单进程为 DB_BUSY_TIMEOUT），超时的写入报 database is locked
+SHARD_DB_BUSY_TIMEOUT = 0.5
+
+# --- 连续消息合并 ---
+# 同一聊天在该时间（秒）内连续发来的消息合并为一次回复；0 表示关闭，每条消息单独回复
+BURST_DEBOUNCE_SECONDS = float(os.getenv("BURST_DEBOUNCE_SECONDS", "0"))
+BURST_MAX_DELAY = 8.0  # 持续发消息时，最迟在第一条消息后多少秒开始回复
+
+# --- 流式回复 ---
+# off: 等待完整回复后一次发送；edit: 先发送第一句，再原地编辑追加；split: 每句话单独发送一条消息
+STREAM_REPLY_MODE = os.getenv("STREAM_REPLY_MODE", "off")
+STREAM_EDIT_INTERVAL = 1.5  # 同一条消息两次编辑的最小间隔（秒），避免触发 Telegram 编辑频率限制
+
+# --- 数据库配置 ---
+DB_BUSY_TIMEOUT = 5.0  # 等待写锁的超时（秒）
+DB_MMAP_SIZE = 64 * 1024 * 1024  # 内存映射读取的大小（字节），0 表示关闭
+DB_STATEMENT_CACHE_SIZE = 128  # 每个连接缓存的预编译语句数量
+
+# --- 聊天记录文件 ---
+CHAT_LOG_DIR = "chat_logs"
+CHAT_LOG_FLUSH_INTERVAL = 1.0  # 最长间隔多少秒把缓冲写入文件
+CHAT_LOG_FLUSH_LINES = 256  # 累积多少行后立即刷新
+CHAT_LOG_MAX_OPEN_FILES = 128  # 同时保持打开的日志文件数（LRU）
+CHAT_LOG_FSYNC_INTERVAL = float(os.getenv("CHAT_LOG_FSYNC_INTERVAL", "0"))  # 每隔多少秒 fsync，0 表示不主动 fsync
+
+# --- 心理状态评估 ---
+ASSESSMENT_QUEUE_MAX = 1000  # 等待评估的用户数上限，超出时丢弃新请求
+ASSESSMENT_BATCH_SIZE = int(os.getenv("ASSESSMENT_BATCH_SIZE", "1"))  # 合并到一次模型调用中的用户数，1 表示不合并
+ASSESSMENT_TIMEOUT = 20.0  # 单次评估调用的超时（秒）
+ASSESSMENT_EWMA_ALPHA = float(os.getenv("ASSESSMENT_EWMA_ALPHA", "0.4"))  # 新评分的权重，其余沿用上次的分数
+ASSESSMENT_MIN_CHARS = 20  # 上次评估以来用户新说的字数少于该值时跳过评估，留到下次累积
+ASSESSMENT_MAX_MESSAGES = 20  # 单次评估最多发送的新消息条数（取最近的）
 
 # --- 会话管理 ---
 MAX_HISTORY_LENGTH = 10  
 
+# --- 对话摘要 ---
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))  # 系统提示、摘要和最近消息合计的 token 上限（本地估算）
+SUMMARY_EVERY_TURNS = 10  # 最近窗口之外积累了这么多轮未摘要的对话后，在后台更新摘要
+SUMMARY_MAX_MESSAGES = 60  # 单次摘要最多合并的消息数
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_TIMEOUT = 30.0  # 单次摘要调用的超时（秒）
+
+# --- 历史消息缓存 ---
+HISTORY_CACHE_TURNS = MAX_HISTORY_LENGTH * 2  # 每个用户缓存的最近消息条数（环形缓冲容量）
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "10000"))  # 最多缓存的用户数
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 缓存内容总大小上限（字节）
+
+# --- 定时任务 ---
+JOB_JITTER_RATIO = 0.1  # 每次运行时间的随机抖动，占执行间隔的比例
+JOB_MAX_JITTER = 60.0  # 随机抖动上限（秒）
+
+# --- 会话结束检测 ---
+INACTIVE_CHAT_MINUTES = 10  # 超过该时间（分钟）没有新消息视为会话结束
+INACTIVE_SWEEP_BATCH = 1000  # 每个事务最多标记的会话数
+
+# --- 主动问候 ---
+OUTREACH_CONCURRENCY = 8  # 同时进行的发送请求数
+OUTREACH_RATE = 25.0  # 全局每秒最多发送条数（Telegram 限制约 30 条/秒）
+OUTREACH_CHAT_INTERVAL = 1.0  # 同一聊天两条消息的最小间隔（秒）
+OUTREACH_MAX_RETRIES = 3  # 遇到 RetryAfter 时的最大重试次数
+OUTREACH_PAGE_SIZE = 500  # 每次从数据库读取的收件人数
+
+# --- 使用限制 ---
+DAILY_CHAT_LIMIT = 100  # 每人每天最多聊天次数
+QUOTA_TIMEZONE = os.getenv("QUOTA_TIMEZONE")  # 每日次数按该时区（如 Asia/Shanghai）的日期重置，未设置时使用服务器本地时间
+WARNING_BAN_THRESHOLD = 3  # 违规警告达到该次数后拉黑
+
 # --- 心理危机处理协议 ---
+CRISIS_REPLY_DEADLINE = 3.0  # 危机模式下模型超过该时间（秒）未回复时，先发送预置的支持性消息
 CRISIS_KEYWORDS = [
     "想死", "自杀", "自残", "了结", "结束一切", "没希望了", "撑不住了",
     "伤害自己", "割腕", "吃药", "跳楼", "上吊", "活不下去", "不想活了",
@@ -30,9 +150,36 @@ VIOLATION_KEYWORDS = [
     # 邪教相关 (避免宗教)
     "邪教", "洗脑", "邪门歪道", "非法组织", "极端主义",
     # 色情相关 (避免艺术/生理)
-    "色情", "裸体", "性交", "性虐", "成人内容", "黄片"
+    "色情", "裸体", "性交", "性虐", "成人内容", "黄片",
+    # 政治敏感 (只触发模型复核，不在本地直接判定)
+    "颠覆政权", "分裂国家", "政变", "反动言论", "暴乱", "煽动",
+    # 其他违法内容
+    "毒品", "冰毒", "贩毒", "赌博", "网赌", "洗钱",
 ]
 
+# --- 本地违规预筛 ---
+# 命中关键词的权重之和 >= VIOLATION_BLOCK_SCORE 时直接判定违规，不再调用模型；
+# 命中但分数不足时交给模型判断；未命中时不附加违规检查指令。
+# 因此只有 VIOLATION_KEYWORDS 覆盖到的类别会经过模型检查，需要模型把关的类别必须在其中列出关键词。
+VIOLATION_KEYWORD_WEIGHTS = {
+    "恐怖主义": 2.0, "枪击": 1.5, "伤害他人": 1.5,
+    "邪门歪道": 0.5, "洗脑": 0.5, "虐待": 0.5, "打死": 0.5, "爆炸": 0.5,
+    "性虐": 2.0, "成人内容": 2.0, "黄片": 2.0, "裸体": 0.5,
+    "颠覆政权": 0.5, "分裂国家": 0.5, "政变": 0.5, "反动言论": 0.5, "暴乱": 0.5, "煽动": 0.5,
+    "毒品": 0.5, "赌博": 0.5, "洗钱": 0.5, "贩毒": 1.5, "冰毒": 1.0, "网赌": 1.0,
+}
+VIOLATION_DEFAULT_WEIGHT = 1.0  # 未在上表中列出的违规关键词的权重
+VIOLATION_BLOCK_SCORE = 2.0
+# 情绪宣泄、转述等语境词，每命中一个扣减 VIOLATION_CONTEXT_DISCOUNT 分
+VIOLATION_CONTEXT_TERMS = [
+    "气得", "气死", "恨不得", "好像", "梦到", "梦见", "电影", "电视剧", "小说", "新闻", "游戏", "以前", "小时候",
+]
+VIOLATION_CONTEXT_DISCOUNT = 1.0
+
+# 关键词热更新：指定 JSON 文件 {"crisis": [...], "violation": [...]} 后，修改文件即可生效
+KEYWORDS_FILE = os.getenv("KEYWORDS_FILE")
+KEYWORDS_RELOAD_INTERVAL = 5.0  # 检查关键词文件是否变化的间隔（秒）
+
 # 外部危机资源（请替换为本地化、经过验证的资源）
 CRISIS_RESOURCES = """
 🆘 <b>请立即寻求专业帮助，你不是一个人在战斗：</b>
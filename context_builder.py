@@ -0,0 +1,137 @@
+# context_builder.py
+import asyncio
+import logging
+import re
+import time
+from typing import Dict
+
+from admission import AdmissionRejected, BACKGROUND
+from ai_handler import get_ai_response
+from assessment_worker import format_history
+from background_worker import BackgroundWorker
+from config import (
+    MAX_HISTORY_LENGTH, PROMPT_TOKEN_BUDGET, SUMMARY_EVERY_TURNS, SUMMARY_MAX_MESSAGES, SUMMARY_MAX_TOKENS,
+    SUMMARY_TIMEOUT,
+)
+from database import get_summary, save_summary, get_unsummarized_messages
+from metrics import LatencyStats
+from prompts import SUMMARY_PROMPT, SUMMARY_CONTEXT_TEMPLATE
+
+logger = logging.getLogger(__name__)
+
+# 中日韩文字、全角符号：大多数分词器下约 1 个 token 一个字
+_CJK = re.compile(r'[⺀-鿿가-힯豈-﫿＀-￯]')
+# 每条消息的角色标记等固定开销
+_MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """本地粗略估算 token 数：CJK 字符按 1 个，其余字符按 4 个一 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_messages(messages: list) -> int:
+    return sum(estimate_tokens(m['content']) + _MESSAGE_OVERHEAD for m in messages)
+
+
+def build_context(user_id: int, history: list, system_prompt: str, budget: int = PROMPT_TOKEN_BUDGET,
+                  keep_recent: int = MAX_HISTORY_LENGTH * 2, max_gap: int = SUMMARY_EVERY_TURNS * 2) -> tuple:
+    """在系统提示后附加对话摘要，并按 token 预算从最新的消息往前保留，返回 (system_prompt, history)
+
+    history 是最近 keep_recent 条消息。已经离开最近窗口、但还没积累到下一次摘要的消息
+    （最多 max_gap 条）补在 history 之前，不会在摘要前丢失。最后一条消息总会保留，即使单独就超出预算。
+    """
+    summary = get_summary(user_id)
+    if summary:
+        system_prompt += SUMMARY_CONTEXT_TEMPLATE.format(summary=summary[0])
+    gap = get_unsummarized_messages(user_id, summary[1] if summary else 0, keep_recent, max_gap, latest=True)
+    history = [{'role': role, 'content': content} for _, role, content in gap] + history
+    before = estimate_tokens(system_prompt) + estimate_messages(history)
+    used = estimate_tokens(system_prompt)
+    kept = []
+    for message in reversed(history):
+        cost = estimate_tokens(message['content']) + _MESSAGE_OVERHEAD
+        if kept and used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    logger.info(f"提示词 token 估算 (用户 {user_id}): {before} -> {used}"
+                f"（{'含摘要, ' if summary else ''}保留 {len(kept)}/{len(history)} 条消息）")
+    return system_prompt, kept
+
+
+class SummaryWorker(BackgroundWorker):
+    """后台滚动摘要
+
+    最近 keep_recent 条消息原样发送给模型；更早且尚未摘要的消息积累到 min_messages 条后，
+    与已有摘要合并成新的摘要。同一用户的多次请求只处理一次。
+    """
+
+    def __init__(self, keep_recent: int, min_messages: int, max_messages: int, timeout: float):
+        super().__init__()
+        self.keep_recent = keep_recent
+        self.min_messages = min_messages
+        self.max_messages = max(min_messages, max_messages)
+        self.timeout = timeout
+        self.summarized = 0
+        self.skipped = 0
+        self.call_time = LatencyStats()
+
+    def submit(self, user_id: int) -> None:
+        """请求检查该用户是否需要更新摘要"""
+        self._enqueue(user_id)
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'queue_depth': len(self._pending),
+            'summarized': self.summarized,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'call_time': self.call_time.snapshot(),
+        }
+
+    async def _process_next(self) -> None:
+        user_id, _ = self._pending.popitem(last=False)
+        await self.summarize(user_id)
+
+    async def summarize(self, user_id: int) -> bool:
+        """积累的消息足够时更新摘要，返回是否更新"""
+        current = get_summary(user_id)
+        summary, after_id = current if current else ("（无）", 0)
+        rows = get_unsummarized_messages(user_id, after_id, self.keep_recent, self.max_messages)
+        if len(rows) < self.min_messages:
+            self.skipped += 1
+            return False
+        conversation = format_history([{'role': role, 'content': content} for _, role, content in rows])
+        prompt = SUMMARY_PROMPT.format(summary=summary, conversation=conversation)
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                get_ai_response([{"role": "system", "content": prompt}], max_tokens=SUMMARY_MAX_TOKENS, lane=BACKGROUND),
+                timeout=self.timeout)
+        except AdmissionRejected:
+            # 繁忙时跳过，下一轮对话后会再次提交
+            self.skipped += 1
+            return False
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"对话摘要失败 (用户 {user_id}): {e}")
+            return False
+        finally:
+            self.call_time.record(time.monotonic() - started)
+        if not response or not response.strip():
+            self.failed += 1
+            logger.warning(f"对话摘要为空 (用户 {user_id})")
+            return False
+        save_summary(user_id, response.strip(), rows[-1][0])
+        self.summarized += 1
+        logger.info(f"更新对话摘要 (用户 {user_id}): 合并 {len(rows)} 条消息，"
+                    f"约 {estimate_tokens(conversation)} -> {estimate_tokens(response)} tokens")
+        return True
+
+
+summary_worker = SummaryWorker(MAX_HISTORY_LENGTH * 2, SUMMARY_EVERY_TURNS * 2, SUMMARY_MAX_MESSAGES, SUMMARY_TIMEOUT)
@@ -1,201 +1,611 @@
 import sqlite3
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, List
+from zoneinfo import ZoneInfo
+from config import (
+    DB_BUSY_TIMEOUT, DB_MMAP_SIZE, DB_STATEMENT_CACHE_SIZE,
+    HISTORY_CACHE_TURNS, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_BYTES,
+    DAILY_CHAT_LIMIT, WARNING_BAN_THRESHOLD, QUOTA_TIMEZONE,
+)
+from log_writer import chat_log_writer
 
 DB_PATH = 'database.db'
 
+# 每日次数的日期边界；None 表示服务器本地时间
+_QUOTA_TZ = ZoneInfo(QUOTA_TIMEZONE) if QUOTA_TIMEZONE else None
+
+# 每个线程持有一个长连接（事件循环线程、调度器线程各自独立）
+_local = threading.local()
+# 等待写锁的超时（秒），分片进程中调低
+_busy_timeout = DB_BUSY_TIMEOUT
+
+def set_busy_timeout(seconds: float) -> None:
+    """修改等待写锁的超时：之后新建的连接使用新值，当前线程已有的连接立即生效"""
+    global _busy_timeout
+    _busy_timeout = seconds
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.execute(f'PRAGMA busy_timeout={int(seconds * 1000)}')
+
+def get_connection() -> sqlite3.Connection:
+    """获取当前线程的数据库长连接，首次使用时创建并设置 PRAGMA"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == DB_PATH:
+        return conn
+    if conn is not None:
+        # DB_PATH 被修改（如测试或基准），关闭旧连接并丢弃属于旧库的缓存
+        conn.close()
+        history_cache.clear()
+    conn = sqlite3.connect(DB_PATH, timeout=_busy_timeout, cached_statements=DB_STATEMENT_CACHE_SIZE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA mmap_size={int(DB_MMAP_SIZE)}')
+    _local.conn = conn
+    _local.path = DB_PATH
+    return conn
+
+def close_connection() -> None:
+    """关闭当前线程的数据库连接"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+        _local.path = None
+
+class HistoryCache:
+    """按 user_id 缓存最近消息的环形缓冲，按 LRU 淘汰并限制总内存"""
+
+    def __init__(self, turns: int, max_users: int, max_bytes: int):
+        self.turns = turns
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        # user_id -> [消息环形缓冲, 是否包含该用户全部消息, 占用字节数]
+        self._entries: "OrderedDict[int, list]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(content: str) -> int:
+        return len(content.encode('utf-8')) + 64  # 64 字节近似每条消息的对象开销
+
+    def get(self, user_id: int, limit: int) -> Optional[list]:
+        """命中时返回最近 limit 条消息，否则返回 None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or (len(entry[0]) < limit and not entry[1]):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            ring = entry[0]
+            start = max(len(ring) - limit, 0)
+            return [{'role': ring[i][0], 'content': ring[i][1]} for i in range(start, len(ring))]
+
+    def fill(self, user_id: int, messages: list, complete: bool) -> None:
+        """用数据库读取的结果填充缓存，complete 表示已包含该用户全部消息"""
+        with self._lock:
+            self._drop(user_id)
+            ring = deque(((m['role'], m['content']) for m in messages[-self.turns:]), maxlen=self.turns)
+            size = sum(self._size(content) for _, content in ring)
+            self._entries[user_id] = [ring, complete and len(messages) <= self.turns, size]
+            self._bytes += size
+            self._evict()
+
+    def append(self, user_id: int, role: str, content: str) -> None:
+        """写入新消息；未缓存的用户直接跳过，下次读取时从数据库加载"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            ring = entry[0]
+            if len(ring) == ring.maxlen:
+                # 环形缓冲已满，最旧的一条被挤出
+                removed = self._size(ring[0][1])
+                entry[1] = False
+                entry[2] -= removed
+                self._bytes -= removed
+            ring.append((role, content))
+            size = self._size(content)
+            entry[2] += size
+            self._bytes += size
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._drop(user_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'users': len(self._entries), 'bytes': self._bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _drop(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_users or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[2]
+            self.evictions += 1
+
+history_cache = HistoryCache(HISTORY_CACHE_TURNS, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_BYTES)
+
+def invalidate_history_cache(user_id: int) -> None:
+    """使用户的历史缓存失效（如 /reset 时）"""
+    history_cache.invalidate(user_id)
+
+# 结构迁移：按顺序执行，PRAGMA user_version 记录已应用的版本号。
+# 只能在末尾追加新版本，已发布的版本不可修改。
+MIGRATIONS = [
+    # 1: 按用户倒序读取历史消息的复合索引（id 与插入顺序一致，替代 timestamp 排序）
+    [
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_id_id ON messages (user_id, id)',
+    ],
+    # 2: 不活跃检查只扫描尚未结束的会话（部分索引，已结束的会话不占索引空间）
+    [
+        'CREATE INDEX IF NOT EXISTS idx_users_open_chats ON users (last_message_time) WHERE last_chat_end_time IS NULL',
+    ],
+    # 3: 记录主动问候的发送时间，同一次会话只问候一次
+    [
+        'ALTER TABLE users ADD COLUMN last_followup_at TEXT',
+        'ALTER TABLE users ADD COLUMN last_checkin_at TEXT',
+    ],
+    # 4: 综合风险分作为虚拟生成列并建索引，按风险排序的查询不再全表排序
+    [
+        'ALTER TABLE users ADD COLUMN risk_score REAL GENERATED ALWAYS AS (depression_score + anxiety_score) VIRTUAL',
+        'ALTER TABLE users ADD COLUMN risk_updated_at TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_users_risk ON users (risk_score DESC, user_id) WHERE is_banned = 0',
+        'CREATE INDEX IF NOT EXISTS idx_users_risk_updated ON users (risk_updated_at) WHERE is_banned = 0',
+    ],
+    # 5: 每日次数按日期记录，新的一天第一次发消息时自动归零，不再需要零点全表重置
+    [
+        'ALTER TABLE users ADD COLUMN quota_day TEXT',
+    ],
+    # 6: 每个用户一份滚动摘要，覆盖 id <= last_message_id 的消息
+    [
+        '''CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at TEXT
+        )''',
+    ],
+    # 7: 增量心理评估：记录已评估到的消息 id，并保存每次评估的分数序列
+    [
+        'ALTER TABLE users ADD COLUMN last_assessed_message_id INTEGER',
+        '''CREATE TABLE IF NOT EXISTS mental_score_history (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            depression_score REAL NOT NULL,
+            anxiety_score REAL NOT NULL,
+            raw_depression REAL NOT NULL,
+            raw_anxiety REAL NOT NULL,
+            message_count INTEGER NOT NULL,
+            assessed_at TEXT NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_score_history_user_id ON mental_score_history (user_id, id)',
+    ],
+]
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """把数据库结构升级到最新版本，对已有的 database.db 安全"""
+    for target, statements in enumerate(MIGRATIONS, start=1):
+        with conn:
+            # IMMEDIATE 事务避免多个进程同时迁移
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= target:
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f'PRAGMA user_version = {target}')
+
 def init_db():
     """初始化数据库和表结构"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # 用户表
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            daily_chat_count INTEGER DEFAULT 0,
-            warning_count INTEGER DEFAULT 0,
-            depression_score REAL DEFAULT 0,
-            anxiety_score REAL DEFAULT 0,
-            is_in_crisis INTEGER DEFAULT 0,
-            last_active_time TEXT,
-            is_banned INTEGER DEFAULT 0,
-            last_chat_end_time TEXT,
-            last_message_time TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 消息历史表（用于存储聊天记录，便于评估）
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            role TEXT,
-            content TEXT,
-            timestamp TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        # 用户表
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                daily_chat_count INTEGER DEFAULT 0,
+                warning_count INTEGER DEFAULT 0,
+                depression_score REAL DEFAULT 0,
+                anxiety_score REAL DEFAULT 0,
+                is_in_crisis INTEGER DEFAULT 0,
+                last_active_time TEXT,
+                is_banned INTEGER DEFAULT 0,
+                last_chat_end_time TEXT,
+                last_message_time TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # 消息历史表（用于存储聊天记录，便于评估）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                role TEXT,
+                content TEXT,
+                timestamp TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+    _migrate(conn)
+
+# users 表中可读写的字段，顺序与 UserState 的默认值一致
+USER_FIELDS = (
+    'daily_chat_count', 'warning_count', 'depression_score', 'anxiety_score', 'is_in_crisis',
+    'last_active_time', 'is_banned', 'last_chat_end_time', 'last_message_time', 'risk_updated_at',
+)
+_USER_DEFAULTS = (0, 0, 0.0, 0.0, False, None, False, None, None, None)
+_BOOL_FIELDS = frozenset(('is_in_crisis', 'is_banned'))
+_SELECT_USER = f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE user_id = ?"
+
+class UserState:
+    """一次更新内使用的用户状态：加载一次，记录修改过的字段，处理结束时一次写回"""
+
+    __slots__ = ('user_id', 'is_new', '_dirty') + USER_FIELDS
+
+    def __init__(self, user_id: int, row: Optional[tuple] = None):
+        object.__setattr__(self, 'user_id', user_id)
+        object.__setattr__(self, 'is_new', row is None)
+        object.__setattr__(self, '_dirty', set())
+        for field, value in zip(USER_FIELDS, row or _USER_DEFAULTS):
+            if field in _BOOL_FIELDS:
+                value = bool(value)
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name in USER_FIELDS:
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    def refresh(self, **values: Any) -> None:
+        """同步数据库中已写入的值，不标记为待写回"""
+        for field, value in values.items():
+            object.__setattr__(self, field, bool(value) if field in _BOOL_FIELDS else value)
+
+    @property
+    def dirty(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self._dirty}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'user_id': self.user_id, **{field: getattr(self, field) for field in USER_FIELDS}}
+
+def load_user_state(user_id: int) -> UserState:
+    """读取用户状态，用户不存在时返回默认状态（在写回时创建）"""
+    row = get_connection().execute(_SELECT_USER, (user_id,)).fetchone()
+    state = UserState(user_id, row)
+    if state.is_new:
+        now = datetime.now().isoformat()
+        state.last_active_time = now
+        state.last_message_time = now
+    return state
+
+def save_user_state(state: UserState) -> None:
+    """把修改过的字段一次 UPSERT 写回数据库"""
+    if state.is_new or state._dirty:
+        _upsert_user(state.user_id, state.dirty)
+        state._dirty.clear()
+        object.__setattr__(state, 'is_new', False)
+
+def _upsert_user(user_id: int, values: Dict[str, Any]) -> None:
+    """插入新用户或只更新给定字段"""
+    now = datetime.now().isoformat()
+    values = {key: value for key, value in values.items() if key in USER_FIELDS}
+    # 新用户插入时补齐活跃时间，已存在的用户只更新给定字段
+    inserted = {'last_active_time': now, 'last_message_time': now, **values}
+    columns = ', '.join(inserted)
+    placeholders = ', '.join('?' * len(inserted))
+    if values:
+        conflict = 'DO UPDATE SET ' + ', '.join(f'{key} = excluded.{key}' for key in values) + ', updated_at = excluded.updated_at'
+    else:
+        conflict = 'DO NOTHING'
+    conn = get_connection()
+    with conn:
+        conn.execute(f'''
+            INSERT INTO users (user_id, {columns}, updated_at) VALUES (?, {placeholders}, ?)
+            ON CONFLICT(user_id) {conflict}
+        ''', (user_id, *inserted.values(), now))
 
 def get_user(user_id: int) -> Optional[Dict[str, Any]]:
     """获取用户数据"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    row = c.fetchone()
-    conn.close()
+    row = get_connection().execute(_SELECT_USER, (user_id,)).fetchone()
     if row:
-        return {
-            'user_id': row[0],
-            'daily_chat_count': row[1],
-            'warning_count': row[2],
-            'depression_score': row[3],
-            'anxiety_score': row[4],
-            'is_in_crisis': bool(row[5]),
-            'last_active_time': row[6],
-            'is_banned': bool(row[7]),
-            'last_chat_end_time': row[8],
-            'last_message_time': row[9]
-        }
+        return UserState(user_id, row).to_dict()
     return None
 
 def create_or_update_user(user_id: int, **kwargs) -> None:
     """创建或更新用户数据"""
-    user = get_user(user_id)
-    now = datetime.now().isoformat()
-    
-    if user is None:
-        # 新用户
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO users (user_id, is_in_crisis, last_active_time, last_message_time, updated_at)
-            VALUES (?, 0, ?, ?, ?)
-        ''', (user_id, now, now, now))
-        conn.commit()
-        conn.close()
-    else:
-        # 更新现有用户
-        updates = []
-        values = []
-        for key, value in kwargs.items():
-            if key in ['depression_score', 'anxiety_score', 'daily_chat_count', 'warning_count', 'is_banned', 'is_in_crisis']:
-                updates.append(f"{key} = ?")
-                values.append(value)
-            elif key in ['last_active_time', 'last_chat_end_time', 'last_message_time']:
-                updates.append(f"{key} = ?")
-                values.append(value)
-        if updates:
-            values.append(user_id)
-            values.append(now)
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute(f'''
-                UPDATE users SET {', '.join(updates)}, updated_at = ?
-                WHERE user_id = ?
-            ''', values)
-            conn.commit()
-            conn.close()
+    _upsert_user(user_id, kwargs)
+
+def quota_day() -> str:
+    """每日次数所属的日期；设置了 QUOTA_TIMEZONE 时按该时区划分日期，否则按服务器本地时间"""
+    return datetime.now(_QUOTA_TZ).date().isoformat()
 
 def increment_daily_chat(user_id: int) -> bool:
-    """增加每日聊天次数，返回是否超过限制"""
-    user = get_user(user_id)
-    if user and user['is_banned']:
+    """增加每日聊天次数，返回是否仍在限制内（已拉黑的用户不计数，返回 False）"""
+    now = datetime.now().isoformat()
+    conn = get_connection()
+    with conn:
+        # 单条语句完成读-改-写，并发更新时计数依然准确；日期变化时从 1 重新计数
+        row = conn.execute('''
+            INSERT INTO users (user_id, daily_chat_count, quota_day, last_active_time, last_message_time, updated_at)
+            VALUES (?, 1, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                daily_chat_count = CASE WHEN quota_day IS excluded.quota_day THEN daily_chat_count + 1 ELSE 1 END,
+                quota_day = excluded.quota_day,
+                updated_at = excluded.updated_at
+            WHERE is_banned = 0
+            RETURNING daily_chat_count
+        ''', (user_id, quota_day(), now, now, now)).fetchone()
+    if row is None:
         return False  # 已拉黑，不允许
-    new_count = (user['daily_chat_count'] + 1 if user else 1)
-    create_or_update_user(user_id, daily_chat_count=new_count)
-    return new_count <= 100
+    return row[0] <= DAILY_CHAT_LIMIT
 
 def reset_daily_chat(user_id: int) -> None:
     """重置每日聊天次数（每日0点）"""
     create_or_update_user(user_id, daily_chat_count=0)
 
 def add_warning(user_id: int) -> int:
-    """添加警告，返回警告次数"""
-    user = get_user(user_id)
-    new_count = (user['warning_count'] + 1 if user else 1)
-    is_banned = new_count >= 3
-    create_or_update_user(user_id, warning_count=new_count, is_banned=is_banned)
-    return new_count
+    """添加警告，返回警告次数；是否拉黑在 SQL 中按阈值判断"""
+    now = datetime.now().isoformat()
+    conn = get_connection()
+    with conn:
+        row = conn.execute('''
+            INSERT INTO users (user_id, warning_count, is_banned, last_active_time, last_message_time, updated_at)
+            VALUES (?, 1, 1 >= ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                warning_count = warning_count + 1,
+                is_banned = MAX(is_banned, warning_count + 1 >= ?),
+                updated_at = excluded.updated_at
+            RETURNING warning_count
+        ''', (user_id, WARNING_BAN_THRESHOLD, now, now, now, WARNING_BAN_THRESHOLD)).fetchone()
+    return row[0]
 
 def update_mental_scores(user_id: int, depression: float, anxiety: float) -> None:
     """更新心理分数"""
-    create_or_update_user(user_id, depression_score=depression, anxiety_score=anxiety, last_active_time=datetime.now().isoformat())
+    now = datetime.now().isoformat()
+    create_or_update_user(user_id, depression_score=depression, anxiety_score=anxiety, last_active_time=now, risk_updated_at=now)
+
+def get_assessment_state(user_id: int) -> Optional[tuple]:
+    """返回 (抑郁分数, 焦虑分数, 已评估到的消息 id)；从未评估过时 id 为 None，用户不存在时返回 None"""
+    return get_connection().execute(
+        'SELECT depression_score, anxiety_score, last_assessed_message_id FROM users WHERE user_id = ?',
+        (user_id,)).fetchone()
+
+def get_messages_after(user_id: int, after_id: Optional[int], limit: int) -> list:
+    """返回 id > after_id 的最近 limit 条消息 (id, role, content)，按时间顺序"""
+    rows = get_connection().execute('''
+        SELECT id, role, content FROM messages
+        WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT ?
+    ''', (user_id, after_id or 0, limit)).fetchall()
+    rows.reverse()
+    return rows
+
+def record_assessment(user_id: int, depression: float, anxiety: float, raw_depression: float, raw_anxiety: float,
+                      last_message_id: int, message_count: int) -> None:
+    """写入一次增量评估：更新当前分数和评估进度，并追加到分数序列"""
+    now = datetime.now().isoformat()
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            UPDATE users SET depression_score = ?, anxiety_score = ?, risk_updated_at = ?, last_active_time = ?,
+                last_assessed_message_id = MAX(COALESCE(last_assessed_message_id, 0), ?), updated_at = ?
+            WHERE user_id = ?
+        ''', (depression, anxiety, now, now, last_message_id, now, user_id))
+        conn.execute('''
+            INSERT INTO mental_score_history
+                (user_id, depression_score, anxiety_score, raw_depression, raw_anxiety, message_count, assessed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, depression, anxiety, raw_depression, raw_anxiety, message_count, now))
+
+def get_score_history(user_id: int, limit: int = 30) -> list:
+    """返回用户最近 limit 次评估的 (评估时间, 抑郁, 焦虑)，按时间顺序"""
+    rows = get_connection().execute('''
+        SELECT assessed_at, depression_score, anxiety_score FROM mental_score_history
+        WHERE user_id = ? ORDER BY id DESC LIMIT ?
+    ''', (user_id, limit)).fetchall()
+    rows.reverse()
+    return rows
 
 def save_message(user_id: int, role: str, content: str) -> None:
     """保存消息到数据库"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO messages (user_id, role, content, timestamp)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, role, content, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            INSERT INTO messages (user_id, role, content, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, role, content, datetime.now().isoformat()))
+    history_cache.append(user_id, role, content)
 
 def get_user_history(user_id: int, limit: int = 20) -> list:
-    """获取用户最近历史消息"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        SELECT role, content, timestamp FROM messages
-        WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?
-    ''', (user_id, limit))
-    rows = c.fetchall()
-    conn.close()
-    return [{'role': row[0], 'content': row[1]} for row in reversed(rows)]  # 逆序恢复时间线
+    """获取用户最近历史消息，优先从内存缓存读取"""
+    cached = history_cache.get(user_id, limit)
+    if cached is not None:
+        return cached
+    # 未命中时一次读满环形缓冲的容量；走 (user_id, id) 索引倒序扫描，无需排序
+    fetch = max(limit, history_cache.turns)
+    rows = get_connection().execute('''
+        SELECT role, content FROM messages
+        WHERE user_id = ? ORDER BY id DESC LIMIT ?
+    ''', (user_id, fetch)).fetchall()
+    messages = [{'role': row[0], 'content': row[1]} for row in reversed(rows)]  # 逆序恢复时间线
+    history_cache.fill(user_id, messages, complete=len(rows) < fetch)
+    return messages[-limit:] if limit > 0 else []
+
+def get_summary(user_id: int) -> Optional[tuple]:
+    """返回用户的对话摘要 (summary, last_message_id)，没有时返回 None"""
+    return get_connection().execute(
+        'SELECT summary, last_message_id FROM conversation_summaries WHERE user_id = ?', (user_id,)).fetchone()
+
+def save_summary(user_id: int, summary: str, last_message_id: int) -> None:
+    """保存用户的对话摘要"""
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            INSERT INTO conversation_summaries (user_id, summary, last_message_id, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                summary = excluded.summary, last_message_id = excluded.last_message_id, updated_at = excluded.updated_at
+        ''', (user_id, summary, last_message_id, datetime.now().isoformat()))
+
+def get_unsummarized_messages(user_id: int, after_id: int, keep_recent: int, limit: int, latest: bool = False) -> list:
+    """返回 id > after_id、且不在最近 keep_recent 条之内的消息 (id, role, content)，按时间顺序
+
+    默认取最早的 limit 条（用于摘要）；latest=True 时取紧挨最近窗口的 limit 条（用于补进上下文）。
+    """
+    rows = get_connection().execute(f'''
+        SELECT id, role, content FROM messages
+        WHERE user_id = ? AND id > ? AND id < (
+            SELECT MIN(id) FROM (SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?)
+        )
+        ORDER BY id {'DESC' if latest else ''} LIMIT ?
+    ''', (user_id, after_id, user_id, keep_recent, limit)).fetchall()
+    if latest:
+        rows.reverse()
+    return rows
 
 def get_worst_users(limit: int = 3) -> list:
     """获取心理状态最差的用户（基于综合分数）"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        SELECT user_id, (depression_score + anxiety_score) as total_score
-        FROM users
+    rows = get_connection().execute('''
+        SELECT user_id, risk_score FROM users
         WHERE is_banned = 0
-        ORDER BY total_score DESC LIMIT ?
-    ''', (limit,))
-    rows = c.fetchall()
-    conn.close()
+        ORDER BY risk_score DESC, user_id LIMIT ?
+    ''', (limit,)).fetchall()
     return [{'user_id': row[0], 'total_score': row[1]} for row in rows]
 
 def update_chat_end_time(user_id: int) -> None:
     """更新聊天结束时间"""
     create_or_update_user(user_id, last_chat_end_time=datetime.now().isoformat())
 
+def close_inactive_chats(minutes: int = 10, batch_size: int = 1000) -> int:
+    """把超过 minutes 分钟没有新消息的会话标记为结束，返回标记的数量
+
+    按批更新，每批一个短事务，不会长时间阻塞消息写入。
+    """
+    now = datetime.now()
+    cutoff = (now - timedelta(minutes=minutes)).isoformat()
+    conn = get_connection()
+    total = 0
+    while True:
+        with conn:
+            # last_message_time 与 cutoff 同为 isoformat 字符串，可直接比较并使用部分索引
+            cursor = conn.execute('''
+                UPDATE users SET last_chat_end_time = ?, updated_at = ?
+                WHERE user_id IN (
+                    SELECT user_id FROM users
+                    WHERE last_chat_end_time IS NULL AND last_message_time < ?
+                    LIMIT ?
+                )
+            ''', (now.isoformat(), now.isoformat(), cutoff, batch_size))
+        total += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            return total
+
 def get_inactive_users(hours: int = 3) -> list:
     """获取聊天结束3小时后的用户，用于发送问候"""
     cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
+    rows = get_connection().execute('''
         SELECT user_id FROM users
         WHERE last_chat_end_time < ? AND is_banned = 0
-    ''', (cutoff,))
-    rows = c.fetchall()
-    conn.close()
+    ''', (cutoff,)).fetchall()
     return [row[0] for row in rows]
 
+def iter_followup_recipients(hours: int = 3, page_size: int = 500) -> Iterator[List[int]]:
+    """分页返回会话结束超过 hours 小时、且本次会话尚未跟进问候的用户
+
+    按 user_id 游标分页，每页一次索引查询，不会一次把所有用户读入内存。
+    """
+    cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
+    after = -2 ** 63  # 小于任何 Telegram chat_id
+    while True:
+        rows = get_connection().execute('''
+            SELECT user_id FROM users
+            WHERE user_id > ? AND last_chat_end_time < ? AND is_banned = 0
+            AND (last_followup_at IS NULL OR last_followup_at < last_chat_end_time)
+            ORDER BY user_id LIMIT ?
+        ''', (after, cutoff, page_size)).fetchall()
+        if not rows:
+            return
+        yield [row[0] for row in rows]
+        after = rows[-1][0]
+
+def get_checkin_recipients(limit: int = 3) -> list:
+    """心理状态最差、且在最近一次发消息之后还没有收到关心问候的用户"""
+    rows = get_connection().execute('''
+        SELECT user_id FROM users
+        WHERE is_banned = 0 AND (last_checkin_at IS NULL OR last_checkin_at < last_message_time)
+        ORDER BY risk_score DESC, user_id LIMIT ?
+    ''', (limit,)).fetchall()
+    return [row[0] for row in rows]
+
+_RISK_REVIEW_FIELDS = ('user_id', 'risk_score', 'depression_score', 'anxiety_score', 'is_in_crisis',
+                       'risk_updated_at', 'last_message_time')
+
+def get_risk_review(limit: int = 50, min_score: Optional[float] = None, changed_since: Optional[str] = None,
+                    cursor: Optional[tuple] = None) -> tuple:
+    """按风险分从高到低分页返回用户，返回 (rows, next_cursor)
+
+    min_score 只返回风险分不低于该值的用户；changed_since（isoformat）只返回此后分数有更新的用户。
+    cursor 为上一页返回的 (risk_score, user_id)，没有下一页时 next_cursor 为 None。
+    每页是一次索引范围扫描，与用户总数无关。
+    """
+    conditions = ['is_banned = 0']
+    params: list = []
+    if min_score is not None:
+        conditions.append('risk_score >= ?')
+        params.append(min_score)
+    if changed_since is not None:
+        conditions.append('risk_updated_at >= ?')
+        params.append(changed_since)
+    if cursor is not None:
+        # 单独的 risk_score <= ? 让索引直接定位到游标处，而不是从头扫描
+        conditions.append('risk_score <= ? AND (risk_score < ? OR user_id > ?)')
+        params.extend((cursor[0], cursor[0], cursor[1]))
+    rows = get_connection().execute(f'''
+        SELECT {', '.join(_RISK_REVIEW_FIELDS)} FROM users
+        WHERE {' AND '.join(conditions)}
+        ORDER BY risk_score DESC, user_id LIMIT ?
+    ''', (*params, limit)).fetchall()
+    result = [dict(zip(_RISK_REVIEW_FIELDS, row)) for row in rows]
+    for item in result:
+        item['is_in_crisis'] = bool(item['is_in_crisis'])
+    next_cursor = (rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+    return result, next_cursor
+
+_OUTREACH_COLUMNS = {'followup': 'last_followup_at', 'checkin': 'last_checkin_at'}
+
+def mark_outreach_sent(kind: str, user_ids: List[int]) -> None:
+    """记录问候已送达（kind 为 followup 或 checkin）"""
+    column = _OUTREACH_COLUMNS[kind]
+    now = datetime.now().isoformat()
+    conn = get_connection()
+    with conn:
+        conn.executemany(f'UPDATE users SET {column} = ? WHERE user_id = ?', [(now, user_id) for user_id in user_ids])
+
 # 每日重置函数（可定时调用）
 def reset_all_daily_chats():
-    """每日重置所有用户的聊天次数"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET daily_chat_count = 0')
-    conn.commit()
-    conn.close()
+    """重置所有用户的聊天次数（每日次数已按日期自动归零，仅供手动维护使用）"""
+    conn = get_connection()
+    with conn:
+        conn.execute('UPDATE users SET daily_chat_count = 0')
 
 def append_chat_log(user_id: int, role: str, content: str) -> None:
-    """追加聊天记录到txt文件"""
-    import os
-    # 确保 chat_logs 目录存在
-    os.makedirs("chat_logs", exist_ok=True)
-    log_file = f"chat_logs/{user_id}.txt"
+    """追加聊天记录到txt文件（由后台写入器批量写入）"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(log_file, 'a', encoding='utf-8') as f:
-        f.write(f"[{timestamp}] {role}: {content}\n")
\ No newline at end of file
+    chat_log_writer.write(user_id, f"[{timestamp}] {role}: {content}\n")
@@ -0,0 +1,57 @@
+# jobs.py
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+def jitter_for(interval: float, ratio: float, limit: float) -> float:
+    """按执行间隔计算随机抖动上限，避免多个任务总在同一时刻触发"""
+    return min(interval * ratio, limit)
+
+
+class GuardedJob:
+    """定时任务包装：上一次运行尚未结束时跳过本次，并记录运行耗时
+
+    作为 JobQueue 回调使用，func 接收 PTB 的 CallbackContext。
+    """
+
+    def __init__(self, name: str, func: Callable[[Any], Awaitable[None]]):
+        self.name = name
+        self.func = func
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.failed = 0
+        self.duration = LatencyStats(window=256)
+
+    async def __call__(self, context: Any) -> None:
+        if self.running:
+            self.skipped += 1
+            logger.warning(f"定时任务 {self.name} 上一次仍在运行，跳过本次")
+            return
+        self.running = True
+        started = time.monotonic()
+        try:
+            await self.func(context)
+            self.runs += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"定时任务 {self.name} 失败: {e}")
+        finally:
+            self.running = False
+            elapsed = time.monotonic() - started
+            self.duration.record(elapsed)
+            logger.info(f"定时任务 {self.name} 完成，耗时 {elapsed:.2f}s")
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'duration': self.duration.snapshot(),
+        }
+
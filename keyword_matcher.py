@@ -0,0 +1,161 @@
+# keyword_matcher.py
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from config import CRISIS_KEYWORDS, VIOLATION_KEYWORDS, VIOLATION_CONTEXT_TERMS, KEYWORDS_FILE, KEYWORDS_RELOAD_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class KeywordMatch(NamedTuple):
+    category: str
+    keyword: str
+    start: int
+    end: int
+
+
+class KeywordMatcher:
+    """Aho-Corasick 多模式匹配：一次扫描文本，返回所有类别命中的关键词及位置"""
+
+    def __init__(self, keywords: Dict[str, Iterable[str]]):
+        self.keywords = {category: sorted(set(words)) for category, words in keywords.items()}
+        self._goto: List[dict] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[tuple] = [()]
+        for category, words in self.keywords.items():
+            for word in words:
+                if word:
+                    self._add(category, word)
+        self._build_failure_links()
+        # 处于根状态时用正则跳到下一个可能的关键词首字符，空闲片段的扫描在 C 中完成
+        first_chars = sorted(self._goto[0])
+        self._next_start = re.compile('[' + ''.join(re.escape(c) for c in first_chars) + ']') if first_chars else None
+
+    def _add(self, category: str, word: str) -> None:
+        state = 0
+        for ch in word:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+                nxt = len(self._goto) - 1
+                self._goto[state][ch] = nxt
+            state = nxt
+        self._out[state] += ((category, word),)
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def _scan(self, text: str, category: Optional[str], first_only: bool) -> List[KeywordMatch]:
+        matches: List[KeywordMatch] = []
+        if not text or self._next_start is None:
+            return matches
+        goto, fail, out = self._goto, self._fail, self._out
+        search = self._next_start.search
+        state = 0
+        i = 0
+        n = len(text)
+        while i < n:
+            if state == 0:
+                m = search(text, i)
+                if m is None:
+                    break
+                i = m.start()
+            ch = text[i]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                for cat, word in out[state]:
+                    if category is None or cat == category:
+                        matches.append(KeywordMatch(cat, word, i + 1 - len(word), i + 1))
+                        if first_only:
+                            return matches
+            i += 1
+        return matches
+
+    def find_all(self, text: Optional[str], category: Optional[str] = None) -> List[KeywordMatch]:
+        """返回所有命中（可按类别过滤），按结束位置排序"""
+        return self._scan(text or "", category, first_only=False)
+
+    def first(self, text: Optional[str], category: Optional[str] = None) -> Optional[KeywordMatch]:
+        """返回第一个命中，找到即停止扫描"""
+        matches = self._scan(text or "", category, first_only=True)
+        return matches[0] if matches else None
+
+    def contains(self, text: Optional[str], category: Optional[str] = None) -> bool:
+        return self.first(text, category) is not None
+
+
+def _default_keywords() -> Dict[str, List[str]]:
+    return {
+        "crisis": list(CRISIS_KEYWORDS),
+        "violation": list(VIOLATION_KEYWORDS),
+        "violation_context": list(VIOLATION_CONTEXT_TERMS),
+    }
+
+
+_matcher = KeywordMatcher(_default_keywords())
+_lock = threading.Lock()
+_file_mtime: Optional[float] = None
+_last_check = float('-inf')
+
+
+def reload_keywords(keywords: Optional[Dict[str, Iterable[str]]] = None) -> KeywordMatcher:
+    """用新的关键词表重建匹配器并原子替换；未给出的类别沿用 config 中的列表"""
+    global _matcher
+    merged = _default_keywords()
+    if keywords:
+        merged.update({category: list(words) for category, words in keywords.items()})
+    matcher = KeywordMatcher(merged)
+    _matcher = matcher
+    logger.info("关键词匹配器已重建: " + ", ".join(f"{c}={len(w)}" for c, w in matcher.keywords.items()))
+    return matcher
+
+
+def _maybe_reload_file() -> None:
+    """KEYWORDS_FILE 被修改后自动重新加载（每 KEYWORDS_RELOAD_INTERVAL 秒最多检查一次）"""
+    global _file_mtime, _last_check
+    now = time.monotonic()
+    if now - _last_check < KEYWORDS_RELOAD_INTERVAL:
+        return
+    with _lock:
+        if now - _last_check < KEYWORDS_RELOAD_INTERVAL:
+            return
+        _last_check = now
+        try:
+            mtime = os.stat(KEYWORDS_FILE).st_mtime
+        except OSError:
+            return
+        if mtime == _file_mtime:
+            return
+        # 加载失败时也记录 mtime，等文件再次修改后重试，避免反复报错
+        _file_mtime = mtime
+        try:
+            with open(KEYWORDS_FILE, encoding='utf-8') as f:
+                reload_keywords(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.error(f"加载关键词文件失败 ({KEYWORDS_FILE}): {e}")
+
+
+def get_matcher() -> KeywordMatcher:
+    """获取当前的关键词匹配器"""
+    if KEYWORDS_FILE:
+        _maybe_reload_file()
+    return _matcher
@@ -0,0 +1,168 @@
+# log_writer.py
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import (
+    CHAT_LOG_DIR, CHAT_LOG_FLUSH_INTERVAL, CHAT_LOG_FLUSH_LINES,
+    CHAT_LOG_MAX_OPEN_FILES, CHAT_LOG_FSYNC_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ChatLogWriter:
+    """聊天记录后台写入器
+
+    处理函数只把日志行放入队列；写线程批量追加到 {log_dir}/{user_id}.txt，
+    对打开的文件句柄做 LRU 缓存，按时间或行数阈值刷新到磁盘。
+    fsync_interval > 0 时每隔该秒数 fsync 一次，0 表示只交给操作系统落盘。
+    """
+
+    def __init__(self, log_dir: str, flush_interval: float, flush_lines: int,
+                 max_open_files: int, fsync_interval: float):
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.max_open_files = max_open_files
+        self.fsync_interval = fsync_interval
+        self._queue: queue.Queue = queue.Queue()
+        self._files: "OrderedDict[int, object]" = OrderedDict()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._pending_lines = 0
+        self._last_flush = time.monotonic()
+        self._last_fsync = time.monotonic()
+        self.lines_written = 0
+        self.flushes = 0
+
+    def write(self, user_id: int, line: str) -> None:
+        """把一行日志加入队列，不阻塞调用方"""
+        self._ensure_started()
+        self._queue.put((user_id, line))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待此前入队的日志全部写入并刷新，返回是否在超时前完成"""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        """写完剩余日志并关闭所有文件（关闭时调用）"""
+        with self._start_lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._queue.put(_STOP)
+            thread.join()
+            self._thread = None
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                os.makedirs(self.log_dir, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="chat-log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            timeout = max(self.flush_interval - (time.monotonic() - self._last_flush), 0.01)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            # 一次取出队列中已有的所有条目，合并写入
+            items = [] if item is None else [item]
+            while len(items) < self.flush_lines:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for entry in items:
+                if entry is _STOP:
+                    self._flush(force_fsync=True)
+                    self._close_all()
+                    return
+                if isinstance(entry, threading.Event):
+                    self._flush()
+                    entry.set()
+                    continue
+                self._append(*entry)
+            if self._pending_lines >= self.flush_lines or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def _append(self, user_id: int, line: str) -> None:
+        try:
+            f = self._files.get(user_id)
+            if f is None:
+                f = open(os.path.join(self.log_dir, f"{user_id}.txt"), 'a', encoding='utf-8')
+                self._files[user_id] = f
+                if len(self._files) > self.max_open_files:
+                    _, oldest = self._files.popitem(last=False)
+                    self._close_file(oldest)
+            else:
+                self._files.move_to_end(user_id)
+            f.write(line)
+            self._pending_lines += 1
+            self.lines_written += 1
+        except OSError as e:
+            logger.error(f"写入聊天记录失败 (用户 {user_id}): {e}")
+
+    def _flush(self, force_fsync: bool = False) -> None:
+        if self._pending_lines:
+            do_fsync = self.fsync_interval > 0 and (
+                force_fsync or time.monotonic() - self._last_fsync >= self.fsync_interval)
+            for f in self._files.values():
+                try:
+                    f.flush()
+                    if do_fsync:
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    logger.error(f"刷新聊天记录失败: {e}")
+            if do_fsync:
+                self._last_fsync = time.monotonic()
+            self._pending_lines = 0
+            self.flushes += 1
+        self._last_flush = time.monotonic()
+
+    def _close_file(self, f) -> None:
+        try:
+            f.flush()
+            if self.fsync_interval > 0:
+                os.fsync(f.fileno())
+            f.close()
+        except OSError as e:
+            logger.error(f"关闭聊天记录文件失败: {e}")
+
+    def _close_all(self) -> None:
+        while self._files:
+            _, f = self._files.popitem(last=False)
+            self._close_file(f)
+
+
+chat_log_writer = ChatLogWriter(
+    CHAT_LOG_DIR, CHAT_LOG_FLUSH_INTERVAL, CHAT_LOG_FLUSH_LINES,
+    CHAT_LOG_MAX_OPEN_FILES, CHAT_LOG_FSYNC_INTERVAL,
+)
+atexit.register(chat_log_writer.close)
+
+
+def flush_chat_logs(timeout: Optional[float] = None) -> bool:
+    """等待已入队的聊天记录写入磁盘"""
+    return chat_log_writer.flush(timeout)
+
+
+def close_chat_logs() -> None:
+    """写完剩余聊天记录并关闭文件"""
+    chat_log_writer.close()
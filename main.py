@@ -1,25 +1,37 @@
 # main.py
 import logging
 from telegram import Update
-from typing import Optional
+from typing import Callable, Optional
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import TimedOut, NetworkError
+from telegram.error import TimedOut, NetworkError, BadRequest, RetryAfter
 from telegram.constants import ParseMode
 
-import threading
+import random
 import time
 
-from config import TELEGRAM_TOKEN, OPENROUTER_API_KEY, AI_MODEL, CRISIS_KEYWORDS, MAX_HISTORY_LENGTH, CRISIS_RESOURCES
-from prompts import WELCOME_MESSAGE, HELP_MESSAGE, RESET_MESSAGE, API_ERROR_MESSAGE, CRISIS_STEP_1_MESSAGE, CRISIS_SYSTEM_PROMPT, SYSTEM_PROMPT
-from ai_handler import get_ai_response
-from database import init_db, get_user, create_or_update_user, increment_daily_chat, add_warning, update_mental_scores, save_message, get_user_history, append_chat_log, update_chat_end_time, get_inactive_users, get_worst_users, reset_all_daily_chats
-from prompts import VIOLATION_CHECK_PROMPT, MENTAL_ASSESSMENT_PROMPT
-from config import VIOLATION_KEYWORDS
+from config import TELEGRAM_TOKEN, OPENROUTER_API_KEY, AI_MODELS, MAX_HISTORY_LENGTH, CRISIS_RESOURCES, STREAM_REPLY_MODE, STREAM_EDIT_INTERVAL, DAILY_CHAT_LIMIT, JOB_JITTER_RATIO, JOB_MAX_JITTER, INACTIVE_CHAT_MINUTES, INACTIVE_SWEEP_BATCH, OUTREACH_PAGE_SIZE, CONCURRENT_UPDATES, BURST_DEBOUNCE_SECONDS, CRISIS_REPLY_DEADLINE, SHARD_WORKERS, SHARD_DB_BUSY_TIMEOUT
+from config import WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_MAX_PENDING, WEBHOOK_MAX_BODY, WEBHOOK_MAX_CONNECTIONS
+from prompts import WELCOME_MESSAGE, HELP_MESSAGE, RESET_MESSAGE, API_ERROR_MESSAGE, OVERLOAD_MESSAGE, CRISIS_STEP_1_MESSAGE, CRISIS_FALLBACK_MESSAGES, CRISIS_SYSTEM_PROMPT, SYSTEM_PROMPT
+from ai_handler import get_ai_response, get_ai_stream, close_ai_client
+from admission import admission, AdmissionRejected, CRISIS, NORMAL
+from model_router import model_router
+from metrics import LatencyStats
+from jobs import GuardedJob, jitter_for
+from outreach import outreach_engine
+from log_writer import close_chat_logs
+from assessment_worker import assessment_worker
+from context_builder import build_context, summary_worker
+from keyword_matcher import get_matcher
+from violation_screen import screen_message, VIOLATION, AMBIGUOUS
+from update_processor import ChatOrderedUpdateProcessor
+from webhook_server import WebhookServer
+from burst_coalescer import burst_coalescer, merge_user_turns, Burst
+from database import init_db, get_user, create_or_update_user, load_user_state, save_user_state, UserState, increment_daily_chat, add_warning, save_message, get_user_history, invalidate_history_cache, append_chat_log, close_inactive_chats, iter_followup_recipients, get_checkin_recipients, mark_outreach_sent, history_cache, set_busy_timeout
+from prompts import VIOLATION_CHECK_PROMPT, VIOLATION_WARNING_MESSAGE, VIOLATION_CHECK_INSTRUCTION, CRISIS_VIOLATION_CHECK_INSTRUCTION
 from datetime import datetime, timedelta
-import schedule
-import time as time_module
-import sqlite3
 import asyncio
+import os
+import signal
 
 
 # 配置日志
@@ -49,20 +61,44 @@ init_db()
 
 # 全局变量
 application = None
+# 多进程模式下只有一个分片运行定时任务
+run_scheduled_jobs = True
+
+# 危机模式回复延迟：首条回复（含预置消息）和模型回复分别统计
+crisis_first_reply_latency = LatencyStats()
+crisis_model_latency = LatencyStats()
+crisis_fallbacks = 0
 
 async def safe_send_message(bot, chat_id: int, text: str, parse_mode=None):
-    """安全发送消息，捕获网络错误"""
+    """安全发送消息，捕获网络错误，成功时返回发送的消息"""
     try:
-        await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
     except (TimedOut, NetworkError) as e:
         logger.warning(f"发送消息失败到 {chat_id}: {e}")
         # 尝试不带 parse_mode 重发
         try:
-            await bot.send_message(chat_id=chat_id, text=text)
+            return await bot.send_message(chat_id=chat_id, text=text)
         except Exception as e2:
             logger.error(f"备用发送也失败: {e2}")
     except Exception as e:
         logger.error(f"发送消息异常: {e}")
+    return None
+
+async def safe_edit_message(bot, chat_id: int, message_id: int, text: str) -> bool:
+    """安全编辑消息，返回是否成功"""
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+        return True
+    except BadRequest as e:
+        # 内容未变化时 Telegram 也会返回 BadRequest，视为成功
+        if "not modified" in str(e).lower():
+            return True
+        logger.warning(f"编辑消息失败 ({chat_id}): {e}")
+    except RetryAfter as e:
+        logger.warning(f"编辑消息触发频率限制 ({chat_id})，需等待 {e.retry_after} 秒")
+    except Exception as e:
+        logger.error(f"编辑消息异常: {e}")
+    return False
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理 Telegram API 错误，特别是网络超时"""
@@ -77,72 +113,86 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 def check_inactive_users():
     """每分钟检查不活跃用户，10min无消息标记结束"""
-    now = datetime.now()
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute('''
-        SELECT user_id FROM users
-        WHERE last_message_time IS NOT NULL
-        AND last_chat_end_time IS NULL
-        AND datetime(last_message_time) < datetime('now', '-10 minutes')
-    ''')
-    inactive = [row[0] for row in c.fetchall()]
-    for user_id in inactive:
-        update_chat_end_time(user_id)
-    conn.close()
-
-async def send_followup_greetings():
-    """每小时发送跟进问候给3小时前结束聊天的用户"""
-    global application
-    if not application:
+    closed = close_inactive_chats(INACTIVE_CHAT_MINUTES, INACTIVE_SWEEP_BATCH)
+    if closed:
+        logger.info(f"标记 {closed} 个不活跃会话结束")
+
+async def send_followup_greetings(bot):
+    """每小时发送跟进问候给3小时前结束聊天的用户，每次会话只问候一次"""
+    await outreach_engine.run(bot, "followup", iter_followup_recipients(3, OUTREACH_PAGE_SIZE),
+                              "好点了吗？如果需要，我在这里听着。",
+                              lambda user_ids: mark_outreach_sent('followup', user_ids))
+
+async def send_worst_users_greetings(bot):
+    """发送问候给心理状态最差的3人，用户再次发消息之前不重复问候"""
+    await outreach_engine.run(bot, "checkin", [get_checkin_recipients(3)],
+                              "最近怎么样？如果感觉不太好，记得寻求支持哦。",
+                              lambda user_ids: mark_outreach_sent('checkin', user_ids))
+
+# 定时任务在应用自身的事件循环上运行；数据库操作放到线程中，不阻塞消息处理
+scheduled_jobs = [
+    GuardedJob("check_inactive_users", lambda context: asyncio.to_thread(check_inactive_users)),
+    GuardedJob("send_followup_greetings", lambda context: send_followup_greetings(context.bot)),
+    GuardedJob("send_worst_users_greetings", lambda context: send_worst_users_greetings(context.bot)),
+]
+
+def schedule_jobs(application: Application) -> None:
+    """在 JobQueue 中注册定时任务"""
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.error('JobQueue 不可用，定时任务未启动（需要安装 "python-telegram-bot[job-queue]"）')
         return
-    inactive_users = get_inactive_users(3)
-    for user_id in inactive_users:
-        try:
-            await application.bot.send_message(
-                chat_id=user_id,
-                text="好点了吗？如果需要，我在这里听着。"
-            )
-        except Exception:
-            pass  # 发送失败忽略
+    check_inactive, followup, worst = scheduled_jobs
+    for job, interval in ((check_inactive, 60), (followup, 3600), (worst, 3600)):
+        jitter = jitter_for(interval, JOB_JITTER_RATIO, JOB_MAX_JITTER)
+        job_queue.run_repeating(job, interval=interval, name=job.name,
+                                job_kwargs={'jitter': jitter, 'coalesce': True})
+
+async def post_init(application: Application) -> None:
+    """在应用的事件循环上启动后台任务"""
+    assessment_worker.start()
+    summary_worker.start()
+    if run_scheduled_jobs:
+        schedule_jobs(application)
+
+async def post_shutdown(application: Application) -> None:
+    """应用关闭时释放共享资源"""
+    logger.info("定时任务统计: " + ", ".join(f"{job.name}={job.metrics()}" for job in scheduled_jobs))
+    await burst_coalescer.stop()
+    logger.info(f"连续消息合并统计: {burst_coalescer.metrics()}")
+    await assessment_worker.stop()
+    logger.info(f"心理评估队列统计: {assessment_worker.metrics()}")
+    await summary_worker.stop()
+    logger.info(f"对话摘要统计: {summary_worker.metrics()}")
+    logger.info(f"模型调用准入统计: {admission.metrics()}")
+    logger.info(f"模型路由统计: {model_router.metrics()}")
+    logger.info(f"危机回复延迟: 首条 {crisis_first_reply_latency.snapshot()}, 模型 {crisis_model_latency.snapshot()}, 预置消息 {crisis_fallbacks} 次")
+    await close_ai_client()
+    await asyncio.to_thread(close_chat_logs)
+
+def _build_application() -> Application:
+    """创建 Application 并注册处理器"""
+    from telegram.request import HTTPXRequest
 
-async def send_worst_users_greetings():
-    """每天发送问候给心理状态最差的3人"""
-    global application
-    if not application:
-        return
-    worst = get_worst_users(3)
-    for w in worst:
-        try:
-            await application.bot.send_message(
-                chat_id=w['user_id'],
-                text="最近怎么样？如果感觉不太好，记得寻求支持哦。"
-            )
-        except Exception:
-            pass  # 发送失败忽略
-
-def daily_reset():
-    """每天重置聊天次数"""
-    reset_all_daily_chats()
-
-def run_scheduler():
-    """运行调度器"""
-    def run_async_task(coro):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            loop.run_until_complete(coro)
-        finally:
-            loop.close()
- 
-    schedule.every(1).minutes.do(check_inactive_users)
-    schedule.every(1).hours.do(lambda: run_async_task(send_followup_greetings()))
-    schedule.every(1).hours.do(lambda: run_async_task(send_worst_users_greetings()))
-    schedule.every().day.at("00:00").do(daily_reset)
-    
-    while True:
-        schedule.run_pending()
-        time_module.sleep(1)
+    request = HTTPXRequest(
+        connect_timeout=60.0,
+        read_timeout=60.0,
+        pool_timeout=120.0,
+        write_timeout=60.0
+    )
+    builder = Application.builder().token(TELEGRAM_TOKEN).request(request).post_init(post_init).post_shutdown(post_shutdown)
+    if CONCURRENT_UPDATES > 1:
+        # 不同聊天并发处理，同一聊天按顺序处理
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+        logger.info(f"并发处理模式: 最多同时处理 {CONCURRENT_UPDATES} 条更新")
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("reset", reset_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_error_handler(error_handler)
+    logger.info("错误处理器已注册")
+    return app
 
 def _init_and_start_bot():
     """初始化并启动 Bot"""
@@ -150,39 +200,187 @@ def _init_and_start_bot():
     if not TELEGRAM_TOKEN:
         logger.error("错误：未设置 TELEGRAM_BOT_TOKEN 环境变量。")
         return
-    from telegram.request import HTTPXRequest
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("错误：webhook 模式需要设置 WEBHOOK_SECRET 环境变量。")
+        return
+
+    if SHARD_WORKERS > 1:
+        # 多进程模式：本进程只接收和分发更新，机器人运行在各个分片进程中
+        from shards import run_supervisor
+        logger.info(f"多进程模式启动: {SHARD_WORKERS} 个分片")
+        try:
+            run_supervisor()
+        except KeyboardInterrupt:
+            pass
+        logger.info("机器人已停止运行")
+        return
 
     if application is None:
-        request = HTTPXRequest(
-            connect_timeout=60.0,
-            read_timeout=60.0,
-            pool_timeout=120.0,
-            write_timeout=60.0
-        )
-        application = Application.builder().token(TELEGRAM_TOKEN).request(request).build()
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("reset", reset_command))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        application.add_error_handler(error_handler)
-        logger.info("错误处理器已注册")
-    
+        application = _build_application()
+
     logger.info("机器人启动成功！")
     logger.info("使用 /help 测试命令，或发送消息测试响应。")
     try:
-        application.run_polling()  # type: ignore
+        if WEBHOOK_URL:
+            asyncio.run(_run_webhook(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET))
+        else:
+            application.run_polling()  # type: ignore
     except KeyboardInterrupt:
         logger.info("收到退出信号，正在停止机器人...")
         if application:
             application.stop_running()
         logger.info("机器人已停止运行")
 
+async def _run_webhook(app: Application, listen: str, port: int, secret: str, register: bool = True,
+                       health: Optional[Callable[[], dict]] = None,
+                       stop_signals: tuple = (signal.SIGINT, signal.SIGTERM)) -> None:
+    """webhook 模式：本地 HTTP 服务确认收到更新后立即返回，再交给更新处理器处理
+
+    register=False 时不向 Telegram 注册 webhook（分片进程只接收 supervisor 转发的更新）。
+    """
+    async def process(data: dict) -> None:
+        update = Update.de_json(data, app.bot)
+        await app.update_processor.process_update(update, app.process_update(update))
+
+    server = WebhookServer(process, secret, WEBHOOK_PATH, WEBHOOK_MAX_PENDING, WEBHOOK_MAX_BODY, health=health)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in stop_signals:
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except NotImplementedError:
+            pass  # Windows 不支持，依靠 KeyboardInterrupt 退出
+
+    # 与 run_polling 相同的生命周期：initialize -> post_init -> start ... stop -> shutdown -> post_shutdown
+    await app.initialize()
+    try:
+        await post_init(app)
+        await app.start()
+        await server.start(listen, port)
+        if register:
+            await app.bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=secret,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+            logger.info(f"Webhook 模式: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        await stopping.wait()
+        logger.info("收到退出信号，正在停止机器人...")
+    finally:
+        # 不删除 webhook：重启期间的更新由 Telegram 暂存并重发
+        await server.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await post_shutdown(app)
+
+def run_shard_worker(shard: int, workers: int, port: int, secret: str, run_jobs: bool) -> None:
+    """分片进程入口：在本机端口接收 supervisor 转发的更新；定时任务只在 run_jobs 的分片运行
+
+    模型调用准入的上限由 workers 个分片均分，等待数据库写锁的超时缩短为 SHARD_DB_BUSY_TIMEOUT。
+    """
+    global application, run_scheduled_jobs
+    # 退出由 supervisor 通过 SIGTERM 控制，终端的 Ctrl+C 不直接中断分片
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    formatter = logging.Formatter(f'%(asctime)s - shard{shard} - %(name)s - %(levelname)s - %(message)s')
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(formatter)
+    run_scheduled_jobs = run_jobs
+    admission.share(workers)
+    # 多个分片争用同一个数据库的写锁：缩短等待，避免同步的数据库调用长时间卡住事件循环
+    set_busy_timeout(SHARD_DB_BUSY_TIMEOUT)
+    application = _build_application()
+    started = time.monotonic()
+
+    def health() -> dict:
+        processor = application.update_processor
+        return {
+            'shard': shard,
+            'pid': os.getpid(),
+            'uptime': round(time.monotonic() - started, 1),
+            'jobs': run_jobs,
+            'update_processor': processor.metrics() if isinstance(processor, ChatOrderedUpdateProcessor) else None,
+            'history_cache': history_cache.stats(),
+            'admission': admission.metrics(),
+        }
+
+    asyncio.run(_run_webhook(application, "127.0.0.1", port, secret, register=False, health=health,
+                             stop_signals=(signal.SIGTERM,)))
+
 # --- 辅助函数 ---
 def is_crisis_message(text: Optional[str]) -> bool:
     """检测用户输入是否包含危机关键词"""
     if text is None:
         return False
-    return any(keyword in text for keyword in CRISIS_KEYWORDS)
+    return get_matcher().contains(text, "crisis")
+
+SENTENCE_END_CHARS = "。！？!?\n"
+
+def split_sentences(buffer: str) -> tuple:
+    """把缓冲区切分为完整句子和剩余片段"""
+    sentences = []
+    start = 0
+    for i, ch in enumerate(buffer):
+        if ch in SENTENCE_END_CHARS:
+            sentence = buffer[start:i + 1].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = i + 1
+    return sentences, buffer[start:]
+
+async def stream_reply(bot, chat_id: int, history: list, system_prompt: str, max_tokens: Optional[int] = None, lane: str = NORMAL) -> Optional[str]:
+    """流式生成回复并逐句投递给用户，返回完整回复文本（无内容时返回 None）
+
+    edit 模式先发送第一句，之后节流地原地编辑同一条消息；
+    split 模式每句话单独发送一条消息。
+    """
+    full_text = ""
+    pending = ""
+    displayed = ""  # 用户当前已看到的文本
+    message = None
+    last_edit = 0.0
+    started = time.monotonic()
+
+    async for chunk in get_ai_stream(history, system_prompt=system_prompt, max_tokens=max_tokens, lane=lane):
+        full_text += chunk
+        pending += chunk
+        sentences, pending = split_sentences(pending)
+        if not sentences:
+            continue
+        if not displayed:
+            logger.info(f"首句已生成 (用户 {chat_id})，耗时 {time.monotonic() - started:.2f}s")
+        if STREAM_REPLY_MODE == "split":
+            for sentence in sentences:
+                await safe_send_message(bot, chat_id, sentence)
+            displayed += "".join(sentences)
+            continue
+        complete = full_text[:len(full_text) - len(pending)].strip()
+        if message is None:
+            message = await safe_send_message(bot, chat_id, complete)
+            if message is not None:
+                displayed = complete
+                last_edit = time.monotonic()
+        elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            if await safe_edit_message(bot, chat_id, message.message_id, complete):
+                displayed = complete
+                last_edit = time.monotonic()
+
+    final_text = full_text.strip()
+    if not final_text:
+        return None
+
+    # 收尾：投递尚未显示的内容
+    if STREAM_REPLY_MODE == "split":
+        if pending.strip():
+            await safe_send_message(bot, chat_id, pending.strip())
+    elif message is None:
+        await safe_send_message(bot, chat_id, final_text)
+    elif final_text != displayed:
+        # 最后一次编辑同样遵守节流间隔
+        wait = STREAM_EDIT_INTERVAL - (time.monotonic() - last_edit)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if not await safe_edit_message(bot, chat_id, message.message_id, final_text):
+            await safe_send_message(bot, chat_id, final_text[len(displayed):].strip())
+    logger.info(f"流式回复完成 (用户 {chat_id})，总耗时 {time.monotonic() - started:.2f}s")
+    return full_text
 
 # --- 命令处理函数 ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -214,6 +412,8 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     chat_id = update.effective_chat.id
     create_or_update_user(chat_id, is_in_crisis=False)
+    burst_coalescer.cancel(chat_id)
+    invalidate_history_cache(chat_id)
     await safe_send_message(context.bot, chat_id, RESET_MESSAGE)
 
 # --- 消息处理核心逻辑 ---
@@ -232,39 +432,58 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except Exception as e:
         logger.warning(f"初始 typing 动作失败 (用户 {chat_id}): {e}")
 
-    user = get_user(chat_id)
-    if user is None:
-        create_or_update_user(chat_id, is_in_crisis=False)
-        user = get_user(chat_id)
-
-    if user and user['is_banned']:
+    # 用户状态只加载一次，所有字段改动在处理结束时一次写回
+    user = load_user_state(chat_id)
+    try:
+        await _process_message(context, chat_id, user_text, user)
+    finally:
+        save_user_state(user)
+
+async def _warn_violation(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user: UserState, warning_text: Optional[str], source: str) -> None:
+    """记录一次违规警告并通知用户"""
+    new_warning_count = add_warning(chat_id)
+    user.refresh(warning_count=new_warning_count)
+    logger.warning(f"用户 {chat_id} {source}违规警告: {new_warning_count}")
+    if new_warning_count >= 5:
+        await safe_send_message(context.bot, chat_id, "🚫 您已被拉黑5次警告，无法继续使用。")
+    if warning_text:
+        await safe_send_message(context.bot, chat_id, warning_text)
+
+async def _process_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_text: str, user: UserState) -> None:
+    """处理一条文本消息，对用户状态的修改由调用方写回"""
+    received_at = time.monotonic()
+    if user.is_banned:
         await safe_send_message(context.bot, chat_id, "❌ 您已被拉黑，无法使用此机器人。")
         logger.warning(f"用户 {chat_id} 被禁")
         return
 
-    # 无快速关键词检查，使用集成AI违规检测（单次调用）
-
     # 检查聊天次数限制
     if not increment_daily_chat(chat_id):
-        await safe_send_message(context.bot, chat_id, "📅 今日聊天次数已达上限（100次），请明天再聊。")
+        await safe_send_message(context.bot, chat_id, f"📅 今日聊天次数已达上限（{DAILY_CHAT_LIMIT}次），请明天再聊。")
         logger.info(f"用户 {chat_id} 达到聊天上限")
         return
 
-    # 更新最后消息时间
-    create_or_update_user(chat_id, last_message_time=datetime.now().isoformat())
+    # 更新最后消息时间；新消息重新开启会话，结束时间由不活跃检查重新标记
+    user.last_message_time = datetime.now().isoformat()
+    user.last_chat_end_time = None
 
     # 加载历史
     history = get_user_history(chat_id, MAX_HISTORY_LENGTH * 2)
-    is_in_crisis = user['is_in_crisis'] if user else False
+    is_in_crisis = user.is_in_crisis
 
     # 保存用户消息
     save_message(chat_id, "user", user_text)
     append_chat_log(chat_id, "user", user_text)
 
+    # 一次扫描得到所有类别的关键词命中，危机检测和违规预筛共用
+    matches = get_matcher().find_all(user_text)
+
     # **心理危机处理协议**
-    if not is_in_crisis and is_crisis_message(user_text):
+    if not is_in_crisis and any(m.category == "crisis" for m in matches):
         logger.warning(f"🚨 用户 {chat_id} 触发危机协议关键词。")
-        create_or_update_user(chat_id, is_in_crisis=True)
+        user.is_in_crisis = True
+        # 危机消息不等待合并，之前尚未回复的消息也不再单独回复
+        burst_coalescer.cancel(chat_id)
         
         # Step 1: 立即验证与稳定
         await safe_send_message(context.bot, chat_id, CRISIS_STEP_1_MESSAGE, ParseMode.HTML)
@@ -273,79 +492,116 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await safe_send_message(context.bot, chat_id, CRISIS_RESOURCES, ParseMode.HTML)
         return # 终止本次交互，等待用户对安全问题的回应
 
+    # 本地违规预筛：明确违规直接警告，不调用模型；只有无法确定时才让模型检查
+    screen = screen_message(user_text, matches)
+    if screen.verdict == VIOLATION:
+        await _warn_violation(context, chat_id, user, VIOLATION_WARNING_MESSAGE, "本地预筛")
+        return
+    check_violation = screen.verdict == AMBIGUOUS
+
     # 如果用户已处于危机模式
     if is_in_crisis:
         logger.info(f"用户 {chat_id} 处于危机模式，发送引导性回复。")
+        burst_coalescer.cancel(chat_id)
         # Step 3: 限制AI响应（非流式，集成违规检查）
         history.append({"role": "user", "content": user_text})
-        user = get_user(chat_id)
-        warning_count = user.get('warning_count', 0) if user is not None else 0
-        try:
-            # 构建包含违规检查的系统提示
-            violation_instruction = """
-在生成响应前，内部检查用户最后一条消息是否包含违规内容（暴力、邪教、色情、政治敏感等）。如果是，立即输出以下警告消息并停止生成更多内容：
-"⚠️ 警告：请避免发送违规内容（暴力、邪教、色情）。继续将导致拉黑。"
-如果不是违规，正常生成响应，但保持危机模式：提供支持性、引导性回复，避免敏感话题。
-"""
-            system_prompt_with_violation = CRISIS_SYSTEM_PROMPT + violation_instruction
-
-            # 获取 AI 响应
-            full_response = await asyncio.wait_for(
-                get_ai_response(history, system_prompt=system_prompt_with_violation, max_tokens=100),
-                timeout=30.0
-            )
-            
-            # 检查响应是否为空
-            if not full_response or not full_response.strip():
-                logger.warning(f"危机模式 AI 返回空响应 (用户 {chat_id})")
-                await safe_send_message(context.bot, chat_id, API_ERROR_MESSAGE + "\n\n" + CRISIS_RESOURCES, ParseMode.HTML)
-                return
-            
-            # 检查是否为违规警告
-            if "⚠️ 警告" in full_response and "违规内容" in full_response:
-                add_warning(chat_id)
-                new_warning_count = warning_count + 1
-                logger.warning(f"用户 {chat_id} AI检测违规警告: {new_warning_count}")
-                if new_warning_count >= 5:
-                    await safe_send_message(context.bot, chat_id, "🚫 您已被拉黑5次警告，无法继续使用。")
-                await safe_send_message(context.bot, chat_id, full_response)
-            else:
-                await safe_send_message(context.bot, chat_id, full_response)
-                save_message(chat_id, "assistant", full_response)
-                append_chat_log(chat_id, "assistant", full_response)
-        except asyncio.TimeoutError:
-            logger.error(f"危机模式 AI 响应超时 (用户 {chat_id})")
-            await safe_send_message(context.bot, chat_id, API_ERROR_MESSAGE + "\n\n" + CRISIS_RESOURCES, ParseMode.HTML)
-        except Exception as e:
-            logger.error(f"危机模式 AI 错误: {e}")
-            await safe_send_message(context.bot, chat_id, API_ERROR_MESSAGE + "\n\n" + CRISIS_RESOURCES, ParseMode.HTML)
+        # 仅在预筛无法确定时附加违规检查指令
+        system_prompt = CRISIS_SYSTEM_PROMPT + CRISIS_VIOLATION_CHECK_INSTRUCTION if check_violation else CRISIS_SYSTEM_PROMPT
+        # history 是在保存本条消息之前读取的，加上本条正好是数据库中最近 len(history) 条消息
+        system_prompt, history = build_context(chat_id, history, system_prompt, keep_recent=len(history))
+        await _crisis_reply(context, chat_id, user, history, system_prompt, received_at)
         return
 
     # --- 正常聊天模式 ---
+    if BURST_DEBOUNCE_SECONDS > 0:
+        # 等待可能紧接着到来的消息，合并后只回复一次
+        burst_coalescer.add(chat_id, lambda cid, burst: _reply_burst(context, cid, burst), flagged=check_violation)
+        return
+
     history.append({"role": "user", "content": user_text})
-    
-    # 保持会话历史在一定长度内
-    if len(history) > MAX_HISTORY_LENGTH * 2:
-        history = history[-MAX_HISTORY_LENGTH * 2:]
-
-    # 构建包含违规检查的系统提示
-    violation_instruction = """
-在生成响应前，内部检查用户最后一条消息是否包含违规内容（暴力、邪教、色情、政治敏感等）。如果是，立即输出以下警告消息并停止生成更多内容：
-"⚠️ 警告：请避免发送违规内容（暴力、邪教、色情）。继续将导致拉黑。"
-如果不是违规，正常生成响应。
-"""
-    system_prompt_with_violation = SYSTEM_PROMPT + violation_instruction
+    await _generate_reply(context, chat_id, user, history, check_violation)
+
+async def _crisis_reply(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user: UserState, history: list,
+                        system_prompt: str, received_at: float) -> None:
+    """危机模式回复：模型在 CRISIS_REPLY_DEADLINE 内没有回复时先发送预置的支持性消息，模型回复稍后到达仍然投递"""
+    global crisis_fallbacks
+    task = asyncio.create_task(get_ai_response(history, system_prompt=system_prompt, max_tokens=100, lane=CRISIS))
+    first_reply_at = None
+    full_response = None
+    try:
+        done, _ = await asyncio.wait({task}, timeout=max(0.0, CRISIS_REPLY_DEADLINE - (time.monotonic() - received_at)))
+        if not done:
+            await safe_send_message(context.bot, chat_id, random.choice(CRISIS_FALLBACK_MESSAGES))
+            first_reply_at = time.monotonic()
+            crisis_fallbacks += 1
+            logger.warning(f"危机模式 AI 在 {CRISIS_REPLY_DEADLINE}s 内未回复，已发送预置消息 (用户 {chat_id})")
+        full_response = await asyncio.wait_for(task, timeout=max(0.0, 30.0 - (time.monotonic() - received_at)))
+    except asyncio.TimeoutError:
+        logger.error(f"危机模式 AI 响应超时 (用户 {chat_id})")
+    except Exception as e:
+        logger.error(f"危机模式 AI 错误: {e}")
+    finally:
+        task.cancel()
+
+    # 检查响应是否为空
+    if not full_response or not full_response.strip():
+        logger.warning(f"危机模式 AI 未返回有效回复 (用户 {chat_id})")
+        if first_reply_at is None:
+            await safe_send_message(context.bot, chat_id, API_ERROR_MESSAGE + "\n\n" + CRISIS_RESOURCES, ParseMode.HTML)
+        else:
+            await safe_send_message(context.bot, chat_id, CRISIS_RESOURCES, ParseMode.HTML)
+    # 检查是否为违规警告
+    elif "⚠️ 警告" in full_response and "违规内容" in full_response:
+        await _warn_violation(context, chat_id, user, full_response, "AI检测")
+    else:
+        await safe_send_message(context.bot, chat_id, full_response)
+        save_message(chat_id, "assistant", full_response)
+        append_chat_log(chat_id, "assistant", full_response)
+        crisis_model_latency.record(time.monotonic() - received_at)
+
+    # 记录端到端延迟：从收到消息到用户看到第一条回复
+    if first_reply_at is None:
+        first_reply_at = time.monotonic()
+    crisis_first_reply_latency.record(first_reply_at - received_at)
+    logger.info(f"危机回复 (用户 {chat_id}): 首条回复 {first_reply_at - received_at:.2f}s, 总耗时 {time.monotonic() - received_at:.2f}s")
+
+async def _reply_burst(context: ContextTypes.DEFAULT_TYPE, chat_id: int, burst: Burst) -> None:
+    """为一组合并的连续消息生成一次回复，消息本身已逐条保存"""
+    user = load_user_state(chat_id)
+    try:
+        if user.is_banned or user.is_in_crisis:
+            return
+        history = merge_user_turns(get_user_history(chat_id, MAX_HISTORY_LENGTH * 2))
+        await _generate_reply(context, chat_id, user, history, burst.flagged,
+                              on_generated=lambda: burst_coalescer.release(chat_id, burst))
+    finally:
+        save_user_state(user)
+
+async def _generate_reply(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user: UserState, history: list,
+                          check_violation: bool, on_generated: Optional[Callable[[], None]] = None) -> None:
+    """正常聊天模式下生成并投递回复；on_generated 在模型返回后、投递前调用"""
+    # 仅在预筛无法确定时附加违规检查指令
+    system_prompt = SYSTEM_PROMPT + VIOLATION_CHECK_INSTRUCTION if check_violation else SYSTEM_PROMPT
+    # 附加较早对话的摘要，并按 token 预算保留最近的消息
+    system_prompt, history = build_context(chat_id, history, system_prompt)
 
     # 获取 AI 回复（非流式，集成违规检查）
     logger.info(f"生成 AI 响应中... (用户 {chat_id})")
-    user = get_user(chat_id)
-    warning_count = user.get('warning_count', 0) if user is not None else 0
+    streaming = STREAM_REPLY_MODE in ("edit", "split")
     try:
-        # 获取 AI 响应
-        full_response = await asyncio.wait_for(
-            get_ai_response(history, system_prompt=system_prompt_with_violation),
-            timeout=30.0
-        )
+        # 获取 AI 响应（流式模式下边生成边投递）
+        if streaming:
+            full_response = await asyncio.wait_for(
+                stream_reply(context.bot, chat_id, history, system_prompt),
+                timeout=30.0
+            )
+        else:
+            full_response = await asyncio.wait_for(
+                get_ai_response(history, system_prompt=system_prompt),
+                timeout=30.0
+            )
+        if on_generated is not None:
+            on_generated()
         
         # 检查响应是否为空
         if not full_response or not full_response.strip():
@@ -356,30 +612,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         # 检查是否为违规警告
         if "⚠️ 警告" in full_response and "违规内容" in full_response:
-            add_warning(chat_id)
-            new_warning_count = warning_count + 1
-            logger.warning(f"用户 {chat_id} AI检测违规警告: {new_warning_count}")
-            if new_warning_count >= 5:
-                await safe_send_message(context.bot, chat_id, "🚫 您已被拉黑5次警告，无法继续使用。")
-            await safe_send_message(context.bot, chat_id, full_response)
+            # 流式模式下警告已经投递给用户
+            await _warn_violation(context, chat_id, user, None if streaming else full_response, "AI检测")
         else:
-            await safe_send_message(context.bot, chat_id, full_response)
+            if not streaming:
+                await safe_send_message(context.bot, chat_id, full_response)
             logger.info(f"AI 响应生成成功 (用户 {chat_id}): {full_response[:50]}...")
             save_message(chat_id, "assistant", full_response)
             append_chat_log(chat_id, "assistant", full_response)
             
-            # 心理状态评估（非流式）
-            try:
-                assessment_history = history + [{"role": "assistant", "content": full_response}]
-                assessment_prompt = MENTAL_ASSESSMENT_PROMPT.format(history=str(assessment_history))
-                assessment_response = await asyncio.wait_for(get_ai_response([{"role": "system", "content": assessment_prompt}]), timeout=20.0)
-                import json
-                if assessment_response is not None:
-                    assessment = json.loads(assessment_response)
-                    update_mental_scores(chat_id, assessment.get('depression', 0), assessment.get('anxiety', 0))
-                    logger.info(f"心理评估更新 (用户 {chat_id}): 抑郁={assessment.get('depression', 0)}, 焦虑={assessment.get('anxiety', 0)}")
-            except Exception as e:
-                logger.warning(f"心理评估失败: {e}")
+            # 心理状态评估交给后台队列，不占用回复路径
+            assessment_worker.submit(chat_id)
+            summary_worker.submit(chat_id)
+    except AdmissionRejected:
+        # 模型调用排队过久：快速回复，不占用名额
+        await safe_send_message(context.bot, chat_id, OVERLOAD_MESSAGE)
     except asyncio.TimeoutError:
         logger.error(f"AI 响应超时 (用户 {chat_id})")
         error_msg = API_ERROR_MESSAGE + "\n\n💡 可能原因：网络问题或 API 限额。请稍后重试，或检查配置。"
@@ -405,10 +652,7 @@ def main() -> None:
     logger.info("=== Mind First Aid Kit Bot 启动 ===")
     logger.info(f"TELEGRAM_TOKEN: {'设置' if TELEGRAM_TOKEN else '未设置'}")
     logger.info(f"OPENROUTER_API_KEY: {'设置' if OPENROUTER_API_KEY else '未设置'}")
-    logger.info(f"AI_MODEL: {AI_MODEL}")
-    
-    # 启动调度器线程
-    threading.Thread(target=run_scheduler, daemon=True).start()
+    logger.info(f"AI_MODELS: {', '.join(AI_MODELS)}")
     
     # 启动机器人
     _init_and_start_bot()
@@ -0,0 +1,43 @@
+# metrics.py
+import math
+from collections import deque
+from typing import Dict
+
+
+class LatencyStats:
+    """记录耗时分布：总次数、平均值、最大值，以及最近 window 个样本的分位数"""
+
+    def __init__(self, window: int = 1024):
+        self._samples: deque = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def samples(self) -> int:
+        """最近窗口内的样本数"""
+        return len(self._samples)
+
+    def percentile(self, p: float) -> float:
+        """最近样本的第 p 百分位（0-100），无样本时返回 0"""
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'max': self.max,
+        }
@@ -0,0 +1,118 @@
+# model_router.py
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+from config import (
+    AI_MODELS, AI_LATENCY_EWMA_ALPHA, AI_HEDGE_DEFAULT_DELAY, AI_HEDGE_MIN_DELAY, AI_HEDGE_MAX_DELAY,
+    AI_CIRCUIT_FAILURES, AI_CIRCUIT_COOLDOWN,
+)
+from metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+# 样本数少于该值时 p95 不可靠，使用默认对冲延迟
+_MIN_SAMPLES_FOR_P95 = 20
+
+
+class ModelHealth:
+    """单个模型的延迟和失败状态"""
+
+    def __init__(self):
+        self.ewma: Optional[float] = None
+        self.latency = LatencyStats(window=256)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            'ewma': self.ewma,
+            'p95': self.latency.percentile(95),
+            'successes': self.successes,
+            'failures': self.failures,
+            'circuit_open': self.open_until > time.monotonic(),
+        }
+
+
+class ModelRouter:
+    """按配置顺序选择模型，记录每个模型的延迟（EWMA 和 p95），并对连续失败的模型熔断
+
+    熔断的模型在 cooldown 秒内被跳过；冷却结束后放行请求试探，再次失败会立即重新熔断。
+    所有模型都熔断时仍使用首选模型，而不是直接失败。
+    """
+
+    def __init__(self, models: Iterable[str], alpha: float, default_delay: float, min_delay: float, max_delay: float,
+                 failure_threshold: int, cooldown: float):
+        self.models: List[str] = list(dict.fromkeys(models))
+        self.alpha = alpha
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health: Dict[str, ModelHealth] = {model: ModelHealth() for model in self.models}
+        self.hedges = 0
+        self.hedges_skipped = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    def _available(self, model: str, now: float) -> bool:
+        return self.health[model].open_until <= now
+
+    def candidates(self) -> List[str]:
+        """按优先级返回当前可用的模型"""
+        now = time.monotonic()
+        available = [model for model in self.models if self._available(model, now)]
+        return available or self.models[:1]
+
+    def fastest_alternative(self, exclude: Iterable[str]) -> Optional[str]:
+        """可用模型中 EWMA 最低的一个；还没有延迟数据的模型优先尝试"""
+        exclude = set(exclude)
+        options = [model for model in self.candidates() if model not in exclude]
+        if not options:
+            return None
+        return min(options, key=lambda model: self.health[model].ewma or 0.0)
+
+    def hedge_delay(self, model: str) -> float:
+        """等待多久后向备选模型发出对冲请求：取该模型最近的 p95 延迟"""
+        stats = self.health[model].latency
+        if stats.samples < _MIN_SAMPLES_FOR_P95:
+            return self.default_delay
+        return min(self.max_delay, max(self.min_delay, stats.percentile(95)))
+
+    def record_success(self, model: str, seconds: Optional[float] = None) -> None:
+        health = self.health[model]
+        health.successes += 1
+        health.consecutive_failures = 0
+        health.open_until = 0.0
+        if seconds is not None:
+            health.latency.record(seconds)
+            health.ewma = seconds if health.ewma is None else self.alpha * seconds + (1 - self.alpha) * health.ewma
+
+    def record_cancelled(self, model: str, seconds: float) -> None:
+        """请求被取消（对冲落败或调用方超时）：已等待的时间作为延迟的下界计入 p95，
+        否则 p95 只来自较快的成功请求，对冲延迟会越来越短"""
+        self.health[model].latency.record(seconds)
+
+    def record_failure(self, model: str) -> None:
+        health = self.health[model]
+        health.failures += 1
+        health.consecutive_failures += 1
+        if health.consecutive_failures >= self.failure_threshold:
+            health.open_until = time.monotonic() + self.cooldown
+            logger.warning(f"模型 {model} 连续失败 {health.consecutive_failures} 次，熔断 {self.cooldown:.0f}s")
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'hedges': self.hedges,
+            'hedges_skipped': self.hedges_skipped,
+            'hedge_wins': self.hedge_wins,
+            'fallbacks': self.fallbacks,
+            'models': {model: health.snapshot() for model, health in self.health.items()},
+        }
+
+
+model_router = ModelRouter(AI_MODELS, AI_LATENCY_EWMA_ALPHA, AI_HEDGE_DEFAULT_DELAY, AI_HEDGE_MIN_DELAY,
+                           AI_HEDGE_MAX_DELAY, AI_CIRCUIT_FAILURES, AI_CIRCUIT_COOLDOWN)
@@ -0,0 +1,113 @@
+# outreach.py
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, Iterable, List
+
+from telegram.error import Forbidden, BadRequest, RetryAfter
+
+from config import OUTREACH_CONCURRENCY, OUTREACH_RATE, OUTREACH_CHAT_INTERVAL, OUTREACH_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+class OutreachReport:
+    """一次主动问候的发送结果"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'retries': self.retries,
+            'elapsed': round(self.elapsed, 2),
+            'per_second': round(self.sent / self.elapsed, 1) if self.elapsed else 0.0,
+        }
+
+
+class OutreachEngine:
+    """按 Telegram 的频率限制批量发送主动问候
+
+    全局按 rate 条/秒匀速发送，同时最多 concurrency 个请求；同一聊天两条消息至少间隔
+    chat_interval 秒。收到 RetryAfter 时暂停所有发送，等待后重试。
+    """
+
+    def __init__(self, concurrency: int, rate: float, chat_interval: float, max_retries: int):
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._next_slot = 0.0
+        self._chat_last_sent: Dict[int, float] = {}
+
+    async def _wait_turn(self, chat_id: int) -> None:
+        """等待全局发送速率和该聊天的发送间隔"""
+        while True:
+            now = time.monotonic()
+            # 清理早已超过间隔的记录，避免无限增长
+            if len(self._chat_last_sent) > 10000:
+                self._chat_last_sent = {c: t for c, t in self._chat_last_sent.items() if now - t < self.chat_interval}
+            chat_ready = self._chat_last_sent.get(chat_id, float('-inf')) + self.chat_interval
+            slot = max(now, self._next_slot)
+            start = max(slot, chat_ready)
+            if start <= now:
+                self._next_slot = now + (1 / self.rate if self.rate > 0 else 0.0)
+                self._chat_last_sent[chat_id] = now
+                return
+            await asyncio.sleep(start - now)
+
+    async def _send(self, bot, chat_id: int, text: str, report: OutreachReport) -> bool:
+        for _ in range(self.max_retries + 1):
+            await self._wait_turn(chat_id)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                report.sent += 1
+                return True
+            except RetryAfter as e:
+                # 频率限制针对整个机器人：推迟所有后续发送
+                retry_after = float(e.retry_after)
+                self._next_slot = max(self._next_slot, time.monotonic() + retry_after)
+                report.retries += 1
+                logger.warning(f"主动问候触发频率限制，暂停 {retry_after:.0f} 秒")
+            except (Forbidden, BadRequest) as e:
+                # 用户屏蔽了机器人或聊天不存在：本次会话不再尝试
+                report.blocked += 1
+                logger.info(f"无法向用户 {chat_id} 发送问候: {e}")
+                return True
+            except Exception as e:
+                report.failed += 1
+                logger.warning(f"向用户 {chat_id} 发送问候失败: {e}")
+                return False
+        report.failed += 1
+        return False
+
+    async def run(self, bot, name: str, pages: Iterable[List[int]], text: str,
+                  on_delivered: Callable[[List[int]], None]) -> OutreachReport:
+        """逐页发送问候；每页发送完成后调用 on_delivered 记录已处理的用户，失败的用户下次再试"""
+        report = OutreachReport(name)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(chat_id: int) -> bool:
+            async with semaphore:
+                return await self._send(bot, chat_id, text, report)
+
+        for page in pages:
+            results = await asyncio.gather(*(send_one(chat_id) for chat_id in page))
+            delivered = [chat_id for chat_id, ok in zip(page, results) if ok]
+            if delivered:
+                on_delivered(delivered)
+        report.elapsed = time.monotonic() - report.started
+        logger.info(f"主动问候 {name} 完成: {report.to_dict()}")
+        return report
+
+
+outreach_engine = OutreachEngine(OUTREACH_CONCURRENCY, OUTREACH_RATE, OUTREACH_CHAT_INTERVAL, OUTREACH_MAX_RETRIES)
@@ -59,13 +59,63 @@ CRISIS_SYSTEM_PROMPT = f"""
 """
 
 MENTAL_ASSESSMENT_PROMPT = """
-基于以下用户聊天历史，请评估用户的心理状态：
+下面是用户自上次评估以来的新对话，请结合上次的评分评估用户当前的心理状态：
 - 抑郁分数 (0-10): 越高越抑郁
 - 焦虑分数 (0-10): 越高越焦虑
 
 只返回JSON格式: {{"depression": 5.5, "anxiety": 7.2}}
 
-历史: {history}
+上次评分: {previous}
+新对话:
+{history}
+"""
+
+# 合并多位用户的评估请求时使用，按编号返回各自的分数
+MENTAL_ASSESSMENT_BATCH_PROMPT = """
+下面是多位用户各自自上次评估以来的新对话（标题中附有上次的评分），请分别评估每位用户当前的心理状态：
+- 抑郁分数 (0-10): 越高越抑郁
+- 焦虑分数 (0-10): 越高越焦虑
+
+只返回JSON格式，键为用户编号: {{"1": {{"depression": 5.5, "anxiety": 7.2}}, "2": {{"depression": 2.0, "anxiety": 3.1}}}}
+
+{conversations}
+"""
+
+# 评估提示中的上次评分
+PREVIOUS_SCORES_TEMPLATE = "抑郁 {depression:.1f}，焦虑 {anxiety:.1f}"
+NO_PREVIOUS_SCORES = "无（首次评估）"
+
+SUMMARY_PROMPT = """
+请把下面的新对话合并进已有摘要，生成一份新的摘要，供之后继续陪伴这位用户时参考。
+保留：用户的主要困扰、情绪变化、提到的重要的人和事、已经尝试过的建议，以及任何安全风险信号。
+不超过300字，只输出摘要正文。
+
+已有摘要：
+{summary}
+
+新的对话：
+{conversation}
+"""
+
+# 附加在系统提示之后，向模型提供较早对话的摘要
+SUMMARY_CONTEXT_TEMPLATE = """
+
+以下是与该用户较早对话的摘要，供参考：
+{summary}"""
+
+VIOLATION_WARNING_MESSAGE = "⚠️ 警告：请避免发送违规内容（暴力、邪教、色情）。继续将导致拉黑。"
+
+# 本地预筛无法确定时，附加在系统提示后由模型判断是否违规
+VIOLATION_CHECK_INSTRUCTION = f"""
+在生成响应前，内部检查用户最后一条消息是否包含违规内容（暴力、邪教、色情、政治敏感等）。如果是，立即输出以下警告消息并停止生成更多内容：
+"{VIOLATION_WARNING_MESSAGE}"
+如果不是违规，正常生成响应。
+"""
+
+CRISIS_VIOLATION_CHECK_INSTRUCTION = f"""
+在生成响应前，内部检查用户最后一条消息是否包含违规内容（暴力、邪教、色情、政治敏感等）。如果是，立即输出以下警告消息并停止生成更多内容：
+"{VIOLATION_WARNING_MESSAGE}"
+如果不是违规，正常生成响应，但保持危机模式：提供支持性、引导性回复，避免敏感话题。
 """
 
 VIOLATION_CHECK_PROMPT = """
@@ -125,4 +175,14 @@ API_ERROR_MESSAGE = f"""
 {CRISIS_RESOURCES}
 """
 
+# 危机模式下模型未能及时回复时立即发送的消息，随机选取一条
+CRISIS_FALLBACK_MESSAGES = [
+    "我在这里，一直在听你说。你愿意告诉我，你现在身边有人陪着吗？",
+    "谢谢你愿意告诉我这些，这需要很大的勇气。你现在安全吗？",
+    "你的感受很重要，我不会离开。如果你觉得撑不住了，请马上拨打希望24热线 400-161-9995。",
+    "我听到了，你不是一个人。我们先慢慢呼吸一下，好吗？你现在在哪里？",
+]
+
+OVERLOAD_MESSAGE = "抱歉，现在找我聊天的人有点多，我需要一点时间。请稍等片刻再发一次消息，我会在这里陪着你。"
+
 CRISIS_STEP_1_MESSAGE = "我听到你说的了，这非常重要。<b>你现在是否处于一个安全的环境中？</b> 我非常担心你。"
\ No newline at end of file
@@ -0,0 +1,54 @@
+# risk_review.py
+"""
+风险复查：按综合风险分从高到低分页查看用户。
+用法：python risk_review.py [--limit N] [--min-score S] [--since 时间] [--cursor 分数:用户ID]
+      python risk_review.py --history 用户ID   查看该用户最近的评分变化
+每页是一次索引查询，可以反复执行而不会给线上数据库带来明显负载。
+"""
+import argparse
+import json
+
+from database import init_db, get_risk_review, get_score_history
+
+
+def _parse_cursor(value: str) -> tuple:
+    score, user_id = value.split(':', 1)
+    return float(score), int(user_id)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="按风险分分页查看用户")
+    parser.add_argument('--limit', type=int, default=20, help="每页人数")
+    parser.add_argument('--min-score', type=float, help="只显示风险分不低于该值的用户")
+    parser.add_argument('--since', help="只显示此后（isoformat）分数有更新的用户")
+    parser.add_argument('--cursor', type=_parse_cursor, help="上一页输出的游标，格式为 分数:用户ID")
+    parser.add_argument('--history', type=int, metavar='USER_ID', help="查看该用户最近的评分变化")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出")
+    args = parser.parse_args()
+
+    init_db()
+    if args.history is not None:
+        history = get_score_history(args.history, args.limit)
+        if args.json:
+            print(json.dumps([{'assessed_at': at, 'depression_score': d, 'anxiety_score': a} for at, d, a in history],
+                             ensure_ascii=False))
+            return
+        print(f"{'评估时间':<26} {'抑郁':>6} {'焦虑':>6}")
+        for assessed_at, depression, anxiety in history:
+            print(f"{assessed_at:<26} {depression:>8.1f} {anxiety:>8.1f}")
+        return
+    rows, next_cursor = get_risk_review(args.limit, args.min_score, args.since, args.cursor)
+    if args.json:
+        print(json.dumps({'rows': rows, 'next_cursor': f"{next_cursor[0]}:{next_cursor[1]}" if next_cursor else None},
+                         ensure_ascii=False))
+        return
+    print(f"{'用户ID':>12} {'风险':>6} {'抑郁':>6} {'焦虑':>6} {'危机':>4}  {'分数更新时间':<26} 最后消息")
+    for row in rows:
+        print(f"{row['user_id']:>14} {row['risk_score']:>8.1f} {row['depression_score']:>8.1f} {row['anxiety_score']:>8.1f} "
+              f"{'是' if row['is_in_crisis'] else '':>4}  {row['risk_updated_at'] or '-':<26} {row['last_message_time'] or '-'}")
+    if next_cursor:
+        print(f"\n下一页: --cursor {next_cursor[0]}:{next_cursor[1]}")
+
+
+if __name__ == '__main__':
+    main()
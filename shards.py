@@ -0,0 +1,370 @@
+# shards.py
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from config import (
+    TELEGRAM_TOKEN, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_MAX_PENDING,
+    WEBHOOK_MAX_BODY, WEBHOOK_MAX_CONNECTIONS, SHARD_WORKERS, SHARD_BASE_PORT, SHARD_QUEUE_MAX, SHARD_VNODES,
+    SHARD_HEALTH_INTERVAL, SHARD_HEALTH_FAILURES, SHARD_STOP_TIMEOUT, SHARD_PARENT_CHECK_INTERVAL,
+)
+from metrics import LatencyStats
+from webhook_server import WebhookServer, SECRET_HEADER, HEALTH_PATH
+
+logger = logging.getLogger(__name__)
+
+# 更新中可能携带聊天的字段；callback_query 的聊天在其 message 中
+_CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member',
+                'chat_member', 'chat_join_request', 'message_reaction', 'message_reaction_count', 'chat_boost',
+                'removed_chat_boost')
+# 更新本身有问题（格式错误、过大），重试也不会成功，直接丢弃
+_PERMANENT_STATUSES = (400, 413)
+
+
+def chat_id_of(data: dict) -> Optional[int]:
+    """从原始更新 JSON 中取出聊天 ID，不构造 Update 对象；没有聊天的更新按发送者 ID 分片"""
+    for field in _CHAT_FIELDS:
+        value = data.get(field)
+        if isinstance(value, dict) and isinstance(value.get('chat'), dict):
+            return value['chat'].get('id')
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        message = value.get('message')
+        if isinstance(message, dict) and isinstance(message.get('chat'), dict):
+            return message['chat'].get('id')
+        sender = value.get('from') or value.get('user')
+        if isinstance(sender, dict) and 'id' in sender:
+            return sender['id']
+    return None
+
+
+class HashRing:
+    """一致性哈希环：每个分片放置 vnodes 个虚拟节点，分片数变化时只有约 1/N 的聊天换到别的分片"""
+
+    def __init__(self, shards: int, vnodes: int):
+        points = []
+        for shard in range(shards):
+            for vnode in range(vnodes):
+                points.append((self._hash(f"shard-{shard}-{vnode}"), shard))
+        points.sort()
+        self._keys = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    def shard_for(self, chat_id: int) -> int:
+        index = bisect.bisect(self._keys, self._hash(str(chat_id)))
+        return self._shards[index % len(self._shards)]
+
+
+def _watch_parent(parent_pid: int, interval: float) -> None:
+    """supervisor 退出（本进程被收养）后向自己发送 SIGTERM 平滑退出，
+    避免遗留的分片继续占用端口、运行定时任务"""
+    while os.getppid() == parent_pid:
+        time.sleep(interval)
+    logger.warning(f"supervisor (pid {parent_pid}) 已退出，分片进程随之退出")
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def _worker_main(shard: int, workers: int, port: int, secret: str, run_jobs: bool, parent_pid: int) -> None:
+    """子进程入口（spawn 方式启动，需可按模块路径导入）"""
+    threading.Thread(target=_watch_parent, args=(parent_pid, SHARD_PARENT_CHECK_INTERVAL), name="parent-watch",
+                     daemon=True).start()
+    import main
+    main.run_shard_worker(shard, workers, port, secret, run_jobs)
+
+
+class Shard:
+    """supervisor 中的一个分片：工作进程、待转发队列和健康状态"""
+
+    def __init__(self, index: int, port: int, queue_size: int):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.process: Optional[multiprocessing.Process] = None
+        self.forwarder: Optional[asyncio.Task] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.crashes = 0
+        self.restart_after = 0.0
+        self.forwarded = 0
+        self.retries = 0
+        self.health_failures = 0
+        self.last_heartbeat: Optional[float] = None
+        self.last_report: Dict[str, object] = {}
+        self.forward_time = LatencyStats(window=256)
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            'pid': self.process.pid if self.process else None,
+            'alive': bool(self.process and self.process.is_alive()),
+            'queue_depth': self.queue.qsize(),
+            'forwarded': self.forwarded,
+            'retries': self.retries,
+            'restarts': self.restarts,
+            'heartbeat_age': round(time.monotonic() - self.last_heartbeat, 1) if self.last_heartbeat else None,
+            'forward_time': self.forward_time.snapshot(),
+            'worker': self.last_report,
+        }
+
+
+class ShardSupervisor:
+    """多进程模式：本进程接收全部更新，按 chat_id 的一致性哈希转发给对应的分片进程
+
+    每个分片一个有界队列和一个转发任务，按到达顺序逐条转发，保证同一聊天的处理顺序；
+    分片进程重启期间更新留在队列中，恢复后继续投递。队列满时 route 等待，
+    积压最终传导到入口的 webhook 服务（返回 503）或暂停轮询。
+    定时任务只在 0 号分片运行。所有分片共用同一个 SQLite 数据库（WAL，多进程写入由 SQLite 锁串行化）。
+    """
+
+    def __init__(self, shards: int, base_port: int, queue_size: int, vnodes: int, health_interval: float,
+                 health_failures: int, stop_timeout: float, secret: Optional[str] = None):
+        self.ring = HashRing(shards, vnodes)
+        self.shards: List[Shard] = [Shard(i, base_port + i, queue_size) for i in range(shards)]
+        self.health_interval = health_interval
+        self.health_failures = health_failures
+        self.stop_timeout = stop_timeout
+        # 分片进程只监听本机，用独立的随机 token 校验转发请求
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.routed = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._context = multiprocessing.get_context('spawn')
+        self._restarting: set = set()
+        self._rolling: Optional[asyncio.Task] = None
+
+    def shard_for(self, data: dict) -> Shard:
+        chat_id = chat_id_of(data)
+        return self.shards[self.ring.shard_for(chat_id) if chat_id is not None else 0]
+
+    async def route(self, data: dict) -> None:
+        """把更新放入对应分片的队列，队列满时等待"""
+        self.routed += 1
+        await self.shard_for(data).queue.put(data)
+
+    def health(self) -> Dict[str, object]:
+        return {'routed': self.routed, 'shards': {shard.index: shard.snapshot() for shard in self.shards}}
+
+    # --- 转发 ---
+
+    def start_forwarding(self) -> None:
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, connect=2.0),
+                                         limits=httpx.Limits(max_keepalive_connections=len(self.shards)))
+        for shard in self.shards:
+            shard.forwarder = asyncio.create_task(self._forward(shard))
+
+    async def _forward(self, shard: Shard) -> None:
+        headers = {SECRET_HEADER: self.secret}
+        while True:
+            data = await shard.queue.get()
+            try:
+                delay = 0.05
+                while True:
+                    started = time.monotonic()
+                    try:
+                        response = await self._client.post(shard.url + WEBHOOK_PATH, json=data, headers=headers)
+                        if response.status_code == 200:
+                            shard.forwarded += 1
+                            shard.forward_time.record(time.monotonic() - started)
+                            break
+                        if response.status_code in _PERMANENT_STATUSES:
+                            logger.error(f"分片 {shard.index} 拒绝更新 {data.get('update_id')}: HTTP {response.status_code}")
+                            break
+                        # 其余状态稍后重试同一条，保持顺序。503 是分片积压已满；403/404 说明端口上不是本 supervisor
+                        # 启动的分片（例如上一个 supervisor 遗留的进程），重启分片；刚启动的分片先等一个检查周期
+                        if response.status_code in (403, 404) and \
+                                time.monotonic() - shard.started_at >= self.health_interval:
+                            await self.restart(shard, f"分片拒绝转发请求 (HTTP {response.status_code})")
+                    except httpx.TransportError:
+                        pass  # 分片进程正在启动或重启
+                    shard.retries += 1
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+            finally:
+                shard.queue.task_done()
+
+    # --- 进程管理 ---
+
+    def _spawn(self, shard: Shard) -> None:
+        shard.process = self._context.Process(
+            target=_worker_main, args=(shard.index, len(self.shards), shard.port, self.secret, shard.index == 0, os.getpid()),
+            name=f"shard-{shard.index}")
+        shard.process.start()
+        shard.started_at = time.monotonic()
+        shard.health_failures = 0
+        logger.info(f"分片 {shard.index} 已启动 (pid {shard.process.pid}, 端口 {shard.port})")
+
+    async def _terminate(self, shard: Shard) -> None:
+        """发送 SIGTERM，分片处理完已接收的更新后退出；超时则强制结束"""
+        process = shard.process
+        if process is None or not process.is_alive():
+            return
+        process.terminate()
+        await asyncio.to_thread(process.join, self.stop_timeout)
+        if process.is_alive():
+            logger.warning(f"分片 {shard.index} 未在 {self.stop_timeout:.0f}s 内退出，强制结束")
+            process.kill()
+            await asyncio.to_thread(process.join)
+
+    async def restart(self, shard: Shard, reason: str) -> None:
+        if shard.index in self._restarting:
+            return
+        self._restarting.add(shard.index)
+        try:
+            logger.warning(f"重启分片 {shard.index}: {reason}")
+            await self._terminate(shard)
+            shard.restarts += 1
+            self._spawn(shard)
+        finally:
+            self._restarting.discard(shard.index)
+
+    async def rolling_restart(self) -> None:
+        """逐个平滑重启分片：等上一个恢复心跳后再重启下一个"""
+        for shard in self.shards:
+            await self.restart(shard, "滚动重启")
+            deadline = time.monotonic() + self.stop_timeout
+            while time.monotonic() < deadline and not await self.check_health(shard):
+                await asyncio.sleep(0.5)
+
+    def request_rolling_restart(self) -> None:
+        """SIGHUP 处理：启动滚动重启；上一次还在进行时忽略"""
+        if self._rolling is not None and not self._rolling.done():
+            logger.info("滚动重启正在进行，忽略本次请求")
+            return
+        self._rolling = asyncio.create_task(self.rolling_restart())
+
+    async def check_health(self, shard: Shard) -> bool:
+        """请求分片的 /health，成功即记为一次心跳"""
+        try:
+            response = await self._client.get(shard.url + HEALTH_PATH, headers={SECRET_HEADER: self.secret},
+                                             timeout=2.0)
+            response.raise_for_status()
+            shard.last_report = response.json()
+        except (httpx.HTTPError, ValueError):
+            shard.health_failures += 1
+            return False
+        shard.health_failures = 0
+        shard.last_heartbeat = time.monotonic()
+        return True
+
+    async def _monitor(self) -> None:
+        last_check = 0.0
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for shard in self.shards:
+                if shard.index in self._restarting or shard.process.is_alive():
+                    continue
+                if shard.restart_after == 0.0:
+                    # 启动后很快就退出（配置错误、网络不可用等）时按指数退避重启，避免反复崩溃
+                    shard.crashes = shard.crashes + 1 if now - shard.started_at < self.health_interval else 0
+                    shard.restart_after = now + (min(30.0, 2.0 ** shard.crashes) if shard.crashes else 0.0)
+                if now >= shard.restart_after:
+                    shard.restart_after = 0.0
+                    await self.restart(shard, f"进程已退出 (exitcode {shard.process.exitcode})")
+            if time.monotonic() - last_check < self.health_interval:
+                continue
+            last_check = time.monotonic()
+            for shard in self.shards:
+                if shard.index in self._restarting or await self.check_health(shard):
+                    continue
+                # 进程还在但持续无响应：视为卡死；刚启动的分片给一个检查周期的初始化时间
+                starting = time.monotonic() - shard.started_at < self.health_interval
+                if shard.health_failures >= self.health_failures and not starting:
+                    await self.restart(shard, f"连续 {shard.health_failures} 次健康检查失败")
+            logger.info("分片状态: " + ", ".join(
+                f"{s.index}=(队列 {s.queue.qsize()}, 已转发 {s.forwarded}, 重启 {s.restarts}, "
+                f"心跳 {s.snapshot()['heartbeat_age']}s)" for s in self.shards))
+
+    # --- 入口 ---
+
+    async def _poll(self, bot, stopping: asyncio.Event) -> None:
+        """长轮询模式：只有 supervisor 调用 getUpdates，再按聊天分发"""
+        from telegram import Update
+
+        await bot.delete_webhook()
+        offset = None
+        while not stopping.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.warning(f"获取更新失败: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            for update in updates:
+                await self.route(update.to_dict())
+                offset = update.update_id + 1
+
+    async def run(self) -> None:
+        from telegram import Bot, Update
+
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig, handler in ((signal.SIGINT, stopping.set), (signal.SIGTERM, stopping.set),
+                             (getattr(signal, 'SIGHUP', None), self.request_rolling_restart)):
+            if sig is None:
+                continue
+            try:
+                loop.add_signal_handler(sig, handler)
+            except NotImplementedError:
+                pass
+
+        for shard in self.shards:
+            self._spawn(shard)
+        self.start_forwarding()
+        monitor = asyncio.create_task(self._monitor())
+        bot = Bot(TELEGRAM_TOKEN)
+        server = None
+        poller = None
+        await bot.initialize()
+        try:
+            if WEBHOOK_URL:
+                server = WebhookServer(self.route, WEBHOOK_SECRET, WEBHOOK_PATH, WEBHOOK_MAX_PENDING, WEBHOOK_MAX_BODY,
+                                       health=self.health)
+                await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+                await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+            else:
+                poller = asyncio.create_task(self._poll(bot, stopping))
+            logger.info(f"多进程模式: {len(self.shards)} 个分片，入口为{'webhook' if WEBHOOK_URL else '长轮询'}")
+            await stopping.wait()
+            logger.info("收到退出信号，正在停止分片...")
+        finally:
+            if server is not None:
+                await server.stop()
+            if poller is not None:
+                poller.cancel()
+            # 先把已接收的更新转发完，再让分片进程处理完后退出
+            try:
+                await asyncio.wait_for(asyncio.gather(*(shard.queue.join() for shard in self.shards)),
+                                       timeout=self.stop_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("停止时仍有更新未转发给分片")
+            monitor.cancel()
+            if self._rolling is not None:
+                self._rolling.cancel()
+            await asyncio.gather(*(self._terminate(shard) for shard in self.shards))
+            for shard in self.shards:
+                shard.forwarder.cancel()
+            await self._client.aclose()
+            await bot.shutdown()
+            logger.info(f"分片统计: {self.health()}")
+
+
+def run_supervisor() -> None:
+    supervisor = ShardSupervisor(SHARD_WORKERS, SHARD_BASE_PORT, SHARD_QUEUE_MAX, SHARD_VNODES, SHARD_HEALTH_INTERVAL,
+                                 SHARD_HEALTH_FAILURES, SHARD_STOP_TIMEOUT)
+    asyncio.run(supervisor.run())
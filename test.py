@@ -4,12 +4,13 @@ from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
 import json
 
-from main import is_crisis_message, handle_message
+from main import is_crisis_message, handle_message, stream_reply
 from database import init_db, get_user, increment_daily_chat, add_warning, update_mental_scores, save_message, get_user_history, append_chat_log, update_chat_end_time, reset_all_daily_chats, get_worst_users, get_inactive_users, create_or_update_user
 from unittest.mock import Mock
 from config import VIOLATION_KEYWORDS, CRISIS_KEYWORDS
-from prompts import VIOLATION_CHECK_PROMPT, MENTAL_ASSESSMENT_PROMPT
-from ai_handler import get_ai_response
+from prompts import VIOLATION_CHECK_PROMPT
+from ai_handler import get_ai_response, get_ai_stream
+import httpx
 
 # 模拟Update和Context
 class MockUpdate(Mock):
@@ -42,6 +43,22 @@ class MockBot(Mock):
     async def send_chat_action(self, chat_id, action):
         print(f"模拟聊天动作 {action} 到 {chat_id}")
 
+class RecordingBot:
+    """记录发送和编辑操作的模拟 Bot"""
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.sent.append(text)
+        return MagicMock(message_id=len(self.sent), text=text)
+
+    async def edit_message_text(self, chat_id, message_id, text):
+        self.edits.append(text)
+
+    async def send_chat_action(self, chat_id, action):
+        pass
+
 async def test_database():
     print("测试数据库初始化...")
     init_db()
@@ -52,6 +69,29 @@ async def test_database():
     conn.close()
     print("数据库测试通过")
 
+async def test_history_migration():
+    print("测试历史索引迁移...")
+    import tempfile, os, database
+    path = os.path.join(tempfile.mkdtemp(), "legacy.db")
+    # 模拟旧版本 database.db：无索引、user_version = 0
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, role TEXT, content TEXT, timestamp TEXT)')
+    conn.executemany('INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+                     [(1, "user", f"消息{i}", "2024-01-01T00:00:00") for i in range(5)])
+    conn.commit()
+    conn.close()
+    with patch('database.DB_PATH', path):
+        init_db()
+        init_db()  # 重复执行应无副作用
+        conn = database.get_connection()
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(database.MIGRATIONS)
+        indexes = [row[1] for row in conn.execute("PRAGMA index_list('messages')")]
+        assert 'idx_messages_user_id_id' in indexes
+        # 时间戳相同时仍按插入顺序返回
+        assert [m['content'] for m in get_user_history(1, 3)] == ["消息2", "消息3", "消息4"]
+    database.close_connection()
+    print("历史索引迁移测试通过")
+
 async def test_user_management():
     print("测试用户管理...")
     user_id = 12345
@@ -62,6 +102,26 @@ async def test_user_management():
     assert user['is_banned'] == False
     print("用户管理测试通过")
 
+async def test_user_state():
+    print("测试用户状态写回...")
+    from database import load_user_state, save_user_state
+    user_id = 55555
+    state = load_user_state(user_id)
+    assert state.is_new and state.daily_chat_count == 0
+    save_user_state(state)
+    state = load_user_state(user_id)
+    assert not state.is_new and not state.dirty
+    state.daily_chat_count += 1
+    state.is_in_crisis = True
+    assert set(state.dirty) == {'daily_chat_count', 'is_in_crisis'}
+    # 其他写入不应被写回覆盖
+    update_mental_scores(user_id, 4.0, 2.0)
+    save_user_state(state)
+    user = get_user(user_id)
+    assert user['daily_chat_count'] == 1 and user['is_in_crisis'] is True
+    assert user['depression_score'] == 4.0
+    print("用户状态写回测试通过")
+
 async def test_chat_limit():
     print("测试聊天次数限制...")
     user_id = 54321
@@ -73,6 +133,120 @@ async def test_chat_limit():
             assert allowed == False
     print("聊天次数限制测试通过")
 
+async def test_atomic_counters():
+    print("测试原子计数...")
+    import threading
+    from config import WARNING_BAN_THRESHOLD
+    user_id = 54322
+    # 多线程（各自独立连接）并发累加，计数不能丢失
+    threads = [threading.Thread(target=lambda: [increment_daily_chat(user_id) for _ in range(20)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert get_user(user_id)['daily_chat_count'] == 80
+    for i in range(WARNING_BAN_THRESHOLD):
+        assert add_warning(user_id) == i + 1
+    assert get_user(user_id)['is_banned'] is True
+    # 拉黑后不再计数
+    assert increment_daily_chat(user_id) == False
+    assert get_user(user_id)['daily_chat_count'] == 80
+    print("原子计数测试通过")
+
+async def test_daily_quota():
+    print("测试按日期重置的每日次数...")
+    from zoneinfo import ZoneInfo
+    from database import get_connection, quota_day
+    from config import DAILY_CHAT_LIMIT
+    user_id = 12121
+    create_or_update_user(user_id)
+    yesterday = (datetime.now() - timedelta(days=1)).date().isoformat()
+    with get_connection() as conn:
+        conn.execute('UPDATE users SET daily_chat_count = ?, quota_day = ? WHERE user_id = ?', (DAILY_CHAT_LIMIT, yesterday, user_id))
+    # 昨天的次数已用完，今天第一条消息从 1 重新计数
+    assert increment_daily_chat(user_id) == True
+    assert get_user(user_id)['daily_chat_count'] == 1
+    assert increment_daily_chat(user_id) == True
+    assert get_user(user_id)['daily_chat_count'] == 2
+
+    # 冻结时间，并把"服务器本地时区"固定为 UTC：09:30 -> 10:30 跨过 UTC+14 时区的午夜，本地日期不变
+    from datetime import timezone
+    before = datetime(2026, 3, 1, 9, 30, tzinfo=timezone.utc)
+    after = before + timedelta(hours=1)
+    class FrozenDatetime(datetime):
+        current = before
+        @classmethod
+        def now(cls, tz=None):
+            return cls.current.astimezone(tz or timezone.utc).replace(tzinfo=tz)
+    with patch('database._QUOTA_TZ', ZoneInfo('Pacific/Kiritimati')), patch('database.datetime', FrozenDatetime):
+        assert quota_day() == "2026-03-01"
+        assert increment_daily_chat(user_id) and get_user(user_id)['daily_chat_count'] == 1
+        assert increment_daily_chat(user_id) and get_user(user_id)['daily_chat_count'] == 2
+        FrozenDatetime.current = after
+        assert quota_day() == "2026-03-02" and FrozenDatetime.now().date().isoformat() == "2026-03-01"
+        # 按 QUOTA_TIMEZONE 的日期重新计数，而不是服务器本地日期
+        assert increment_daily_chat(user_id) and get_user(user_id)['daily_chat_count'] == 1
+    print("按日期重置的每日次数测试通过")
+
+async def test_conversation_summary():
+    print("测试对话摘要与 token 预算...")
+    from context_builder import SummaryWorker, build_context, estimate_tokens
+    from database import get_summary
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("你好世界") == 4
+    assert estimate_tokens("hello world!") == 3
+    user_id = 13131
+    create_or_update_user(user_id)
+    for i in range(15):
+        save_message(user_id, "user", f"第{i}条用户消息")
+        save_message(user_id, "assistant", f"第{i}条回复")
+    worker = SummaryWorker(keep_recent=4, min_messages=6, max_messages=60, timeout=5)
+    prompts_seen = []
+    async def fake_response(messages, *args, **kwargs):
+        prompts_seen.append(messages[0]["content"])
+        return "用户最近工作压力很大。"
+    with patch('context_builder.get_ai_response', fake_response):
+        assert await worker.summarize(user_id) == True
+        # 新消息不足，不再调用模型
+        assert await worker.summarize(user_id) == False
+    assert len(prompts_seen) == 1 and "第0条用户消息" in prompts_seen[0] and "第13条回复" not in prompts_seen[0]
+    summary, last_id = get_summary(user_id)
+    assert summary == "用户最近工作压力很大。"
+    history = get_user_history(user_id, 20)
+    system_prompt, kept = build_context(user_id, history, "系统提示", budget=60)
+    assert "用户最近工作压力很大" in system_prompt
+    assert 0 < len(kept) < len(history) and kept[-1] == history[-1]
+    # 预算再小也保留最后一条消息
+    _, kept = build_context(user_id, history, "系统提示", budget=1)
+    assert kept == history[-1:]
+    # 读取数据库出错时只计入失败，后台任务继续处理后面的用户
+    import sqlite3
+    from database import get_unsummarized_messages
+    reads = []
+    def flaky_read(*args, **kwargs):
+        reads.append(args[0])
+        if len(reads) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return get_unsummarized_messages(*args, **kwargs)
+    with patch('context_builder.get_unsummarized_messages', flaky_read):
+        worker.start()
+        worker.submit(user_id)
+        worker.submit(13132)
+        for _ in range(100):
+            if len(reads) == 2:
+                break
+            await asyncio.sleep(0.01)
+        await worker.stop()
+    assert reads == [user_id, 13132] and worker.failed == 1
+    # 离开最近窗口但尚未摘要的消息补进上下文，不会丢失
+    for i in range(15, 17):
+        save_message(user_id, "user", f"第{i}条用户消息")
+        save_message(user_id, "assistant", f"第{i}条回复")
+    recent = get_user_history(user_id, 4)
+    _, kept = build_context(user_id, recent, "系统提示", keep_recent=4, max_gap=6)
+    assert [m['content'] for m in kept] == [f"第{i}条{kind}" for i in range(13, 17) for kind in ("用户消息", "回复")]
+    print("对话摘要测试通过")
+
 async def test_violation_detection():
     print("测试违规内容检测...")
     user_id = 67890
@@ -106,11 +280,103 @@ async def test_mental_assessment():
             assert user['anxiety_score'] == 3.0
     print("心理状态评估测试通过")
 
+async def test_history_cache():
+    print("测试历史消息缓存...")
+    from database import history_cache, invalidate_history_cache
+    user_id = 44444
+    create_or_update_user(user_id)
+    save_message(user_id, "user", "第一条")
+    first = get_user_history(user_id, 20)
+    misses = history_cache.misses
+    # 再次读取和写入后读取都应命中缓存
+    save_message(user_id, "assistant", "第二条")
+    history = get_user_history(user_id, 20)
+    assert history[-2:] == [{'role': 'user', 'content': '第一条'}, {'role': 'assistant', 'content': '第二条'}]
+    assert len(history) == len(first) + 1
+    assert history_cache.misses == misses
+    # /reset 后缓存失效，重新从数据库加载
+    invalidate_history_cache(user_id)
+    assert get_user_history(user_id, 20) == history
+    assert history_cache.misses == misses + 1
+    print("历史消息缓存测试通过")
+
+async def test_assessment_worker():
+    print("测试后台心理评估...")
+    from assessment_worker import AssessmentWorker, parse_json_object
+    assert parse_json_object('```json\n{"depression": 1, "anxiety": 2}\n```') == {"depression": 1, "anxiety": 2}
+    assert parse_json_object('评估结果：{"depression": 3, "anxiety": 4}。') == {"depression": 3, "anxiety": 4}
+    assert parse_json_object("无法评估") is None
+    worker = AssessmentWorker(max_queue=2, batch_size=2, timeout=5, alpha=0.5, min_chars=10, max_messages=20)
+    for user_id in (66661, 66662):
+        create_or_update_user(user_id)
+    save_message(66661, "user", "这周一直睡不好，工作压力特别大")
+    save_message(66661, "assistant", "听起来你很累")
+    save_message(66662, "user", "今天考试没考好，心里很乱也很难过")
+    calls = []
+    async def fake_response(messages, *args, **kwargs):
+        calls.append(messages[0]["content"])
+        return '结果如下 {"1": {"depression": 12, "anxiety": 3}, "2": {"depression": "2.5", "anxiety": 1}}'
+    with patch('assessment_worker.get_ai_response', fake_response):
+        assert worker.submit(66661)
+        assert worker.submit(66661)  # 合并
+        assert worker.submit(66662)
+        assert not worker.submit(66663)  # 队列已满
+        worker.start()
+        while worker.metrics()['queue_depth'] or worker.assessed < 2:
+            await asyncio.sleep(0.01)
+        await worker.stop()
+    assert len(calls) == 1 and "睡不好" in calls[0] and "首次评估" in calls[0]
+    assert get_user(66661)['depression_score'] == 10.0  # 超出范围的分数被截断
+    assert get_user(66662)['depression_score'] == 2.5
+    metrics = worker.metrics()
+    assert metrics['coalesced'] == 1 and metrics['dropped'] == 1 and metrics['batches'] == 1
+    # 增量评估：只发送上次评估之后的新消息和上次的分数，结果与上次的分数做 EWMA
+    from database import get_score_history
+    save_message(66661, "user", "好")
+    assert worker._prepare(66661) is None and worker.skipped == 1  # 新内容太少，留到下次
+    save_message(66661, "user", "今天和朋友聊了聊，感觉轻松了一些")
+    calls.clear()
+    async def fake_single(messages, *args, **kwargs):
+        calls.append(messages[0]["content"])
+        return '{"depression": 4, "anxiety": 2}'
+    with patch('assessment_worker.get_ai_response', fake_single):
+        await worker.run_batch([worker._prepare(66661)])
+    assert "轻松" in calls[0] and "睡不好" not in calls[0] and "抑郁 10.0" in calls[0]
+    assert get_user(66661)['depression_score'] == 7.0 and get_user(66661)['anxiety_score'] == 2.5
+    assert [row[1:] for row in get_score_history(66661)] == [(10.0, 3.0), (7.0, 2.5)]
+    assert worker._prepare(66661) is None  # 没有新消息
+    # 单个用户读取数据库失败时，同一批的其他用户照常评估，后台任务不退出
+    import sqlite3
+    from database import get_assessment_state
+    create_or_update_user(66663)
+    save_message(66663, "user", "最近总是很焦虑，晚上也睡不着觉")
+    def flaky_state(chat_id):
+        if chat_id == 66662:
+            raise sqlite3.OperationalError("database is locked")
+        return get_assessment_state(chat_id)
+    async def fake_first(messages, *args, **kwargs):
+        return '{"depression": 5, "anxiety": 6}'
+    failed = worker.failed
+    with patch('assessment_worker.get_ai_response', fake_first), patch('assessment_worker.get_assessment_state', flaky_state):
+        worker.start()
+        worker.submit(66662)
+        worker.submit(66663)
+        for _ in range(100):
+            if get_user(66663)['anxiety_score'] == 6.0:
+                break
+            await asyncio.sleep(0.01)
+        await worker.stop()
+    assert get_user(66663)['anxiety_score'] == 6.0 and worker.failed == failed + 1
+    print("后台心理评估测试通过")
+
 async def test_chat_log():
     print("测试聊天记录...")
     user_id = 22222
     create_or_update_user(user_id)
     append_chat_log(user_id, "user", "测试消息")
+    # 日志由后台线程批量写入，检查前先刷新
+    from log_writer import flush_chat_logs
+    assert flush_chat_logs(timeout=5)
     # 检查文件是否存在
     import os
     log_file = f"chat_logs/{user_id}.txt"
@@ -152,6 +418,543 @@ async def test_scheduler_functions():
     inactive = get_inactive_users(1)
     print("调度器函数测试通过")
 
+async def test_inactivity_sweep():
+    print("测试不活跃会话标记...")
+    from database import close_inactive_chats
+    stale = (datetime.now() - timedelta(minutes=30)).isoformat()
+    create_or_update_user(22221, last_message_time=stale)
+    create_or_update_user(22222, last_message_time=stale)
+    create_or_update_user(22223, last_message_time=datetime.now().isoformat())
+    assert close_inactive_chats(10, batch_size=1) >= 2  # 分多批完成
+    assert get_user(22221)['last_chat_end_time'] is not None
+    assert get_user(22223)['last_chat_end_time'] is None
+    assert close_inactive_chats(10) == 0
+    # 新消息重新开启会话，之后可以再次被标记结束
+    with patch('main.get_ai_response', return_value="嗯"):
+        await handle_message(MockUpdate(22221, "我又来了"), MockContext(RecordingBot()))  # type: ignore
+    assert get_user(22221)['last_chat_end_time'] is None
+    print("不活跃会话标记测试通过")
+
+async def test_outreach():
+    print("测试主动问候...")
+    from telegram.error import RetryAfter, Forbidden
+    from outreach import OutreachEngine
+    import main
+    ended = (datetime.now() - timedelta(hours=4)).isoformat()
+    for user_id in (11111, 11112, 11113):
+        create_or_update_user(user_id, last_message_time=ended, last_chat_end_time=ended)
+
+    class FlakyBot(RecordingBot):
+        def __init__(self):
+            super().__init__()
+            self.chats = []
+            self.limited = False
+        async def send_message(self, chat_id, text, parse_mode=None):
+            if chat_id == 11112 and not self.limited:
+                self.limited = True
+                raise RetryAfter(0)
+            if chat_id == 11113:
+                raise Forbidden("bot was blocked by the user")
+            self.chats.append(chat_id)
+
+    engine = OutreachEngine(4, 1000, 0.0, 3)
+    with patch('main.outreach_engine', engine), patch('main.OUTREACH_PAGE_SIZE', 1):
+        bot = FlakyBot()
+        await main.send_followup_greetings(bot)
+        assert {11111, 11112} <= set(bot.chats) and 11113 not in bot.chats
+        # 同一次会话不再重复问候，屏蔽机器人的用户也不再尝试
+        bot = FlakyBot()
+        await main.send_followup_greetings(bot)
+        assert not {11111, 11112, 11113} & set(bot.chats)
+        # 问候之后又有新的会话结束，可以再次问候
+        from database import get_connection
+        with get_connection() as conn:
+            conn.execute('UPDATE users SET last_followup_at = ? WHERE user_id = 11111', ((datetime.now() - timedelta(hours=5)).isoformat(),))
+        create_or_update_user(11111, last_chat_end_time=(datetime.now() - timedelta(hours=3, minutes=30)).isoformat())
+        await main.send_followup_greetings(bot)
+        assert 11111 in bot.chats
+    print("主动问候测试通过")
+
+async def test_scheduled_jobs():
+    print("测试定时任务...")
+    from telegram.ext import Application
+    from jobs import GuardedJob
+    import main
+    runs = []
+    async def slow_job(context):
+        runs.append(context)
+        await asyncio.sleep(0.05)
+    job = GuardedJob("slow", slow_job)
+    # 上一次未结束时跳过
+    await asyncio.gather(job("a"), job("b"))
+    assert runs == ["a"] and job.metrics()['runs'] == 1 and job.metrics()['skipped'] == 1
+    assert job.metrics()['duration']['max'] >= 0.05
+    # 所有任务注册到应用的 JobQueue
+    application = Application.builder().token("123:TEST").build()
+    main.schedule_jobs(application)
+    names = sorted(j.name for j in application.job_queue.jobs())
+    assert names == sorted(j.name for j in main.scheduled_jobs)
+    print("定时任务测试通过")
+
+async def test_risk_review():
+    print("测试风险复查...")
+    from database import get_risk_review, get_connection
+    since = datetime.now().isoformat()
+    for user_id, score in ((88881, 9.9), (88882, 9.8), (88883, 9.8), (88884, 9.7)):
+        update_mental_scores(user_id, score, score)
+    assert [w['user_id'] for w in get_worst_users(2)] == [88881, 88882]
+    # 分页：游标接续上一页，不重复不遗漏
+    pages, cursor = [], None
+    while True:
+        rows, cursor = get_risk_review(2, min_score=19.4, changed_since=since, cursor=cursor)
+        pages.append([row['user_id'] for row in rows])
+        if cursor is None:
+            break
+    assert pages[0] == [88881, 88882] and [u for page in pages for u in page] == [88881, 88882, 88883, 88884]
+    assert get_risk_review(10, changed_since=datetime.now().isoformat())[0] == []
+    plan = get_connection().execute('EXPLAIN QUERY PLAN SELECT user_id FROM users WHERE is_banned = 0 ORDER BY risk_score DESC, user_id LIMIT 3').fetchall()
+    assert 'idx_users_risk' in plan[0][-1]
+    print("风险复查测试通过")
+
+async def test_keyword_matcher():
+    print("测试关键词匹配器...")
+    from keyword_matcher import KeywordMatcher, KeywordMatch, reload_keywords, get_matcher
+    matcher = KeywordMatcher({"crisis": ["想死", "死"], "violation": ["打死", "色情"]})
+    # 一次扫描返回所有类别、重叠的命中及位置
+    assert matcher.find_all("气得想打死他") == [KeywordMatch("violation", "打死", 3, 5), KeywordMatch("crisis", "死", 4, 5)]
+    assert matcher.first("我想死", "crisis") == KeywordMatch("crisis", "想死", 1, 3)
+    assert not matcher.contains("今天天气不错")
+    # 与原来的逐词子串查找结果一致
+    for text in ["我想自杀", "今天天气不错", "撑不住了，再见", ""]:
+        assert get_matcher().contains(text, "crisis") == any(k in text for k in CRISIS_KEYWORDS)
+    try:
+        reload_keywords({"crisis": ["新词"]})
+        assert is_crisis_message("这是新词") and not is_crisis_message("我想自杀")
+    finally:
+        reload_keywords()
+    assert is_crisis_message("我想自杀")
+    print("关键词匹配器测试通过")
+
+async def test_violation_screen():
+    print("测试本地违规预筛...")
+    from unittest.mock import AsyncMock
+    from violation_screen import screen_message, VIOLATION, AMBIGUOUS, CLEAN
+    from prompts import VIOLATION_WARNING_MESSAGE
+    assert screen_message("今天天气不错").verdict == CLEAN
+    assert screen_message("给我发黄片").verdict == VIOLATION
+    assert screen_message("我想打死他").verdict == AMBIGUOUS
+    assert screen_message("气得我想找枪击的游戏玩").verdict == AMBIGUOUS  # 语境词降低分数
+    # 政治敏感等类别也交给模型复核
+    assert screen_message("我们一起去颠覆政权吧").verdict == AMBIGUOUS
+    assert screen_message("哪里能买到冰毒").verdict == AMBIGUOUS
+    # 明确违规时不调用模型
+    user_id = 77777
+    bot = RecordingBot()
+    ai = AsyncMock(return_value="你好")
+    from keyword_matcher import KeywordMatcher
+    scans = []
+    original_scan = KeywordMatcher._scan
+    def counting_scan(self, *args, **kwargs):
+        scans.append(args[0])
+        return original_scan(self, *args, **kwargs)
+    with patch('main.get_ai_response', ai), patch.object(KeywordMatcher, '_scan', counting_scan):
+        await handle_message(MockUpdate(user_id, "有没有成人内容"), MockContext(bot))  # type: ignore
+    ai.assert_not_called()
+    assert scans == ["有没有成人内容"]  # 危机检测和违规预筛共用一次扫描
+    assert bot.sent == [VIOLATION_WARNING_MESSAGE]
+    assert get_user(user_id)['warning_count'] == 1
+    print("本地违规预筛测试通过")
+
+async def test_crisis_deadline():
+    print("测试危机回复期限...")
+    import main
+    from prompts import CRISIS_FALLBACK_MESSAGES
+    async def slow_ai(history, system_prompt=None, max_tokens=None, lane=None):
+        await asyncio.sleep(0.2)
+        return "我在这里陪着你"
+    user_id = 44445
+    create_or_update_user(user_id, is_in_crisis=True)
+    bot = RecordingBot()
+    before = main.crisis_first_reply_latency.count
+    with patch('main.get_ai_response', slow_ai), patch('main.CRISIS_REPLY_DEADLINE', 0.05):
+        await handle_message(MockUpdate(user_id, "我好难受"), MockContext(bot))  # type: ignore
+    # 先发送预置消息，模型回复到达后仍然投递
+    assert bot.sent[0] in CRISIS_FALLBACK_MESSAGES and bot.sent[1:] == ["我在这里陪着你"]
+    assert main.crisis_first_reply_latency.count == before + 1
+    assert main.crisis_first_reply_latency.percentile(100) < 0.2
+    # 模型及时回复时不发送预置消息
+    bot = RecordingBot()
+    with patch('main.get_ai_response', slow_ai), patch('main.CRISIS_REPLY_DEADLINE', 1.0):
+        await handle_message(MockUpdate(user_id, "我好难受"), MockContext(bot))  # type: ignore
+    assert bot.sent == ["我在这里陪着你"]
+    print("危机回复期限测试通过")
+
+async def test_update_processor():
+    print("测试并发更新处理...")
+    from update_processor import ChatOrderedUpdateProcessor
+    processor = ChatOrderedUpdateProcessor(8)
+    events = []
+    async def handle(chat_id, n, delay):
+        events.append(("start", chat_id, n))
+        await asyncio.sleep(delay)
+        events.append(("end", chat_id, n))
+    updates = [(1, 1, 0.05), (1, 2, 0.01), (2, 1, 0.01), (1, 3, 0.0)]
+    await asyncio.gather(*[
+        processor.process_update(MockUpdate(chat_id, "x"), handle(chat_id, n, delay))
+        for chat_id, n, delay in updates
+    ])
+    # 同一聊天严格按顺序、不重叠
+    chat1 = [e for e in events if e[1] == 1]
+    assert chat1 == [("start", 1, 1), ("end", 1, 1), ("start", 1, 2), ("end", 1, 2), ("start", 1, 3), ("end", 1, 3)]
+    # 不同聊天并行：聊天 2 不必等聊天 1 的第一条完成
+    assert events.index(("end", 2, 1)) < events.index(("end", 1, 1))
+    metrics = processor.metrics()
+    assert metrics['processed'] == 4 and metrics['chats_in_flight'] == 0 and metrics['waiting_for_chat'] == 0
+    assert metrics['chat_wait']['max'] >= 0.05
+
+    # 单个聊天堆积的消息只占一个名额，不挡住其他聊天
+    processor = ChatOrderedUpdateProcessor(2)
+    events.clear()
+    burst = [processor.process_update(MockUpdate(1, "x"), handle(1, n, 0.02)) for n in range(10)]
+    other = processor.process_update(MockUpdate(2, "x"), handle(2, 1, 0.0))
+    await asyncio.gather(*burst, other)
+    assert events.index(("end", 2, 1)) < events.index(("end", 1, 1))
+    assert processor.metrics()['processed'] == 11 and processor.metrics()['chats_in_flight'] == 0
+    print("并发更新处理测试通过")
+
+async def test_burst_coalescing():
+    print("测试连续消息合并...")
+    from burst_coalescer import burst_coalescer
+    from prompts import CRISIS_STEP_1_MESSAGE
+    calls = []
+    async def slow_ai(history, system_prompt=None, max_tokens=None, lane=None):
+        calls.append(history[-1]["content"])
+        await asyncio.sleep(0.2)
+        return "我在听"
+    user_id = 66666
+    bot = RecordingBot()
+    with patch('main.get_ai_response', slow_ai), patch('main.BURST_DEBOUNCE_SECONDS', 0.05), \
+         patch.object(burst_coalescer, 'window', 0.05):
+        await handle_message(MockUpdate(user_id, "我"), MockContext(bot))  # type: ignore
+        await handle_message(MockUpdate(user_id, "今天"), MockContext(bot))  # type: ignore
+        await asyncio.sleep(0.1)  # 开始生成回复
+        await handle_message(MockUpdate(user_id, "好累"), MockContext(bot))  # type: ignore  # 取消正在进行的生成
+        await asyncio.sleep(0.4)
+        assert calls == ["我\n今天", "我\n今天\n好累"]
+        assert bot.sent == ["我在听"]
+        # 每条消息单独保存
+        assert [m["content"] for m in get_user_history(user_id, 4)] == ["我", "今天", "好累", "我在听"]
+        assert burst_coalescer.metrics()['cancelled_generations'] >= 1
+
+        # 危机关键词不等待合并，并取消尚未发出的回复
+        user_id = 66667
+        bot = RecordingBot()
+        calls.clear()
+        await handle_message(MockUpdate(user_id, "睡不着"), MockContext(bot))  # type: ignore
+        await handle_message(MockUpdate(user_id, "我想自杀"), MockContext(bot))  # type: ignore
+        assert bot.sent[0] == CRISIS_STEP_1_MESSAGE
+        await asyncio.sleep(0.3)
+        assert calls == [] and len(bot.sent) == 2
+    print("连续消息合并测试通过")
+
+async def test_admission_control():
+    print("测试模型调用准入控制...")
+    from admission import AdmissionController, AdmissionRejected, CRISIS, NORMAL, BACKGROUND
+    controller = AdmissionController(1, 0, 1, {CRISIS: None, NORMAL: 1.0, BACKGROUND: 0.05})
+    order = []
+    async def call(lane, hold):
+        async with controller.slot(lane):
+            order.append(lane)
+            await asyncio.sleep(hold)
+    first = asyncio.create_task(call(NORMAL, 0.1))
+    await asyncio.sleep(0)
+    # 名额被占用时，后台任务排队超时被放弃，危机请求先于普通请求放行
+    results = await asyncio.gather(call(BACKGROUND, 0), call(NORMAL, 0), call(CRISIS, 0), return_exceptions=True)
+    await first
+    assert isinstance(results[0], AdmissionRejected)
+    assert order == [NORMAL, CRISIS, NORMAL]
+    metrics = controller.metrics()
+    assert metrics['active'] == 0 and metrics['rejected'][BACKGROUND] == 1 and metrics['admitted'][CRISIS] == 1
+
+    # 令牌桶限速：容量 1、每秒 20 个，第三个请求至少等待约 0.1 秒
+    controller = AdmissionController(10, 20, 1, {NORMAL: None})
+    started = asyncio.get_running_loop().time()
+    await asyncio.gather(*[call(NORMAL, 0) for _ in range(3)])
+    assert asyncio.get_running_loop().time() - started >= 0.09
+
+    # 多进程时各分片均分上限
+    controller = AdmissionController(20, 10, 10, {})
+    controller.share(4)
+    assert controller.max_concurrent == 5 and controller.rate == 2.5 and controller.burst == 2
+    controller = AdmissionController(2, 0, 1, {})
+    controller.share(4)
+    assert controller.max_concurrent == 1 and controller.rate == 0 and controller.burst == 1
+
+    # 普通回复排队超时时快速回复，不调用模型
+    from prompts import OVERLOAD_MESSAGE
+    bot = RecordingBot()
+    async def rejected(*args, **kwargs):
+        raise AdmissionRejected(NORMAL, 8.0)
+    with patch('main.get_ai_response', rejected):
+        await handle_message(MockUpdate(55556, "你好"), MockContext(bot))  # type: ignore
+    assert bot.sent == [OVERLOAD_MESSAGE]
+    print("模型调用准入控制测试通过")
+
+async def test_webhook_server():
+    print("测试 webhook 接收...")
+    from telegram import Update
+    from webhook_server import WebhookServer, SECRET_HEADER
+    received = []
+    release = asyncio.Event()
+    async def handler(data):
+        update = Update.de_json(data, None)
+        received.append((update.update_id, update.effective_chat.id, update.message.text))
+        if update.message.text == "慢":
+            await release.wait()
+    server = WebhookServer(handler, "s3cret", "/telegram", max_pending=2, max_body=4096)
+    await server.start("127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.port}/telegram"
+    def fake_update(update_id, text):
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": 88991, "type": "private"}, "from": {"id": 88991, "is_bot": False, "first_name": "测试"}}}
+    async with httpx.AsyncClient() as client:
+        ok = {SECRET_HEADER: "s3cret"}
+        assert (await client.post(url, json=fake_update(1, "你好"))).status_code == 403
+        assert (await client.post(url, json=fake_update(1, "你好"), headers={SECRET_HEADER: "wrong"})).status_code == 403
+        assert (await client.post(url, content=b"not json", headers=ok)).status_code == 400
+        assert (await client.post(url.replace("/telegram", "/other"), json={}, headers=ok)).status_code == 404
+        assert (await client.get(url)).status_code == 405
+        assert (await client.post(url, content=b"x" * 5000, headers=ok)).status_code == 413
+        # 确认在处理完成之前返回；积压达到上限后返回 503
+        assert (await client.post(url, json=fake_update(2, "慢"), headers=ok)).status_code == 200
+        assert (await client.post(url, json=fake_update(3, "慢"), headers=ok)).status_code == 200
+        response = await client.post(url, json=fake_update(4, "第三条"), headers=ok)
+        assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+        release.set()
+        while server.in_flight:
+            await asyncio.sleep(0.01)
+        assert (await client.post(url, json=fake_update(4, "第三条"), headers=ok)).status_code == 200
+    await server.stop()
+    assert [r[0] for r in received] == [2, 3, 4] and received[0][1] == 88991
+    metrics = server.metrics()
+    assert metrics['accepted'] == 3 and metrics['rejected'] == 1 and metrics['unauthorized'] == 2
+    assert metrics['processed'] == 3 and metrics['max_in_flight'] == 2
+    print("webhook 接收测试通过")
+
+async def test_shard_routing():
+    print("测试多进程分片路由...")
+    from shards import HashRing, ShardSupervisor, chat_id_of
+    from webhook_server import WebhookServer
+    # 一致性哈希：分布均匀，增加一个分片时只有少量聊天换分片
+    ring4, ring5 = HashRing(4, 64), HashRing(5, 64)
+    counts = [0] * 4
+    moved = 0
+    for chat_id in range(10000):
+        counts[ring4.shard_for(chat_id)] += 1
+        moved += ring4.shard_for(chat_id) != ring5.shard_for(chat_id)
+    assert min(counts) > 1500 and moved < 3500
+    assert chat_id_of({"update_id": 1, "message": {"chat": {"id": 42}}}) == 42
+    assert chat_id_of({"update_id": 1, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": 43}}}}) == 43
+    assert chat_id_of({"update_id": 1, "inline_query": {"from": {"id": 7}}}) == 7
+    assert chat_id_of({"update_id": 1}) is None
+
+    # 用本进程内的 webhook 服务代替分片进程
+    supervisor = ShardSupervisor(2, 0, queue_size=100, vnodes=64, health_interval=1, health_failures=3,
+                                 stop_timeout=5, secret="internal")
+    received = {0: [], 1: []}
+    workers = []
+    for shard in supervisor.shards:
+        async def handler(data, index=shard.index):
+            await asyncio.sleep(0.005)
+            received[index].append((data["message"]["chat"]["id"], data["update_id"]))
+        # 积压上限为 1：转发会收到 503 并按顺序重试
+        worker = WebhookServer(handler, "internal", "/telegram", max_pending=1, max_body=4096,
+                               health=lambda index=shard.index: {'shard': index})
+        workers.append(worker)
+    await workers[0].start("127.0.0.1", 0)
+    supervisor.shards[0].url = f"http://127.0.0.1:{workers[0].port}"
+    supervisor.shards[1].url = "http://127.0.0.1:1"  # 分片 1 尚未启动：转发等待重试
+    supervisor.start_forwarding()
+    chats = [88901, 88902, 88903, 88904, 88905, 88906]
+    update_id = 0
+    for _ in range(5):
+        for chat_id in chats:
+            update_id += 1
+            await supervisor.route({"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": "hi"}})
+    await asyncio.sleep(0.2)
+    await workers[1].start("127.0.0.1", 0)
+    supervisor.shards[1].url = f"http://127.0.0.1:{workers[1].port}"
+    await asyncio.wait_for(asyncio.gather(*(shard.queue.join() for shard in supervisor.shards)), timeout=10)
+    for worker in workers:
+        await worker.stop()
+    for index, items in received.items():
+        for chat_id, _ in items:
+            assert supervisor.ring.shard_for(chat_id) == index
+    for chat_id in chats:
+        ids = [u for index in received for c, u in received[index] if c == chat_id]
+        assert len(ids) == 5 and ids == sorted(ids)  # 同一聊天按顺序处理
+    assert all(received.values())  # 两个分片都有聊天
+    assert supervisor.routed == 30 and sum(s.forwarded for s in supervisor.shards) == 30
+    assert sum(s.retries for s in supervisor.shards) > 0
+
+    # 端口上是 secret 不同的遗留进程：不丢弃更新，重启分片后重试
+    restarted = []
+    async def fake_restart(shard, reason):
+        restarted.append((shard.index, reason))
+        workers[0].secret_token = "internal"  # 新启动的分片
+    stale = supervisor.shards[0]
+    workers[0].secret_token = "stale"
+    await workers[0].start("127.0.0.1", 0)
+    stale.url = f"http://127.0.0.1:{workers[0].port}"
+    chat_id = next(c for c in range(88907, 89000) if supervisor.ring.shard_for(c) == 0)
+    with patch.object(supervisor, 'restart', fake_restart):
+        await supervisor.route({"update_id": 31, "message": {"chat": {"id": chat_id}, "text": "hi"}})
+        await asyncio.wait_for(stale.queue.join(), timeout=5)
+    await workers[0].stop()
+    assert restarted == [(0, "分片拒绝转发请求 (HTTP 403)")] and received[0][-1] == (chat_id, 31)
+
+    # 健康检查即心跳
+    await workers[0].start("127.0.0.1", 0)
+    supervisor.shards[0].url = f"http://127.0.0.1:{workers[0].port}"
+    assert await supervisor.check_health(supervisor.shards[0])
+    # 不带 secret token 的健康检查被拒绝
+    async with httpx.AsyncClient() as client:
+        assert (await client.get(supervisor.shards[0].url + "/health")).status_code == 403
+    assert supervisor.shards[0].last_report['shard'] == 0 and supervisor.shards[0].last_heartbeat
+    assert not await supervisor.check_health(supervisor.shards[1])
+    report = supervisor.health()['shards']
+    assert report[0]['worker']['shard'] == 0 and report[1]['heartbeat_age'] is None
+    await workers[0].stop()
+
+    # 滚动重启进行中再次收到 SIGHUP 时忽略
+    rolls = []
+    async def slow_rolling_restart():
+        rolls.append(1)
+        await asyncio.sleep(0.05)
+    with patch.object(supervisor, 'rolling_restart', slow_rolling_restart):
+        supervisor.request_rolling_restart()
+        supervisor.request_rolling_restart()
+        await supervisor._rolling
+        supervisor.request_rolling_restart()
+        await supervisor._rolling
+    assert rolls == [1, 1]
+
+    # 分片进程缩短等待写锁的超时
+    from database import set_busy_timeout, get_connection
+    from config import DB_BUSY_TIMEOUT
+    set_busy_timeout(0.5)
+    assert get_connection().execute('PRAGMA busy_timeout').fetchone()[0] == 500
+    set_busy_timeout(DB_BUSY_TIMEOUT)
+    assert get_connection().execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+    for shard in supervisor.shards:
+        shard.forwarder.cancel()
+    await supervisor._client.aclose()
+    print("多进程分片路由测试通过")
+
+async def test_ai_client():
+    print("测试异步 AI 客户端...")
+    def handler(request):
+        body = json.loads(request.content)
+        if body.get("stream"):
+            sse = 'data: {"choices": [{"delta": {"content": "你好"}}]}\n\ndata: {"choices": [{"delta": {"content": "。"}}]}\n\ndata: [DONE]\n\n'
+            return httpx.Response(200, text=sse, headers={"Content-Type": "text/event-stream"})
+        return httpx.Response(200, json={"choices": [{"message": {"content": "你好。"}}]})
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with patch('ai_handler._get_client', return_value=client):
+        # 并发请求不应互相阻塞
+        results = await asyncio.gather(*[get_ai_response([{"role": "user", "content": "hi"}]) for _ in range(5)])
+        assert results == ["你好。"] * 5
+        chunks = [chunk async for chunk in get_ai_stream([{"role": "user", "content": "hi"}])]
+        assert "".join(chunks) == "你好。"
+    await client.aclose()
+    print("异步 AI 客户端测试通过")
+
+async def test_model_hedging():
+    print("测试对冲请求与模型熔断...")
+    from model_router import ModelRouter
+    calls = []
+    async def handler(request):
+        body = json.loads(request.content)
+        model = body["model"]
+        calls.append(model)
+        if model == "slow":
+            await asyncio.sleep(1.0)
+        if model == "broken":
+            return httpx.Response(500)
+        if body.get("stream"):
+            sse = 'data: {"choices": [{"delta": {"content": "来自 %s"}}]}\n\ndata: [DONE]\n\n' % model
+            return httpx.Response(200, text=sse, headers={"Content-Type": "text/event-stream"})
+        return httpx.Response(200, json={"choices": [{"message": {"content": f"来自 {model}"}}]})
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    router = ModelRouter(["slow", "fast"], 0.2, 0.1, 0.05, 1.0, 3, 60.0)
+    with patch('ai_handler._get_client', return_value=client), patch('ai_handler.model_router', router):
+        # 首选模型超过对冲延迟未返回，备选模型先返回
+        started = asyncio.get_running_loop().time()
+        assert await get_ai_response([{"role": "user", "content": "hi"}]) == "来自 fast"
+        assert asyncio.get_running_loop().time() - started < 0.5
+        assert router.hedges == 1 and router.hedge_wins == 1
+        assert router.health["fast"].ewma is not None and router.health["slow"].ewma is None
+        await asyncio.sleep(0.01)
+        # 被取消的首选请求以已等待的时间作为延迟下界计入 p95（约为对冲延迟 0.1 秒，计时起点略晚于对冲计时）
+        assert router.health["slow"].latency.samples == 1 and router.health["slow"].latency.percentile(95) >= 0.09
+
+    from admission import AdmissionController
+    router = ModelRouter(["slow", "fast"], 0.2, 0.1, 0.05, 1.0, 3, 60.0)
+    limited = AdmissionController(1, 0, 1, {})
+    with patch('ai_handler._get_client', return_value=client), patch('ai_handler.model_router', router), \
+            patch('ai_handler.admission', limited):
+        # 没有空闲名额时不对冲，继续等待首选模型
+        assert await get_ai_response([{"role": "user", "content": "hi"}]) == "来自 slow"
+        assert router.hedges == 0 and router.hedges_skipped == 1 and limited.active == 0
+    # 新的路由器：上面等满 1 秒的首选请求会把对冲延迟推到上限，与首选模型返回的时间相同
+    router = ModelRouter(["slow", "fast"], 0.2, 0.1, 0.05, 1.0, 3, 60.0)
+    roomy = AdmissionController(2, 0, 2, {})
+    with patch('ai_handler._get_client', return_value=client), patch('ai_handler.model_router', router), \
+            patch('ai_handler.admission', roomy):
+        assert await get_ai_response([{"role": "user", "content": "hi"}]) == "来自 fast"
+        await asyncio.sleep(0.01)
+        assert router.hedges == 1 and roomy.active == 0 and sum(roomy.admitted.values()) == 2
+
+    router = ModelRouter(["broken", "fast"], 0.2, 5.0, 0.05, 5.0, 2, 60.0)
+    with patch('ai_handler._get_client', return_value=client), patch('ai_handler.model_router', router):
+        # 首选模型失败时立即改用备选，连续失败后被熔断跳过
+        for _ in range(2):
+            assert await get_ai_response([{"role": "user", "content": "hi"}]) == "来自 fast"
+        assert router.candidates() == ["fast"]
+        calls.clear()
+        assert await get_ai_response([{"role": "user", "content": "hi"}]) == "来自 fast"
+        assert calls == ["fast"]
+        # 流式请求在第一个 chunk 之前失败同样改用备选模型
+        router.health["broken"].open_until = 0.0
+        assert [chunk async for chunk in get_ai_stream([{"role": "user", "content": "hi"}])] == ["来自 fast"]
+        assert router.fallbacks == 3
+    router = ModelRouter(["broken"], 0.2, 5.0, 0.05, 5.0, 2, 60.0)
+    with patch('ai_handler._get_client', return_value=client), patch('ai_handler.model_router', router):
+        # 最后一个候选失败时没有可改用的模型，不计入 fallbacks
+        assert [chunk async for chunk in get_ai_stream([{"role": "user", "content": "hi"}])] == []
+        assert router.fallbacks == 0
+    await client.aclose()
+    print("对冲请求与模型熔断测试通过")
+
+async def test_stream_reply():
+    print("测试流式回复...")
+    async def fake_stream(history, system_prompt=None, max_tokens=None, lane=None):
+        for chunk in ["我听到", "了。你现在", "感觉怎么样？", "慢慢说"]:
+            yield chunk
+    with patch('main.get_ai_stream', fake_stream), patch('main.STREAM_EDIT_INTERVAL', 0):
+        with patch('main.STREAM_REPLY_MODE', 'split'):
+            bot = RecordingBot()
+            text = await stream_reply(bot, 1, [], "")
+            assert bot.sent == ["我听到了。", "你现在感觉怎么样？", "慢慢说"]
+            assert text == "我听到了。你现在感觉怎么样？慢慢说"
+        with patch('main.STREAM_REPLY_MODE', 'edit'):
+            bot = RecordingBot()
+            await stream_reply(bot, 1, [], "")
+            assert bot.sent == ["我听到了。"]
+            assert bot.edits[-1] == "我听到了。你现在感觉怎么样？慢慢说"
+    print("流式回复测试通过")
+
 async def test_bot_simulation():
     print("测试Bot模拟...")
     mock_update = MockUpdate(99999, "hello")
@@ -167,12 +970,34 @@ async def test_bot_simulation():
 
 async def main_test():
     await test_database()
+    await test_history_migration()
     await test_user_management()
+    await test_user_state()
     await test_chat_limit()
+    await test_atomic_counters()
+    await test_daily_quota()
     await test_violation_detection()
     await test_mental_assessment()
+    await test_history_cache()
+    await test_assessment_worker()
+    await test_conversation_summary()
     await test_chat_log()
     await test_crisis_detection()
+    await test_inactivity_sweep()
+    await test_outreach()
+    await test_scheduled_jobs()
+    await test_risk_review()
+    await test_keyword_matcher()
+    await test_violation_screen()
+    await test_crisis_deadline()
+    await test_update_processor()
+    await test_burst_coalescing()
+    await test_admission_control()
+    await test_webhook_server()
+    await test_shard_routing()
+    await test_ai_client()
+    await test_model_hedging()
+    await test_stream_reply()
     await test_scheduler_functions()
     await test_bot_simulation()
     print("所有测试通过！")
@@ -0,0 +1,96 @@
+# update_processor.py
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+def _chat_id_of(update: object) -> Optional[int]:
+    chat = getattr(update, 'effective_chat', None)
+    return getattr(chat, 'id', None)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """并发处理更新：不同聊天并行，同一聊天按到达顺序逐条处理
+
+    先排队等待本聊天的锁，拿到锁后才占用全局并发名额，因此每个聊天最多占一个名额，
+    单个聊天堆积大量消息时不会挤占其他聊天。
+    """
+
+    def __init__(self, max_concurrent_updates: int, log_every: int = 500):
+        super().__init__(max_concurrent_updates)
+        self.log_every = log_every
+        # chat_id -> [锁, 正在使用或等待该锁的更新数]
+        self._chat_locks: Dict[int, list] = {}
+        self.active = 0
+        self.waiting = 0
+        self.processed = 0
+        self.chat_wait = LatencyStats()
+        self.run_time = LatencyStats()
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:  # type: ignore[misc]
+        # 基类在调用 do_process_update 前就占用全局信号量；这里先取聊天锁再交给基类，
+        # 避免同一聊天排队等锁的更新各自占着一个名额
+        chat_id = _chat_id_of(update)
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            # asyncio.Lock 按等待顺序唤醒，保证同一聊天的处理顺序
+            try:
+                await entry[0].acquire()
+            finally:
+                self.waiting -= 1
+            try:
+                self.chat_wait.record(time.monotonic() - queued_at)
+                await super().process_update(update, coroutine)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await self._run(coroutine)
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        self.active += 1
+        started = time.monotonic()
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+            self.run_time.record(time.monotonic() - started)
+            if self.processed % self.log_every == 0:
+                logger.info(f"更新处理统计: {self.metrics()}")
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'max_concurrent': self.max_concurrent_updates,
+            'active': self.active,
+            'waiting_for_chat': self.waiting,
+            'chats_in_flight': len(self._chat_locks),
+            'processed': self.processed,
+            'chat_wait': self.chat_wait.snapshot(),
+            'run_time': self.run_time.snapshot(),
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        logger.info(f"更新处理统计: {self.metrics()}")
@@ -0,0 +1,64 @@
+# violation_screen.py
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+from config import (
+    VIOLATION_KEYWORD_WEIGHTS, VIOLATION_DEFAULT_WEIGHT, VIOLATION_BLOCK_SCORE, VIOLATION_CONTEXT_DISCOUNT,
+)
+from keyword_matcher import KeywordMatch, get_matcher
+
+logger = logging.getLogger(__name__)
+
+# 预筛结论
+VIOLATION = "violation"  # 明确违规：本地警告，不调用模型
+AMBIGUOUS = "ambiguous"  # 命中关键词但不确定：交给模型判断
+CLEAN = "clean"  # 未命中：无需模型做违规检查
+
+
+class ScreenResult(NamedTuple):
+    verdict: str
+    score: float
+    matches: List[KeywordMatch]
+
+
+class ScreenStats:
+    """统计预筛结论，用于衡量节省的模型调用"""
+
+    def __init__(self, log_every: int = 100):
+        self.log_every = log_every
+        self.counts = {VIOLATION: 0, AMBIGUOUS: 0, CLEAN: 0}
+        self._lock = threading.Lock()
+
+    def record(self, verdict: str) -> None:
+        with self._lock:
+            self.counts[verdict] += 1
+            total = sum(self.counts.values())
+        if total % self.log_every == 0:
+            logger.info(f"违规预筛统计: {self.snapshot()}")
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.counts, 'llm_calls_saved': self.counts[VIOLATION]}
+
+
+screen_stats = ScreenStats()
+
+
+def screen_message(text: str, matches: Optional[List[KeywordMatch]] = None) -> ScreenResult:
+    """按关键词权重和语境给消息打分，返回预筛结论；matches 为调用方已经扫描得到的全部命中"""
+    if matches is None:
+        matches = get_matcher().find_all(text)
+    hits = {m.keyword for m in matches if m.category == "violation"}
+    if not hits:
+        result = ScreenResult(CLEAN, 0.0, [])
+    else:
+        score = sum(VIOLATION_KEYWORD_WEIGHTS.get(word, VIOLATION_DEFAULT_WEIGHT) for word in hits)
+        context = {m.keyword for m in matches if m.category == "violation_context"}
+        score -= VIOLATION_CONTEXT_DISCOUNT * len(context)
+        verdict = VIOLATION if score >= VIOLATION_BLOCK_SCORE else AMBIGUOUS
+        result = ScreenResult(verdict, score, [m for m in matches if m.category.startswith("violation")])
+    screen_stats.record(result.verdict)
+    if result.verdict != CLEAN:
+        logger.info(f"违规预筛: {result.verdict} (分数 {result.score:.1f}, 命中 {sorted(hits)}), 累计 {screen_stats.snapshot()}")
+    return result
@@ -0,0 +1,241 @@
+# webhook_server.py
+import asyncio
+import hmac
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+HEALTH_PATH = '/health'
+
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+    408: 'Request Timeout', 411: 'Length Required', 413: 'Payload Too Large', 431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable',
+}
+
+
+class WebhookServer:
+    """接收 Telegram webhook 的本地 HTTP 服务
+
+    校验 secret token 后立即返回 200，更新交给后台任务调用 handler 处理；
+    已接收但尚未处理完的更新最多 max_pending 条，超出时返回 503，Telegram 会稍后重发。
+    GET /health 返回统计信息（JSON），health 提供的字段会一并返回；监听地址可能对外，
+    因此同样要求带上 secret token 请求头。
+    """
+
+    def __init__(self, handler: Callable[[dict], Awaitable[Any]], secret_token: str, path: str,
+                 max_pending: int, max_body: int, idle_timeout: float = 75.0, retry_after: int = 1,
+                 health: Optional[Callable[[], Dict[str, object]]] = None):
+        self.handler = handler
+        self.health = health
+        self.secret_token = secret_token
+        self.path = path
+        self.max_pending = max(1, max_pending)
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout
+        self.retry_after = retry_after
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks: Set[asyncio.Task] = set()
+        # 正在等待下一个请求的长连接，停止时直接关闭
+        self._idle: Set[asyncio.StreamWriter] = set()
+        self._connections: Set[asyncio.Task] = set()
+        self._closing = False
+        self.accepted = 0
+        self.rejected = 0
+        self.unauthorized = 0
+        self.bad_requests = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_in_flight = 0
+        self.ack_time = LatencyStats()
+        self.process_time = LatencyStats()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    @property
+    def port(self) -> Optional[int]:
+        """实际监听的端口（port=0 时由系统分配）"""
+        if self._server is None or not self._server.sockets:
+            return None
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str, port: int) -> None:
+        self._closing = False
+        self._server = await asyncio.start_server(self._serve_connection, host, port)
+        logger.info(f"Webhook 服务监听 {host}:{self.port}{self.path}")
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        """停止接收新请求，并等待已接收的更新处理完"""
+        self._closing = True
+        for writer in list(self._idle):
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning(f"Webhook 停止时仍有 {len(pending)} 条更新未处理完，已取消")
+        if self._connections:
+            # 等待各连接写完最后一个响应后退出
+            _, pending = await asyncio.wait(set(self._connections), timeout=1.0)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        logger.info(f"Webhook 统计: {self.metrics()}")
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'unauthorized': self.unauthorized,
+            'bad_requests': self.bad_requests,
+            'processed': self.processed,
+            'failed': self.failed,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'ack_time': self.ack_time.snapshot(),
+            'process_time': self.process_time.snapshot(),
+        }
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Telegram 会复用连接，同一连接上依次处理多个请求
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not self._closing:
+                self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 431, keep_alive=False)
+                    return
+                finally:
+                    self._idle.discard(writer)
+                started = time.monotonic()
+                keep_alive = await self._handle_request(head, reader, writer)
+                self.ack_time.record(time.monotonic() - started)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_request(self, head: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """处理一个请求并写回响应，返回连接是否可以继续使用"""
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            self.bad_requests += 1
+            await self._respond(writer, 400, keep_alive=False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1' and not self._closing
+
+        length = headers.get('content-length')
+        if method == 'GET' and target.split('?', 1)[0] == HEALTH_PATH:
+            if not self._authorized(headers):
+                self.unauthorized += 1
+                await self._respond(writer, 403, keep_alive)
+                return keep_alive
+            report = {'webhook': self.metrics(), **(self.health() if self.health else {})}
+            await self._respond(writer, 200, keep_alive, body=json.dumps(report).encode(),
+                                content_type='application/json')
+            return keep_alive
+        if method != 'POST':
+            await self._respond(writer, 405 if target.split('?', 1)[0] == self.path else 404, keep_alive=False)
+            return False
+        if length is None or not length.isdigit():
+            self.bad_requests += 1
+            await self._respond(writer, 411, keep_alive=False)
+            return False
+        if int(length) > self.max_body:
+            self.bad_requests += 1
+            await self._respond(writer, 413, keep_alive=False)
+            return False
+        try:
+            body = await asyncio.wait_for(reader.readexactly(int(length)), timeout=self.idle_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+
+        if target.split('?', 1)[0] != self.path:
+            await self._respond(writer, 404, keep_alive)
+            return keep_alive
+        if not self._authorized(headers):
+            self.unauthorized += 1
+            logger.warning("Webhook 请求的 secret token 不匹配，已拒绝")
+            await self._respond(writer, 403, keep_alive)
+            return keep_alive
+        try:
+            update = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            update = None
+        if not isinstance(update, dict):
+            self.bad_requests += 1
+            await self._respond(writer, 400, keep_alive)
+            return keep_alive
+        if not self.submit(update):
+            # 背压：返回非 2xx 时 Telegram 会稍后重发该更新
+            await self._respond(writer, 503, keep_alive, extra_headers=f'Retry-After: {self.retry_after}\r\n')
+            return keep_alive
+        await self._respond(writer, 200, keep_alive)
+        return keep_alive
+
+    def _authorized(self, headers: Dict[str, str]) -> bool:
+        return hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), self.secret_token.encode())
+
+    def submit(self, update: dict) -> bool:
+        """把更新交给后台处理，积压已满时返回 False"""
+        if len(self._tasks) >= self.max_pending:
+            self.rejected += 1
+            if self.rejected % 100 == 1:
+                logger.warning(f"Webhook 积压已满 ({self.max_pending})，返回 503")
+            return False
+        self.accepted += 1
+        # 按到达顺序创建任务，更新处理器据此保证同一聊天的处理顺序
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.max_in_flight = max(self.max_in_flight, len(self._tasks))
+        return True
+
+    async def _process(self, update: dict) -> None:
+        started = time.monotonic()
+        try:
+            await self.handler(update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"处理 webhook 更新 {update.get('update_id')} 失败: {e}")
+        finally:
+            self.process_time.record(time.monotonic() - started)
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, keep_alive: bool, extra_headers: str = '',
+                       body: Optional[bytes] = None, content_type: str = 'text/plain') -> None:
+        if body is None:
+            body = _REASONS.get(status, '').encode()
+        writer.write((f'HTTP/1.1 {status} {_REASONS.get(status, "")}\r\n'
+                      f'Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n{extra_headers}'
+                      f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode() + body)
+        await writer.drain()